@@ -1,13 +1,39 @@
+import argparse
 import logging
-import sqlite3
 import os
+import socket
+import sys
+import time
 import uuid
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from telegram.constants import ParseMode
-from py3xui import Api, Client
-from py3xui.inbound import Inbound, Settings, StreamSettings, Sniffing
+from panel import PanelUnavailable, is_missing_record_error
+from shards import ShardPlacement, load_panels
+from concurrency import BlockingRunner, PeriodicTask, QueueFull, SingleFlight
+from client_index import ClientIndex, ClientRecord
+from storage import DuplicateUser, open_store
+from provisioning import ClientBatcher
+from client_pool import ClientPool
+from cache import TTLCache
+from traffic import TrafficSnapshot, format_bytes
+from updates import PerUserUpdateProcessor
+from reconcile import Reconciler
+from ratelimit import GLOBAL, RateLimiter, parse_rate
+from transfer import FORMATS, ImportProgress, UserImporter, detect_format, export_users, read_users
+from metrics import MetricsServer, register_cache, timed_handler, track_handler
+from logging_setup import parse_levels, setup_logging
+from broadcast import Broadcaster, Notifier, SendScheduler
+from subscription import SubscriptionProxy
+from telegram_io import MessageEditor, answering, build_request
+from lifecycle import (DEPLETED, EXPIRED, EXPIRING, RENEWED, WARNED, LifecyclePolicy, LifecycleSweeper,
+                       apply_client_changes)
+
+# Начало запуска для замеров этапов; py3xui импортируется при первом обращении к панели
+STARTED_AT = time.perf_counter()
 
 # Настройки из переменных окружения
 BOT_TOKEN = os.getenv('BOT_TOKEN')
@@ -18,6 +44,73 @@ INBOUND_ID = int(os.getenv('INBOUND_ID', '1'))
 DATA_LIMIT_GB = int(os.getenv('DATA_LIMIT_GB', '10'))
 BOT_USERNAME = os.getenv('BOT_USERNAME')
 DEFAULT_PORT = int(os.getenv('DEFAULT_PORT', '5622'))
+XUI_POOL_SIZE = int(os.getenv('XUI_POOL_SIZE', '10'))
+XUI_REQUEST_TIMEOUT = float(os.getenv('XUI_REQUEST_TIMEOUT', '10'))
+XUI_REQUEST_RETRIES = int(os.getenv('XUI_REQUEST_RETRIES', '2'))
+XUI_BREAKER_THRESHOLD = int(os.getenv('XUI_BREAKER_THRESHOLD', '5'))
+XUI_BREAKER_RESET_SECONDS = float(os.getenv('XUI_BREAKER_RESET_SECONDS', '5'))
+XUI_BREAKER_MAX_RESET_SECONDS = float(os.getenv('XUI_BREAKER_MAX_RESET_SECONDS', '300'))
+PANEL_WORKERS = int(os.getenv('PANEL_WORKERS', '8'))
+DB_WORKERS = int(os.getenv('DB_WORKERS', '4'))
+DATABASE_URL = os.getenv('DATABASE_URL')
+REPLICA_ID = os.getenv('REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}"
+REGISTRATION_LEASE_SECONDS = int(os.getenv('REGISTRATION_LEASE_SECONDS', '60'))
+PANEL_QUEUE_LIMIT = int(os.getenv('PANEL_QUEUE_LIMIT', '200'))
+REGISTER_USER_RATE = parse_rate(os.getenv('REGISTER_USER_RATE', '3/60'))
+REGISTER_GLOBAL_RATE = parse_rate(os.getenv('REGISTER_GLOBAL_RATE', '20/1'))
+TEST_USER_RATE = parse_rate(os.getenv('TEST_USER_RATE', '2/60'))
+TEST_GLOBAL_RATE = parse_rate(os.getenv('TEST_GLOBAL_RATE', '10/60'))
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '32'))
+PANEL_SYNC_SECONDS = int(os.getenv('PANEL_SYNC_SECONDS', '120'))
+INBOUND_CACHE_TTL = int(os.getenv('INBOUND_CACHE_TTL', '3600'))
+INBOUND_CAPACITY = int(os.getenv('INBOUND_CAPACITY', '0'))
+XUI_SHARDS = os.getenv('XUI_SHARDS')
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '50000'))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '600'))
+USER_CACHE_NEGATIVE_TTL = int(os.getenv('USER_CACHE_NEGATIVE_TTL', '60'))
+PROVISION_BATCH_WINDOW_MS = int(os.getenv('PROVISION_BATCH_WINDOW_MS', '200'))
+PROVISION_BATCH_SIZE = int(os.getenv('PROVISION_BATCH_SIZE', '50'))
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+SHUTDOWN_DRAIN_SECONDS = int(os.getenv('SHUTDOWN_DRAIN_SECONDS', '25'))
+RECONCILE_SECONDS = int(os.getenv('RECONCILE_SECONDS', '300'))
+RECONCILE_REPAIR = os.getenv('RECONCILE_REPAIR', 'false').lower() in ('1', 'true', 'yes')
+RECONCILE_FULL_EVERY = int(os.getenv('RECONCILE_FULL_EVERY', '12'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv('ADMIN_IDS', '').replace(',', ' ').split()}
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', '200'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+LIFECYCLE_SECONDS = int(os.getenv('LIFECYCLE_SECONDS', '600'))
+LIFECYCLE_WARN_PERCENT = int(os.getenv('LIFECYCLE_WARN_PERCENT', '80'))
+LIFECYCLE_PERIOD_DAYS = int(os.getenv('LIFECYCLE_PERIOD_DAYS', '0'))
+LIFECYCLE_EXPIRY_WARN_DAYS = int(os.getenv('LIFECYCLE_EXPIRY_WARN_DAYS', '3'))
+LIFECYCLE_AUTO_RENEW = os.getenv('LIFECYCLE_AUTO_RENEW', 'false').lower() in ('1', 'true', 'yes')
+SUBSCRIPTION_PROXY_URL = os.getenv('SUBSCRIPTION_PROXY_URL')
+SUBSCRIPTION_LISTEN = os.getenv('SUBSCRIPTION_LISTEN', '0.0.0.0')
+SUBSCRIPTION_PORT = int(os.getenv('SUBSCRIPTION_PORT', '8080'))
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', '300'))
+SUBSCRIPTION_STALE_TTL = int(os.getenv('SUBSCRIPTION_STALE_TTL', '86400'))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '100000'))
+CLIENT_POOL_SIZE = int(os.getenv('CLIENT_POOL_SIZE', '0'))
+CLIENT_POOL_BATCH = int(os.getenv('CLIENT_POOL_BATCH', '20'))
+CLIENT_POOL_FILL_SECONDS = int(os.getenv('CLIENT_POOL_FILL_SECONDS', '30'))
+CLIENT_POOL_MAX_BINDS = int(os.getenv('CLIENT_POOL_MAX_BINDS', '2'))
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', str(UPDATE_CONCURRENCY + BROADCAST_CONCURRENCY + 8)))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv('TELEGRAM_CONNECT_TIMEOUT', '5'))
+TELEGRAM_READ_TIMEOUT = float(os.getenv('TELEGRAM_READ_TIMEOUT', '10'))
+TELEGRAM_WRITE_TIMEOUT = float(os.getenv('TELEGRAM_WRITE_TIMEOUT', '10'))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv('TELEGRAM_POOL_TIMEOUT', '5'))
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_LEVELS = os.getenv('LOG_LEVELS', 'httpx=WARNING,urllib3=WARNING')
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', '')
 
 # Проверка обязательных переменных
 if not all([BOT_TOKEN, XUI_PANEL_URL, XUI_USERNAME, XUI_PASSWORD]):
@@ -28,61 +121,111 @@ if not all([BOT_TOKEN, XUI_PANEL_URL, XUI_USERNAME, XUI_PASSWORD]):
     if not XUI_PASSWORD: missing.append('XUI_PASSWORD')
     raise Exception(f"Отсутствуют обязательные переменные окружения: {', '.join(missing)}")
 
+if BOT_MODE not in ('polling', 'webhook'):
+    raise Exception(f"Неизвестный режим BOT_MODE: {BOT_MODE} (допустимо: polling, webhook)")
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    raise Exception("Для BOT_MODE=webhook необходима переменная окружения WEBHOOK_URL")
+
 # Настройки путей
 BASE_DIR = Path(__file__).parent
-DATA_DIR = BASE_DIR / "data"
+DATA_DIR = Path(os.getenv('DATA_DIR', BASE_DIR / "data"))
 DATA_DIR.mkdir(exist_ok=True)
 DB_NAME = DATA_DIR / "users.db"
 
 # Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Запись логов в отдельном потоке; повторяющиеся строки DEBUG ограничиваются LOG_SAMPLE (по умолчанию выключено)
+setup_logging(LOG_LEVEL, LOG_FORMAT == 'json', parse_levels(LOG_LEVELS), parse_rate(LOG_SAMPLE))
 logger = logging.getLogger(__name__)
 
+# Панели 3x-ui и их инбаунды; у каждой панели своя общая сессия
+panels = load_panels(
+    XUI_SHARDS,
+    default_shard={
+        'name': 'main',
+        'url': XUI_PANEL_URL,
+        'username': XUI_USERNAME,
+        'password': XUI_PASSWORD,
+        'inbounds': [{'id': INBOUND_ID, 'port': DEFAULT_PORT, 'capacity': INBOUND_CAPACITY}]
+    },
+    inbound_cache_ttl=INBOUND_CACHE_TTL,
+    pool_size=XUI_POOL_SIZE,
+    request_timeout=XUI_REQUEST_TIMEOUT,
+    request_retries=XUI_REQUEST_RETRIES,
+    breaker_threshold=XUI_BREAKER_THRESHOLD,
+    breaker_reset=XUI_BREAKER_RESET_SECONDS,
+    breaker_max_reset=XUI_BREAKER_MAX_RESET_SECONDS
+)
+placement = ShardPlacement(panels)
+
+# Отдельные пулы потоков для панели и базы данных
+panel_runner = BlockingRunner("panel", PANEL_WORKERS, max_pending=PANEL_QUEUE_LIMIT or None)
+db_runner = BlockingRunner("db", DB_WORKERS)
+
+# Индекс клиентов панели для поиска без полного сканирования инбаундов
+client_index = ClientIndex()
+
+# Снимок трафика клиентов для показа статуса без запросов к панели
+traffic_snapshot = TrafficSnapshot()
+
+# Хранилище пользователей: общая база PostgreSQL для нескольких реплик (DATABASE_URL) или локальный SQLite
+user_store = open_store(DATABASE_URL, DB_NAME, DB_WORKERS)
+if DATABASE_URL:
+    # Другие реплики пишут в те же инбаунды: чтение и перезапись инбаунда - под арендой в базе
+    for panel in panels:
+        panel.use_leases(user_store, REPLICA_ID)
+DB_LABEL = DATABASE_URL.split('@')[-1] if DATABASE_URL else DB_NAME
+
+# Кэш пользователей перед базой (включая незарегистрированных)
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL, USER_CACHE_NEGATIVE_TTL)
+register_cache("users", user_cache)
+
+# Хэши содержимого сообщений для пропуска правок без изменений
+message_editor = MessageEditor()
+
+# Выполняющиеся регистрации по Telegram ID
+registration_flight = SingleFlight()
+
+
+class RegistrationInProgress(Exception):
+    """Регистрацию пользователя выполняет другая реплика бота"""
+
+# Ограничение частоты действий, которые обращаются к панели
+register_limiter = RateLimiter("register", REGISTER_USER_RATE, REGISTER_GLOBAL_RATE)
+test_limiter = RateLimiter("test", TEST_USER_RATE, TEST_GLOBAL_RATE)
+
+# Рассылки и уведомления делят один лимит: для массовых отправок Telegram допускает около 30 сообщений в секунду
+send_scheduler = SendScheduler(BROADCAST_RATE)
+broadcaster = Broadcaster(
+    user_store, db_runner, send_scheduler,
+    page_size=BROADCAST_PAGE_SIZE, concurrency=BROADCAST_CONCURRENCY, owner=REPLICA_ID
+)
+notifier = Notifier(send_scheduler)
+
 
 # ========== ФУНКЦИИ БАЗЫ ДАННЫХ ==========
 
 def init_db():
     """Инициализация базы данных"""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE,
-                username TEXT,
-                full_name TEXT,
-                language_code TEXT,
-                subscription_url TEXT,
-                xui_client_id TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.commit()
-        conn.close()
-        logger.info(f"База данных инициализирована: {DB_NAME}")
+        user_store.init()
+        logger.info(f"База данных инициализирована: {DB_LABEL}")
     except Exception as e:
         logger.error(f"Ошибка инициализации БД: {e}")
 
 
-def add_user(telegram_id, username, full_name, language_code, subscription_url, xui_client_id):
+def add_user(telegram_id, username, full_name, language_code, subscription_url, xui_client_id,
+             email=None, panel=None, inbound_id=None):
     """Добавление пользователя в базу"""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute(
-            """INSERT INTO users (telegram_id, username, full_name, language_code, subscription_url, xui_client_id) 
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (telegram_id, username, full_name, language_code, subscription_url, xui_client_id)
+        user = user_store.add_user(
+            telegram_id, username, full_name, language_code, subscription_url, xui_client_id,
+            email, panel, inbound_id
         )
-        conn.commit()
-        conn.close()
+        user_cache.put(telegram_id, user)
         return True
-    except sqlite3.IntegrityError:
+    except DuplicateUser:
         logger.warning(f"Пользователь {telegram_id} уже существует")
+        user_cache.invalidate(telegram_id)
         return False
     except Exception as e:
         logger.error(f"Ошибка добавления пользователя: {e}")
@@ -91,12 +234,14 @@ def add_user(telegram_id, username, full_name, language_code, subscription_url,
 
 def get_user(telegram_id):
     """Получение пользователя по Telegram ID"""
+    found, user = user_cache.get(telegram_id)
+    if found:
+        return user
+
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-        user = cursor.fetchone()
-        conn.close()
+        version = user_cache.version
+        user = user_store.get_user(telegram_id)
+        user_cache.fill(telegram_id, user, version)
         return user
     except Exception as e:
         logger.error(f"Ошибка получения пользователя: {e}")
@@ -105,21 +250,12 @@ def get_user(telegram_id):
 
 # ========== ФУНКЦИИ 3X-UI ==========
 
-def login_to_xui():
-    """Авторизация в 3x-ui"""
-    try:
-        api = Api(
-            XUI_PANEL_URL,
-            XUI_USERNAME,
-            XUI_PASSWORD,
-            use_tls_verify=False
-        )
-        api.login()
-        logger.info("✅ Успешная авторизация в 3x-ui")
-        return api
-    except Exception as e:
-        logger.error(f"❌ Ошибка авторизации в 3x-ui: {e}")
-        return None
+def login_to_xui(panel=None):
+    """Получение авторизованной сессии 3x-ui (по умолчанию - основной панели)"""
+    panel = panel or placement.default_panel
+    if panel.session.ensure_login():
+        return panel.session
+    return None
 
 
 def generate_client_email(telegram_id, username):
@@ -134,10 +270,10 @@ def generate_client_email(telegram_id, username):
 def get_all_inbounds(api):
     """Получение всех инбаундов"""
     try:
-        inbounds = api.inbound.get_list()
+        inbounds = api.call("inbound.get_list")
         logger.info(f"📡 Найдено инбаундов: {len(inbounds)}")
         for inbound in inbounds:
-            logger.info(f"  - ID: {inbound.id}, Имя: {inbound.remark}, Порт: {inbound.port}")
+            logger.debug(f"  - ID: {inbound.id}, Имя: {inbound.remark}, Порт: {inbound.port}")
         return inbounds
     except Exception as e:
         logger.error(f"❌ Ошибка получения инбаундов: {e}")
@@ -147,7 +283,7 @@ def get_all_inbounds(api):
 def get_inbound_by_id(api, inbound_id):
     """Получение конкретного инбаунда по ID"""
     try:
-        inbound = api.inbound.get_by_id(inbound_id)
+        inbound = api.call("inbound.get_by_id", inbound_id)
         if inbound:
             logger.info(f"✅ Найден инбаунд: {inbound.remark} (ID: {inbound.id})")
             return inbound
@@ -161,6 +297,8 @@ def get_inbound_by_id(api, inbound_id):
 
 def create_default_inbound(api, port=443):
     """Создание инбаунда по умолчанию если он не существует"""
+    from py3xui.inbound import Inbound, Settings, StreamSettings, Sniffing
+
     try:
         logger.info(f"🔄 Создаем инбаунд по умолчанию на порту {port}...")
 
@@ -197,16 +335,15 @@ def create_default_inbound(api, port=443):
             tag=f"inbound-{port}"
         )
 
-        # Добавляем инбаунд
-        result = api.inbound.add(inbound)
+        # Добавляем инбаунд (при ошибке py3xui выбрасывает исключение)
+        api.call("inbound.add", inbound)
 
-        if result:
-            # Получаем ID созданного инбаунда
-            inbounds = get_all_inbounds(api)
-            for inv in inbounds:
-                if inv.port == port and inv.remark == inbound.remark:
-                    logger.info(f"✅ Инбаунд создан успешно! ID: {inv.id}")
-                    return inv.id
+        # Получаем ID созданного инбаунда
+        inbounds = get_all_inbounds(api)
+        for inv in inbounds:
+            if inv.port == port and inv.remark == inbound.remark:
+                logger.info(f"✅ Инбаунд создан успешно! ID: {inv.id}")
+                return inv
 
         logger.error("❌ Не удалось создать инбаунд")
         return None
@@ -216,14 +353,20 @@ def create_default_inbound(api, port=443):
         return None
 
 
-def ensure_inbound_exists(api, inbound_id, port=443):
-    """Проверяет существование инбаунда и создает его если нужно"""
+def ensure_inbound_exists(target):
+    """Проверяет существование инбаунда (с кэшем) и создает его если нужно"""
+    info = target.cache.get(lambda: resolve_inbound(target.panel.session, target.inbound_id, target.port))
+    return info.id if info else None
+
+
+def resolve_inbound(api, inbound_id, port=443):
+    """Поиск инбаунда по ID или порту, создание если его нет"""
     # Пытаемся найти инбаунд по ID
     inbound = get_inbound_by_id(api, inbound_id)
 
     if inbound:
         logger.info(f"✅ Инбаунд {inbound_id} существует: {inbound.remark}")
-        return inbound_id
+        return inbound
 
     # Если инбаунд не найден по ID, ищем по порту
     logger.info(f"🔍 Ищем инбаунд на порту {port}...")
@@ -231,29 +374,52 @@ def ensure_inbound_exists(api, inbound_id, port=443):
     for inv in inbounds:
         if inv.port == port:
             logger.info(f"✅ Найден инбаунд на порту {port}: ID {inv.id}")
-            return inv.id
+            return inv
 
     # Если инбаунд не найден, создаем новый
     logger.warning(f"⚠️ Инбаунд не найден. Создаем новый на порту {port}...")
-    new_inbound_id = create_default_inbound(api, port)
+    new_inbound = create_default_inbound(api, port)
 
-    if new_inbound_id:
-        logger.info(f"✅ Новый инбаунд создан с ID: {new_inbound_id}")
-        return new_inbound_id
+    if new_inbound:
+        logger.info(f"✅ Новый инбаунд создан с ID: {new_inbound.id}")
+        return new_inbound
     else:
         logger.error("❌ Не удалось создать инбаунд")
         return None
 
 
-def create_xui_client(telegram_id, username, full_name, data_limit_gb=10):
-    """Создание клиента в 3x-ui"""
+def add_clients(shard_key, clients):
+    """Добавление клиентов в инбаунд одним вызовом (при ошибке py3xui выбрасывает исключение)"""
+    panel_name, inbound_id = shard_key
+    panel = placement.panel(panel_name)
     try:
-        api = login_to_xui()
-        if not api:
-            return None
+        with panel.write_lock(inbound_id):
+            panel.session.call("client.add", inbound_id, clients)
+    except Exception as e:
+        if is_missing_record_error(e):
+            # Инбаунд удален в панели: следующий вызов найдет или создаст его заново
+            panel.invalidate_inbound(inbound_id)
+        raise
+
 
-        # Проверяем и создаем инбаунд если нужно
-        actual_inbound_id = ensure_inbound_exists(api, INBOUND_ID, DEFAULT_PORT)
+def choose_target():
+    """Выбор панели и инбаунда для нового клиента по числу клиентов"""
+    client_index.ensure_loaded(fetch_inbounds)
+    target = placement.choose(client_index.count)
+    if not target:
+        if not placement.available:
+            raise PanelUnavailable("Все панели 3x-ui временно недоступны")
+        return None, None
+    return target, ensure_inbound_exists(target)
+
+
+async def create_xui_client(telegram_id, username, full_name, data_limit_gb=10):
+    """Создание клиента в 3x-ui"""
+    from py3xui import Client
+
+    try:
+        # Выбираем наименее заполненный инбаунд, проверяем и создаем его если нужно
+        target, actual_inbound_id = await panel_runner.run(choose_target)
         if not actual_inbound_id:
             logger.error("❌ Не удалось найти или создать инбаунд")
             return None
@@ -271,102 +437,336 @@ def create_xui_client(telegram_id, username, full_name, data_limit_gb=10):
             enable=True,
             limitIp=0,
             totalGB=data_limit_gb * 1073741824,  # Конвертация в байты
-            expiryTime=0
+            expiryTime=0,
+            tgId=telegram_id
         )
 
-        # Добавляем клиента в инбаунд
-        logger.info(f"🔄 Добавляем клиента в инбаунд {actual_inbound_id}")
-        result = api.client.add(actual_inbound_id, [client_config])
+        # Добавляем клиента в инбаунд вместе с другими регистрациями из того же окна
+        panel_name = target.panel.name
+        logger.info(f"🔄 Добавляем клиента в инбаунд {actual_inbound_id} панели {panel_name}")
+        await client_batcher.submit((panel_name, actual_inbound_id), client_config)
+
+        # Генерируем ссылку для подписки
+        subscription_url = generate_subscription_url(client_id, actual_inbound_id, panel_name)
+        client_index.add(ClientRecord(client_id, email, actual_inbound_id, telegram_id, panel_name))
+        logger.info(f"✅ Клиент создан: {email} (ID: {client_id})")
+        return {
+            'client_id': client_id,
+            'subscription_url': subscription_url,
+            'email': email,
+            'inbound_id': actual_inbound_id,
+            'panel': panel_name,
+            'success': True
+        }
+
+    except (PanelUnavailable, QueueFull):
+        # Отказ без обращения к панели: пользователь получает сообщение о перегрузке
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка создания клиента: {e}")
+        return None
 
-        if result:
-            # Генерируем ссылку для подписки
-            subscription_url = generate_subscription_url(client_id, actual_inbound_id)
-            logger.info(f"✅ Клиент создан: {email} (ID: {client_id})")
-            return {
-                'client_id': client_id,
-                'subscription_url': subscription_url,
-                'email': email,
-                'inbound_id': actual_inbound_id,
-                'success': True
-            }
-        else:
-            logger.error("❌ Не удалось создать клиента в 3x-ui")
-            return None
 
+def create_spare_clients(target, spares):
+    """Добавление отключенных клиентов запаса одним вызовом client.add"""
+    from py3xui import Client
+
+    clients = [
+        Client(id=spare.client_id, email=spare.email, enable=False, limitIp=0,
+               totalGB=DATA_LIMIT_GB * 1073741824, expiryTime=0)
+        for spare in spares
+    ]
+    add_clients(target, clients)
+    for spare in spares:
+        client_index.add(ClientRecord(spare.client_id, spare.email, spare.inbound_id, None, spare.panel))
+
+
+def bind_spare_client(spare, client):
+    """Переименование и включение клиента запаса одним client.update
+
+    Запрос передает только этого клиента и не ждет окна пачки, поэтому
+    регистрация из запаса не зависит от размера инбаунда и окна
+    PROVISION_BATCH_WINDOW_MS.
+    """
+    panel = placement.panel(spare.panel)
+    with panel.write_lock(spare.inbound_id):
+        panel.session.call("client.update", client.id, client)
+
+
+async def take_spare_client(telegram_id, username):
+    """Клиент для пользователя из запаса; None, если запас пуст, занят или привязать клиента не удалось"""
+    # Во время всплеска регистраций client.add пачкой быстрее привязок по одному
+    if not client_pool.acquire_bind(contended=client_batcher.busy):
+        return None
+    try:
+        return await bind_from_pool(telegram_id, username)
+    finally:
+        client_pool.release_bind()
+
+
+async def bind_from_pool(telegram_id, username):
+    from py3xui import Client
+
+    available = [panel.name for panel in panels if panel.session.available]
+    spare = await db_runner.run(client_pool.take, available)
+    if spare is None:
+        return None
+
+    email = generate_client_email(telegram_id, username)
+    client = Client(id=spare.client_id, email=email, enable=True, limitIp=0,
+                    totalGB=DATA_LIMIT_GB * 1073741824, expiryTime=0, tgId=telegram_id, inboundId=spare.inbound_id)
+    try:
+        await panel_runner.run(bind_spare_client, spare, client)
+    except (PanelUnavailable, QueueFull, TimeoutError) as e:
+        # Вызов в панель не выполнялся: клиент не изменен и остается в запасе
+        logger.warning(f"⚠️ Клиент запаса {spare.client_id} не привязан и возвращен в запас: {e}")
+        await db_runner.run(client_pool.put_back, spare)
+        return None
     except Exception as e:
-        logger.error(f"❌ Ошибка создания клиента: {e}")
+        logger.error(f"❌ Не удалось привязать клиента запаса {spare.client_id}, он исключен из запаса: {e}")
+        client_index.remove(spare.client_id)
         return None
 
+    client_index.add(ClientRecord(spare.client_id, email, spare.inbound_id, telegram_id, spare.panel))
+    return {
+        'client_id': spare.client_id,
+        'subscription_url': generate_subscription_url(spare.client_id, spare.inbound_id, spare.panel),
+        'email': email,
+        'inbound_id': spare.inbound_id,
+        'panel': spare.panel,
+        'success': True
+    }
 
-def generate_subscription_url(client_id, inbound_id=None):
-    """Генерация ссылки для подписки"""
+
+def fill_client_pool():
+    """Пополнение запаса одной пачкой в наименее заполненный инбаунд; возвращает число клиентов"""
+    target, inbound_id = choose_target()
+    if not inbound_id:
+        return 0
+    return client_pool.fill((target.panel.name, inbound_id))
+
+
+# Запас отключенных клиентов для регистрации без client.add (CLIENT_POOL_SIZE=0 отключает)
+client_pool = ClientPool(
+    user_store, CLIENT_POOL_SIZE, CLIENT_POOL_BATCH, create_spare_clients, CLIENT_POOL_MAX_BINDS
+) if CLIENT_POOL_SIZE else None
+
+
+def generate_subscription_url(client_id, inbound_id=None, panel_name=None):
+    """Генерация ссылки для подписки: на прокси подписок, если он включен, иначе на панели клиента"""
     try:
         actual_inbound_id = inbound_id or INBOUND_ID
-        base_url = XUI_PANEL_URL.rstrip('/')
+        base_url = SUBSCRIPTION_PROXY_URL.rstrip('/') if subscription_proxy else placement.panel(panel_name).url
         subscription_url = f"{base_url}/sub/{actual_inbound_id}/{client_id}"
-        logger.info(f"🔗 Сгенерирована ссылка: {subscription_url}")
+        logger.debug(f"🔗 Сгенерирована ссылка: {subscription_url}")
         return subscription_url
     except Exception as e:
         logger.error(f"❌ Ошибка генерации ссылки: {e}")
         return f"{XUI_PANEL_URL}/sub/{client_id}"
 
 
+def panel_subscription_url(client_id):
+    """Ссылка подписки в панели для клиента бота; None для неизвестных клиентов"""
+    record = client_index.by_client_id(client_id)
+    if record:
+        return f"{placement.panel(record.panel).url}/sub/{record.inbound_id}/{record.client_id}"
+    user = user_store.get_user_by_client_id(client_id)
+    if user:
+        return f"{placement.panel(user.panel).url}/sub/{user.inbound_id or INBOUND_ID}/{user.xui_client_id}"
+    return None
+
+
+async def resolve_subscription(client_id):
+    return await db_runner.run(panel_subscription_url, client_id)
+
+
+# Кэширующий прокси ссылок подписки (включается SUBSCRIPTION_PROXY_URL)
+subscription_proxy = SubscriptionProxy(
+    SUBSCRIPTION_LISTEN, SUBSCRIPTION_PORT, resolve_subscription,
+    ttl=SUBSCRIPTION_CACHE_TTL, stale_ttl=SUBSCRIPTION_STALE_TTL, max_size=SUBSCRIPTION_CACHE_SIZE
+) if SUBSCRIPTION_PROXY_URL else None
+
+
+def user_subscription_url(user_data):
+    """Ссылка подписки пользователя; при включенном прокси - ссылка на прокси вместо сохраненной"""
+    if subscription_proxy and user_data.xui_client_id:
+        return generate_subscription_url(user_data.xui_client_id, user_data.inbound_id, user_data.panel)
+    return user_data.subscription_url
+
+
+def invalidate_subscription(client_id):
+    """Сброс закэшированной подписки после изменения клиента ботом"""
+    if subscription_proxy and client_id:
+        subscription_proxy.invalidate(client_id)
+
+
 def test_xui_connection():
-    """Тестирование подключения к 3x-ui"""
+    """Тестирование подключения ко всем панелям 3x-ui"""
     try:
-        api = login_to_xui()
-        if api:
-            inbounds = get_all_inbounds(api)
-            if inbounds:
-                logger.info("✅ Подключение к 3x-ui успешно")
-                return True
-        return False
+        for panel in panels:
+            api = login_to_xui(panel)
+            if not api or not get_all_inbounds(api):
+                logger.warning(f"⚠️ Панель {panel.name} недоступна")
+                return False
+        logger.info("✅ Подключение к 3x-ui успешно")
+        return True
     except Exception as e:
         logger.error(f"❌ Ошибка тестирования подключения: {e}")
         return False
 
 
+def fetch_inbounds():
+    """Выгрузка инбаундов с клиентами и статистикой: по одному запросу на панель"""
+    inbounds_by_panel = {panel.name: panel.session.call("inbound.get_list") for panel in panels}
+    # Та же выгрузка обновляет снимок трафика
+    traffic_snapshot.load(inbounds_by_panel)
+    return inbounds_by_panel
+
+
+def sync_panel_state():
+    """Обновление индекса клиентов и снимка трафика одной выгрузкой"""
+    client_index.refresh(fetch_inbounds)
+
+
 def get_existing_client(telegram_id):
     """Поиск существующего клиента по Telegram ID"""
     try:
-        api = login_to_xui()
-        if not api:
-            return None
-
-        # Получаем все инбаунды и ищем клиента
-        inbounds = get_all_inbounds(api)
+        client_index.ensure_loaded(fetch_inbounds)
+        record = client_index.by_telegram_id(telegram_id)
 
-        for inbound in inbounds:
-            # Ищем клиента по email (так как tgId может не поддерживаться)
-            clients = inbound.settings.clients
-
-            for client in clients:
-                # Ищем по email, так как в этой версии API может не быть tgId
-                # Email генерируется на основе Telegram данных
-                expected_email_prefix = f"user{telegram_id}" if not telegram_id else f"{telegram_id}"
-                if client.email and expected_email_prefix in client.email:
-                    client_id = client.id
-                    subscription_url = generate_subscription_url(client_id, inbound.id)
-                    email = client.email
-                    logger.info(f"✅ Найден существующий клиент для Telegram ID {telegram_id} в инбаунде {inbound.id}")
-                    return {
-                        'client_id': client_id,
-                        'subscription_url': subscription_url,
-                        'email': email,
-                        'inbound_id': inbound.id,
-                        'existing': True
-                    }
-
-        logger.info(f"ℹ️ Существующий клиент для Telegram ID {telegram_id} не найден")
-        return None
+        if not record:
+            logger.debug(f"ℹ️ Существующий клиент для Telegram ID {telegram_id} не найден")
+            return None
 
+        logger.info(
+            f"✅ Найден существующий клиент для Telegram ID {telegram_id} "
+            f"в инбаунде {record.inbound_id} панели {record.panel}"
+        )
+        return {
+            'client_id': record.client_id,
+            'subscription_url': generate_subscription_url(record.client_id, record.inbound_id, record.panel),
+            'email': record.email,
+            'inbound_id': record.inbound_id,
+            'panel': record.panel,
+            'existing': True,
+            'success': True
+        }
+
+    except PanelUnavailable:
+        raise
     except Exception as e:
         logger.error(f"❌ Ошибка поиска клиента: {e}")
         return None
 
 
+def adopt_orphan_client(record):
+    """Запись в базу пользователя для клиента бота, найденного только в панели"""
+    subscription_url = generate_subscription_url(record.client_id, record.inbound_id, record.panel)
+    return add_user(
+        record.telegram_id, None, None, None, subscription_url, record.client_id,
+        record.email, record.panel, record.inbound_id
+    )
+
+
+def delete_spare_client(record):
+    """Удаление из панели клиента запаса, которого нет в таблице spare_clients"""
+    panel = placement.panel(record.panel)
+    with panel.write_lock(record.inbound_id):
+        panel.session.call("client.delete", record.inbound_id, record.client_id)
+    client_index.remove(record.client_id)
+
+
+# Сверка таблицы users с клиентами панелей
+reconciler = Reconciler(
+    user_store,
+    default_panel=placement.default_panel.name,
+    default_inbound_id=INBOUND_ID,
+    adopt=adopt_orphan_client,
+    invalidate=user_cache.invalidate,
+    repair=RECONCILE_REPAIR,
+    full_every=RECONCILE_FULL_EVERY,
+    delete_spare=delete_spare_client
+)
+
+
+def reconcile_panel_state():
+    """Проход сверки базы и панелей по свежей выгрузке инбаундов"""
+    return reconciler.run(fetch_inbounds())
+
+
+def apply_lifecycle_changes(panel_name, inbound_id, changes):
+    """Запись изменений клиентов инбаунда без пересечения с добавлением клиентов"""
+    panel = placement.panel(panel_name)
+    with panel.write_lock(inbound_id):
+        apply_client_changes(panel.session, inbound_id, changes)
+    for change in changes:
+        record = client_index.by_email(change.email)
+        if record:
+            invalidate_subscription(record.client_id)
+
+
+# Пороги трафика и сроки действия клиентов бота
+lifecycle_sweeper = LifecycleSweeper(
+    user_store,
+    LifecyclePolicy(
+        warn_percent=LIFECYCLE_WARN_PERCENT,
+        period_days=LIFECYCLE_PERIOD_DAYS,
+        expiry_warn_days=LIFECYCLE_EXPIRY_WARN_DAYS,
+        auto_renew=LIFECYCLE_AUTO_RENEW
+    ),
+    apply_lifecycle_changes
+)
+
+
+def sweep_client_lifecycle():
+    """Проход по трафику и срокам клиентов по свежей выгрузке инбаундов"""
+    return lifecycle_sweeper.run(fetch_inbounds())
+
+
+# Пакетное добавление клиентов: одна перезапись инбаунда на несколько регистраций
+client_batcher = ClientBatcher(
+    add_clients,
+    panel_runner,
+    window=PROVISION_BATCH_WINDOW_MS / 1000,
+    max_batch=PROVISION_BATCH_SIZE
+)
+
+
 # ========== TELEGRAM БОТ ==========
 
+# Данные кнопок, для которых ведутся отдельные метрики
+BUTTON_ACTIONS = ("register", "status", "help")
+
+PANEL_UNAVAILABLE_TEXT = (
+    "⏳ **Сервис временно недоступен**\n\n"
+    "Сервер VPN сейчас не отвечает, мы уже восстанавливаем работу. "
+    "Попробуйте зарегистрироваться через несколько минут.\n\n"
+    "Если вы уже зарегистрированы, ваша ссылка продолжает работать: /status"
+)
+
+
+def rate_limited_text(scope, retry_after):
+    """Ответ пользователю, превысившему лимит"""
+    if scope == GLOBAL:
+        return (
+            "⏳ **Сейчас очень много запросов**\n\n"
+            f"Пожалуйста, попробуйте снова через {max(int(retry_after), 1)} с."
+        )
+    return f"⏳ Слишком частые запросы. Попробуйте снова через {max(int(retry_after), 1)} с."
+
+
+def admit_panel_work(limiter, user_id):
+    """Проверка лимитов и очереди панели; None - можно выполнять, иначе текст отказа"""
+    if panel_runner.saturated:
+        logger.warning(f"🚦 Очередь панели заполнена ({panel_runner.pending}), запрос {limiter.action} отклонен")
+        return rate_limited_text(GLOBAL, 5)
+    rejected = limiter.check(user_id)
+    if rejected:
+        return rate_limited_text(*rejected)
+    return None
+
+
+@timed_handler("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     user = update.effective_user
@@ -396,14 +796,88 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатий кнопок"""
     query = update.callback_query
-    await query.answer()
+    action = query.data if query.data in BUTTON_ACTIONS else "other"
+
+    with track_handler(f"button:{action}"):
+        # answer() отправляется параллельно с обработкой, а не перед ней
+        async with answering(query):
+            if query.data == "register":
+                await register_user(query, context)
+            elif query.data == "status":
+                await show_status(query, context)
+            elif query.data == "help":
+                await help_command(query, context)
+
+
+async def provision_user(user):
+    """Регистрация пользователя под арендой в базе, общей для всех реплик
+
+    SingleFlight объединяет повторные нажатия внутри процесса, аренда
+    register:{id} - нажатия, попавшие на разные реплики.
+    """
+    lease = f"register:{user.id}"
+    if not await db_runner.run(user_store.acquire_lease, lease, REPLICA_ID, REGISTRATION_LEASE_SECONDS):
+        raise RegistrationInProgress(user.id)
+    try:
+        # Другая реплика могла завершить регистрацию, пока в кэше лежал промах
+        stored = await db_runner.run(user_store.get_user, user.id)
+        if stored:
+            user_cache.put(user.id, stored)
+            return {
+                'success': True,
+                'existing': True,
+                'email': stored.email,
+                'client_id': stored.xui_client_id,
+                'subscription_url': user_subscription_url(stored),
+                'panel': stored.panel,
+                'inbound_id': stored.inbound_id
+            }, True
+        return await create_or_find_client(user)
+    finally:
+        await db_runner.run(user_store.release_lease, lease, REPLICA_ID)
+
+
+async def create_or_find_client(user):
+    """Создание или поиск клиента в 3x-ui и сохранение пользователя в базу"""
+    # Сначала проверяем, нет ли существующего клиента в 3x-ui
+    existing_client = await panel_runner.run(get_existing_client, user.id)
 
-    if query.data == "register":
-        await register_user(query, context)
-    elif query.data == "status":
-        await show_status(query, context)
-    elif query.data == "help":
-        await help_command(query, context)
+    if existing_client:
+        # Используем существующего клиента
+        client_result = existing_client
+        logger.info(f"🔄 Используем существующего клиента для пользователя {user.id}")
+    else:
+        # Клиент из запаса уже есть в панели: его достаточно переименовать и включить
+        client_result = await take_spare_client(user.id, user.username) if client_pool else None
+        if client_result:
+            logger.info(f"🧊 Клиент для пользователя {user.id} взят из запаса")
+        else:
+            # Создаем нового клиента
+            logger.info(f"🆕 Создаем нового клиента для пользователя {user.id}")
+            client_result = await create_xui_client(
+                user.id,
+                user.username,
+                user.full_name,
+                DATA_LIMIT_GB
+            )
+
+    if not client_result or not client_result.get('success'):
+        return client_result, False
+
+    # Сохраняем пользователя в базу
+    success = await db_runner.run(
+        add_user,
+        user.id,
+        user.username,
+        user.full_name,
+        user.language_code,
+        client_result['subscription_url'],
+        client_result['client_id'],
+        client_result['email'],
+        client_result['panel'],
+        client_result['inbound_id']
+    )
+    return client_result, success
 
 
 async def register_user(query, context):
@@ -411,11 +885,12 @@ async def register_user(query, context):
     user = query.from_user
 
     # Проверяем, не зарегистрирован ли уже пользователь в нашей базе
-    existing_user = get_user(user.id)
+    existing_user = await db_runner.run(get_user, user.id)
 
     if existing_user:
-        subscription_url = existing_user[5]
-        await query.edit_message_text(
+        subscription_url = user_subscription_url(existing_user)
+        await message_editor.edit(
+            query,
             f"✅ **Вы уже зарегистрированы!**\n\n"
             f"🔗 **Ваша ссылка для подключения:**\n"
             f"`{subscription_url}`\n\n"
@@ -424,41 +899,49 @@ async def register_user(query, context):
         )
         return
 
-    # Сразу начинаем процесс регистрации
-    await query.edit_message_text(
-        "⏳ **Создаем ваш VPN аккаунт...**\n\n"
-        "Используем данные вашего Telegram аккаунта...",
-        parse_mode=ParseMode.MARKDOWN
-    )
-
-    # Сначала проверяем, нет ли существующего клиента в 3x-ui
-    existing_client = get_existing_client(user.id)
-
-    if existing_client:
-        # Используем существующего клиента
-        client_result = existing_client
-        logger.info(f"🔄 Используем существующего клиента для пользователя {user.id}")
-    else:
-        # Создаем нового клиента
-        logger.info(f"🆕 Создаем нового клиента для пользователя {user.id}")
-        client_result = create_xui_client(
-            user.id,
-            user.username,
-            user.full_name,
-            DATA_LIMIT_GB
+    if user.id not in registration_flight:
+        # Панель недоступна: отвечаем сразу, не дожидаясь таймаутов
+        if not placement.available:
+            await message_editor.edit(query, PANEL_UNAVAILABLE_TEXT, parse_mode=ParseMode.MARKDOWN)
+            return
+
+        # Повторные нажатия во время регистрации не нагружают панель и не ограничиваются
+        rejection = admit_panel_work(register_limiter, user.id)
+        if rejection:
+            await message_editor.edit(query, rejection, parse_mode=ParseMode.MARKDOWN)
+            return
+
+    # Сразу начинаем процесс регистрации (при повторном нажатии сообщение уже показано)
+    if user.id not in registration_flight:
+        await message_editor.edit(
+            query,
+            "⏳ **Создаем ваш VPN аккаунт...**\n\n"
+            "Используем данные вашего Telegram аккаунта...",
+            parse_mode=ParseMode.MARKDOWN
         )
 
-    if client_result and client_result.get('success'):
-        # Сохраняем пользователя в базу
-        success = add_user(
-            user.id,
-            user.username,
-            user.full_name,
-            user.language_code,
-            client_result['subscription_url'],
-            client_result['client_id']
+    # Повторные нажатия ждут уже запущенную регистрацию этого пользователя
+    try:
+        client_result, success = await registration_flight.run(user.id, provision_user, user)
+    except PanelUnavailable as e:
+        logger.warning(f"⏳ Регистрация {user.id} отклонена: {e}")
+        await message_editor.edit(query, PANEL_UNAVAILABLE_TEXT, parse_mode=ParseMode.MARKDOWN)
+        return
+    except QueueFull as e:
+        logger.warning(f"🚦 Регистрация {user.id} отклонена: {e}")
+        await message_editor.edit(query, rate_limited_text(GLOBAL, 5), parse_mode=ParseMode.MARKDOWN)
+        return
+    except RegistrationInProgress:
+        logger.info(f"⏳ Регистрация {user.id} уже выполняется другой репликой")
+        await message_editor.edit(
+            query,
+            "⏳ **Регистрация уже выполняется...**\n\n"
+            "Через несколько секунд нажмите '📊 Мой статус'.",
+            parse_mode=ParseMode.MARKDOWN
         )
+        return
 
+    if client_result and client_result.get('success'):
         if success:
             if client_result.get('existing', False):
                 message_header = "🔄 **Найден существующий аккаунт!**"
@@ -472,7 +955,8 @@ async def register_user(query, context):
             if user.username:
                 user_info += f"📱 **Username:** @{user.username}\n"
 
-            await query.edit_message_text(
+            await message_editor.edit(
+                query,
                 f"{message_header}\n\n"
                 f"{user_info}\n"
                 f"📧 **Сгенерированный email:** {client_result['email']}\n"
@@ -487,14 +971,16 @@ async def register_user(query, context):
                 parse_mode=ParseMode.MARKDOWN
             )
         else:
-            await query.edit_message_text(
+            await message_editor.edit(
+                query,
                 "❌ **Ошибка сохранения данных!**\n\n"
                 "VPN аккаунт создан, но возникла ошибка при сохранении в базе. "
                 "Обратитесь к администратору.",
                 parse_mode=ParseMode.MARKDOWN
             )
     else:
-        await query.edit_message_text(
+        await message_editor.edit(
+            query,
             "❌ **Ошибка создания VPN аккаунта!**\n\n"
             "Возможные причины:\n"
             "• Панель 3x-ui недоступна\n"
@@ -506,29 +992,42 @@ async def register_user(query, context):
         )
 
 
+def format_traffic_usage(user_data):
+    """Строки об израсходованном трафике из последнего снимка"""
+    usage = traffic_snapshot.get(user_data.xui_client_id, user_data.email)
+    if usage is None:
+        return "📈 **Использовано:** данные обновляются\n"
+
+    text = f"📈 **Использовано:** {format_bytes(usage.used)}\n"
+    if usage.remaining is not None:
+        text += f"📉 **Осталось:** {format_bytes(usage.remaining)}\n"
+    text += f"🕒 **Данные на:** {traffic_snapshot.updated_at:%d.%m.%Y %H:%M}\n"
+    return text
+
+
 async def show_status(query, context):
     """Показать статус пользователя"""
     user = query.from_user
-    user_data = get_user(user.id)
+    user_data = await db_runner.run(get_user, user.id)
 
     if user_data:
-        _, telegram_id, username, full_name, language_code, subscription_url, xui_client_id, created_at = user_data
-
         status_text = (
             f"✅ **Ваш VPN аккаунт активен**\n\n"
-            f"👤 **Telegram пользователь:** {full_name or 'Не указано'}\n"
+            f"👤 **Telegram пользователь:** {user_data.full_name or 'Не указано'}\n"
         )
 
-        if username:
-            status_text += f"📱 **Username:** @{username}\n"
+        if user_data.username:
+            status_text += f"📱 **Username:** @{user_data.username}\n"
 
         status_text += (
-            f"🆔 **Telegram ID:** {telegram_id}\n"
+            f"🆔 **Telegram ID:** {user_data.telegram_id}\n"
             f"📊 **Лимит трафика:** {DATA_LIMIT_GB} GB\n"
-            f"📅 **Регистрация:** {created_at[:10]}\n"
-            f"🆔 **ID клиента:** {xui_client_id}\n\n"
+            f"{format_traffic_usage(user_data)}"
+            f"📅 **Регистрация:** {user_data.created_at[:10]}\n"
+            f"🆔 **ID клиента:** {user_data.xui_client_id}\n\n"
         )
 
+        subscription_url = user_subscription_url(user_data)
         if subscription_url:
             status_text += f"🔗 **Ссылка для подключения:**\n`{subscription_url}`\n\n"
 
@@ -539,14 +1038,15 @@ async def show_status(query, context):
             "• Для перерегистрации удалите старую подписку из клиента"
         )
 
-        await query.edit_message_text(status_text, parse_mode=ParseMode.MARKDOWN)
+        await message_editor.edit(query, status_text, parse_mode=ParseMode.MARKDOWN)
     else:
         keyboard = [
             [InlineKeyboardButton("🚀 Зарегистрироваться", callback_data="register")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
-        await query.edit_message_text(
+        await message_editor.edit(
+            query,
             "❌ **Вы не зарегистрированы!**\n\n"
             "Нажмите кнопку ниже чтобы создать VPN аккаунт "
             "используя ваш Telegram профиль.",
@@ -584,18 +1084,20 @@ async def help_command(query, context):
         "• Не требуем email и пароли\n"
         "• Ваши данные защищены"
     )
-    await query.edit_message_text(help_text, parse_mode=ParseMode.MARKDOWN)
+    await message_editor.edit(query, help_text, parse_mode=ParseMode.MARKDOWN)
 
 
+@timed_handler("status_command")
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /status"""
     user = update.effective_user
-    user_data = get_user(user.id)
+    user_data = await db_runner.run(get_user, user.id)
 
     if user_data:
-        subscription_url = user_data[5]
+        subscription_url = user_subscription_url(user_data)
         await update.message.reply_text(
             f"🔗 **Ваша ссылка для подключения:**\n`{subscription_url}`\n\n"
+            f"{format_traffic_usage(user_data)}\n"
             f"Используйте /start для полной информации о аккаунте.",
             parse_mode=ParseMode.MARKDOWN
         )
@@ -611,53 +1113,388 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+@timed_handler("test_command")
 async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для тестирования подключения к 3x-ui"""
+    rejection = admit_panel_work(test_limiter, update.effective_user.id)
+    if rejection:
+        await update.message.reply_text(rejection, parse_mode=ParseMode.MARKDOWN)
+        return
+
     await update.message.reply_text("🧪 Тестируем подключение к 3x-ui...")
 
-    if test_xui_connection():
+    try:
+        connected = await panel_runner.run(test_xui_connection)
+    except QueueFull as e:
+        logger.warning(f"🚦 Проверка подключения отклонена: {e}")
+        await update.message.reply_text(rate_limited_text(GLOBAL, 5), parse_mode=ParseMode.MARKDOWN)
+        return
+
+    if connected:
         await update.message.reply_text("✅ Подключение к 3x-ui успешно!")
     else:
         await update.message.reply_text("❌ Не удалось подключиться к 3x-ui")
 
+    cache_stats = user_cache.stats()
+    breakers = "\n".join(f"🔌 Панель {panel.name}: {panel.session.breaker.describe()}" for panel in panels)
+    await update.message.reply_text(
+        f"{breakers}\n"
+        f"💾 Кэш пользователей: {cache_stats['size']}/{cache_stats['max_size']}, "
+        f"попаданий {cache_stats['hits']}, промахов {cache_stats['misses']} "
+        f"({cache_stats['hit_ratio']:.0%})"
+    )
+
+
+def lifecycle_notification_text(notification):
+    """Текст уведомления о смене фазы клиента"""
+    expiry = datetime.fromtimestamp(notification.expiry_time / 1000).strftime('%d.%m.%Y')
+    usage = f"Использовано {format_bytes(notification.used)} из {format_bytes(notification.total)}."
+    if notification.kind == WARNED:
+        return f"⚠️ Трафик VPN почти израсходован. {usage}"
+    if notification.kind == DEPLETED:
+        return f"⛔ Трафик VPN израсходован, подключение приостановлено. {usage}"
+    if notification.kind == EXPIRING:
+        return f"⏳ Срок действия VPN заканчивается {expiry}."
+    if notification.kind == EXPIRED:
+        return "⛔ Срок действия VPN истек, подключение приостановлено."
+    if notification.kind == RENEWED:
+        return f"🔄 Доступ к VPN продлен до {expiry}, трафик обнулен."
+    return None
+
+
+async def run_lifecycle():
+    """Фоновая проверка трафика и сроков с постановкой уведомлений в очередь"""
+    if not await holds_job_lease("lifecycle", LIFECYCLE_SECONDS):
+        # Фазы меняет другая реплика: при переходе аренды сюда они перечитываются из базы
+        lifecycle_sweeper.forget()
+        logger.debug("⏳ Проверку жизненного цикла выполняет другая реплика")
+        return
+    report = await panel_runner.run(sweep_client_lifecycle)
+    for notification in report.notifications:
+        text = lifecycle_notification_text(notification)
+        if text:
+            notifier.submit(notification.telegram_id, text)
+
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда администратора /broadcast <текст>: рассылка всем пользователям"""
+    # Команда может быть вида /broadcast@BotName и отделяться от текста переводом строки
+    parts = update.message.text.split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        await update.message.reply_text("Использование: /broadcast <текст сообщения>")
+        return
+    if broadcaster.running:
+        await update.message.reply_text(f"⏳ Уже выполняется: {await broadcaster.progress()}")
+        return
+
+    try:
+        progress = await broadcaster.launch(context.bot, text, update.effective_user.id)
+    except RuntimeError as e:
+        # Рассылку ведет другая реплика
+        await update.message.reply_text(f"⏳ {e}: /broadcast_status")
+        return
+    minutes = progress.total / BROADCAST_RATE / 60
+    await update.message.reply_text(
+        f"📨 Рассылка #{progress.id} запущена: {progress.total} получателей, "
+        f"примерно {minutes:.0f} мин.\nПрогресс: /broadcast_status, отмена: /broadcast_cancel"
+    )
+
+
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда администратора /broadcast_status [ID]: прогресс рассылки"""
+    broadcast_id = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    progress = await broadcaster.progress(broadcast_id)
+    await update.message.reply_text(progress or "Рассылок еще не было")
+
+
+async def broadcast_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда администратора /broadcast_cancel: отмена текущей рассылки"""
+    if await broadcaster.cancel():
+        await update.message.reply_text(f"🛑 {await broadcaster.progress()}")
+    else:
+        await update.message.reply_text("Нет выполняющейся рассылки")
+
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
     logger.error(f"Ошибка: {context.error}", exc_info=context.error)
 
 
+@contextmanager
+def startup_phase(name):
+    """Замер длительности этапа запуска"""
+    started = time.perf_counter()
+    yield
+    logger.info(f"⏱️ Запуск: {name} - {(time.perf_counter() - started) * 1000:.0f} мс")
+
+
+def warm_up_inbound_cache():
+    """Разрешение инбаундов при запуске, до первой регистрации"""
+    for target in placement.targets:
+        if ensure_inbound_exists(target):
+            logger.info(f"🔥 Инбаунд {target.name} разрешен при запуске")
+        else:
+            logger.warning(f"⚠️ Не удалось разрешить инбаунд {target.name} при запуске")
+
+
+async def run_panel_sync():
+    """Фоновое обновление индекса клиентов и снимка трафика"""
+    await panel_runner.run(sync_panel_state)
+
+
+panel_sync_job = PeriodicTask("panel-sync", PANEL_SYNC_SECONDS, run_panel_sync)
+
+
+async def holds_job_lease(name, interval):
+    """Фоновые задачи со сменой состояния выполняет одна реплика; аренда продлевается каждым проходом"""
+    return await db_runner.run(user_store.acquire_lease, f"job:{name}", REPLICA_ID, interval * 2)
+
+
+async def run_reconcile():
+    """Фоновая сверка базы с панелями"""
+    if not await holds_job_lease("reconcile", RECONCILE_SECONDS):
+        logger.debug("🔁 Сверку выполняет другая реплика")
+        return
+    await panel_runner.run(reconcile_panel_state)
+
+
+# Первый проход после первой синхронизации панели (RECONCILE_SECONDS=0 отключает)
+reconcile_job = (
+    PeriodicTask("reconcile", RECONCILE_SECONDS, run_reconcile, run_immediately=False)
+    if RECONCILE_SECONDS else None
+)
+
+async def run_client_pool_fill():
+    """Пополнение запаса клиентов пачками, пока панель не занята регистрациями"""
+    if not await holds_job_lease("client-pool", CLIENT_POOL_FILL_SECONDS):
+        return
+    while not panel_runner.pending and await panel_runner.run(fill_client_pool):
+        pass
+
+
+client_pool_job = (
+    PeriodicTask("client-pool", CLIENT_POOL_FILL_SECONDS, run_client_pool_fill, run_immediately=False)
+    if client_pool else None
+)
+
+# Проверка жизненного цикла клиентов (LIFECYCLE_SECONDS=0 отключает)
+lifecycle_job = (
+    PeriodicTask("lifecycle", LIFECYCLE_SECONDS, run_lifecycle, run_immediately=False)
+    if LIFECYCLE_SECONDS else None
+)
+
+# Локальный эндпоинт метрик Prometheus (METRICS_PORT=0 отключает)
+metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT) if METRICS_PORT else None
+
+
+async def check_panels_on_startup():
+    """Проверка подключения к панелям и прогрев инбаундов в фоне, пока бот уже отвечает"""
+    with startup_phase("проверка подключения к 3x-ui"):
+        if not await panel_runner.run(test_xui_connection):
+            logger.warning("⚠️ Не удалось подключиться к 3x-ui при запуске")
+    with startup_phase("прогрев инбаундов"):
+        await panel_runner.run(warm_up_inbound_cache)
+
+
+async def post_init(application: Application):
+    """Запуск фоновых задач после инициализации бота"""
+    if metrics_server:
+        await metrics_server.start()
+    if subscription_proxy:
+        await subscription_proxy.start()
+    panel_sync_job.start()
+    if reconcile_job:
+        reconcile_job.start()
+    notifier.start(application.bot)
+    if lifecycle_job:
+        lifecycle_job.start()
+    if client_pool_job:
+        client_pool_job.start()
+    application.create_task(check_panels_on_startup())
+    broadcaster.start(application.bot)
+    logger.info(f"⏱️ Запуск: бот готов принимать обновления через {(time.perf_counter() - STARTED_AT) * 1000:.0f} мс")
+
+
+async def post_shutdown(application: Application):
+    """Освобождение ресурсов после остановки бота"""
+    await client_batcher.flush_all()
+    await broadcaster.stop()
+    await panel_sync_job.stop()
+    if reconcile_job:
+        await reconcile_job.stop()
+    if lifecycle_job:
+        await lifecycle_job.stop()
+    if client_pool_job:
+        await client_pool_job.stop()
+    await notifier.stop()
+    await db_runner.run(user_store.close)
+    panel_runner.shutdown(wait=False)
+    db_runner.shutdown()
+    if metrics_server:
+        await metrics_server.stop()
+    if subscription_proxy:
+        await subscription_proxy.stop()
+
+
 def main():
     """Основная функция запуска бота"""
     logger.info("🚀 Запуск VPN Telegram бота с OAuth...")
     logger.info(f"🔗 3x-ui панель: {XUI_PANEL_URL}")
     logger.info(f"📊 Лимит данных: {DATA_LIMIT_GB} GB")
     logger.info(f"🎯 Inbound ID: {INBOUND_ID}")
+    logger.info(f"🗂️ Панелей: {len(panels)}, инбаундов для размещения: {len(placement.targets)}")
     logger.info(f"🔌 Порт по умолчанию: {DEFAULT_PORT}")
-    logger.info(f"💾 База данных: {DB_NAME}")
+    logger.info(f"💾 База данных: {DB_LABEL}, реплика: {REPLICA_ID}")
+    logger.info(f"⚙️ Потоки панели/БД: {PANEL_WORKERS}/{DB_WORKERS}, параллельных обновлений: {UPDATE_CONCURRENCY}")
+    logger.info(f"📡 Режим получения обновлений: {BOT_MODE}")
+    logger.info(
+        f"⏳ Жизненный цикл: каждые {LIFECYCLE_SECONDS} с, предупреждение при {LIFECYCLE_WARN_PERCENT}%, "
+        f"срок {LIFECYCLE_PERIOD_DAYS or 'без ограничения'} дн., автопродление: {'да' if LIFECYCLE_AUTO_RENEW else 'нет'}"
+    )
+    if client_pool:
+        logger.info(f"🧊 Запас клиентов: {CLIENT_POOL_SIZE}, пополнение по {CLIENT_POOL_BATCH} каждые {CLIENT_POOL_FILL_SECONDS} с")
+    if subscription_proxy:
+        logger.info(f"🔗 Прокси подписок: {SUBSCRIPTION_PROXY_URL} (кэш {SUBSCRIPTION_CACHE_TTL} с)")
+    logger.info(f"📨 Администраторов: {len(ADMIN_IDS)}, скорость рассылок: {BROADCAST_RATE} сообщ./с")
+    logger.info(f"🧮 Сверка базы с панелью: каждые {RECONCILE_SECONDS} с, исправление: {'да' if RECONCILE_REPAIR else 'нет'}")
 
     # Инициализация базы данных
-    init_db()
+    with startup_phase("база данных"):
+        init_db()
 
-    # Тестируем подключение при запуске
-    logger.info("🧪 Тестируем подключение к 3x-ui...")
-    if not test_xui_connection():
-        logger.warning("⚠️ Не удалось подключиться к 3x-ui при запуске")
+    # Подключение к 3x-ui проверяется в фоне после запуска (post_init)
 
     # Создание приложения
-    application = Application.builder().token(BOT_TOKEN).build()
+    with startup_phase("сборка приложения"):
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .request(build_request(TELEGRAM_POOL_SIZE, TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT,
+                                   TELEGRAM_WRITE_TIMEOUT, TELEGRAM_POOL_TIMEOUT))
+            # Долгий опрос getUpdates идет отдельным соединением и не занимает пул обработчиков
+            .get_updates_request(build_request(1, TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT,
+                                               TELEGRAM_WRITE_TIMEOUT, TELEGRAM_POOL_TIMEOUT))
+            .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, drain_timeout=SHUTDOWN_DRAIN_SECONDS))
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
 
-    # Добавление обработчиков
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("status", status_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("test", test_command))
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_error_handler(error_handler)
+        # Добавление обработчиков
+        application.add_handler(CommandHandler("start", start))
+        application.add_handler(CommandHandler("status", status_command))
+        application.add_handler(CommandHandler("help", help_command))
+        application.add_handler(CommandHandler("test", test_command))
+        admins = filters.User(user_id=ADMIN_IDS)
+        application.add_handler(CommandHandler("broadcast", broadcast_command, filters=admins))
+        application.add_handler(CommandHandler("broadcast_status", broadcast_status_command, filters=admins))
+        application.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command, filters=admins))
+        application.add_handler(CallbackQueryHandler(button_handler))
+        application.add_error_handler(error_handler)
 
     # Запуск бота
     logger.info("✅ Бот запущен и готов к работе с Telegram OAuth!")
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        webhook_path = WEBHOOK_PATH.strip('/')
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=webhook_path,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{webhook_path}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        application.run_polling()
+
+
+# ========== ЭКСПОРТ И ИМПОРТ ПОЛЬЗОВАТЕЛЕЙ ==========
+
+def make_import_client(record):
+    """Клиент панели для импортируемого пользователя; UUID и email сохраняются, если заданы"""
+    from py3xui import Client
+
+    return Client(
+        id=record['xui_client_id'] or str(uuid.uuid4()),
+        email=record['email'] or generate_client_email(record['telegram_id'], record['username']),
+        enable=True,
+        limitIp=0,
+        totalGB=DATA_LIMIT_GB * 1073741824,
+        expiryTime=0,
+        tgId=record['telegram_id']
+    )
+
+
+def export_command(args):
+    """Выгрузка пользователей в JSONL/CSV"""
+    init_db()
+    index = traffic = None
+    if args.with_panel:
+        sync_panel_state()
+        index, traffic = client_index, traffic_snapshot
+
+    fmt = detect_format(args.output, args.format)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    try:
+        count = export_users(user_store.iter_users(), output, fmt, index, traffic)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logger.info(f"📤 Выгружено пользователей: {count} ({fmt})")
+
+
+def import_command(args):
+    """Загрузка пользователей из JSONL/CSV с созданием недостающих клиентов в панели"""
+    init_db()
+    client_index.ensure_loaded(fetch_inbounds)
+
+    progress = ImportProgress(args.progress or f"{args.input}.progress")
+    if args.restart:
+        progress.clear()
+
+    importer = UserImporter(
+        user_store,
+        client_index,
+        placement,
+        add_clients=add_clients,
+        ensure_inbound=ensure_inbound_exists,
+        subscription_url=generate_subscription_url,
+        make_client=make_import_client,
+        batch_size=args.batch_size
+    )
+    stats = importer.run(read_users(args.input, detect_format(args.input, args.format)), progress)
+    logger.info(f"📥 Импорт завершен: {dict(stats)}")
+
+
+def cli(argv):
+    """Служебные команды: python bot.py export|import ..."""
+    parser = argparse.ArgumentParser(prog="bot.py", description="Экспорт и импорт пользователей VPN бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="выгрузка пользователей")
+    export_parser.add_argument("output", nargs="?", default="-", help="файл (по умолчанию stdout)")
+    export_parser.add_argument("--format", choices=FORMATS, help="формат (по умолчанию по расширению)")
+    export_parser.add_argument("--with-panel", action="store_true", help="добавить состояние клиентов в панели")
+    export_parser.set_defaults(handler=export_command)
+
+    import_parser = commands.add_parser("import", help="загрузка пользователей")
+    import_parser.add_argument("input", help="файл JSONL или CSV")
+    import_parser.add_argument("--format", choices=FORMATS, help="формат (по умолчанию по расширению)")
+    import_parser.add_argument("--batch-size", type=int, default=500, help="записей в пачке")
+    import_parser.add_argument("--progress", help="файл прогресса (по умолчанию <input>.progress)")
+    import_parser.add_argument("--restart", action="store_true", help="начать заново, игнорируя прогресс")
+    import_parser.set_defaults(handler=import_command)
+
+    args = parser.parse_args(argv)
+    try:
+        args.handler(args)
+    finally:
+        user_store.close()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        cli(sys.argv[1:])
+    else:
+        main()
\ No newline at end of file
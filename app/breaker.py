@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+STATE_TITLES = {CLOSED: "работает", HALF_OPEN: "пробный запрос", OPEN: "недоступна"}
+
+CIRCUIT_STATE = REGISTRY.gauge(
+    "vpnbot_circuit_state", "Состояние предохранителя: 0 - закрыт, 1 - пробный запрос, 2 - открыт", ("name",))
+
+
+class CircuitBreaker:
+    """Предохранитель для вызовов внешнего сервиса
+
+    После failure_threshold ошибок подряд размыкается: вызовы сразу
+    отклоняются, пока не истечет пауза. Затем пропускается один пробный
+    вызов; при успехе предохранитель замыкается, при ошибке пауза
+    удваивается (но не больше max_reset_timeout). clock - источник
+    времени в секундах, по умолчанию time.monotonic.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=5.0, max_reset_timeout=300.0,
+                 clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._backoff = reset_timeout
+        self._retry_at = 0.0
+        self._probe_in_flight = False
+        CIRCUIT_STATE.set(STATE_CODES[CLOSED], name=name)
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def available(self):
+        """Можно ли рассчитывать на вызов сейчас (без резервирования пробы)"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                return self._clock() >= self._retry_at
+            return not self._probe_in_flight
+
+    @property
+    def retry_in(self):
+        """Секунд до следующей пробы в разомкнутом состоянии"""
+        if self._state != OPEN:
+            return 0.0
+        return max(self._retry_at - self._clock(), 0.0)
+
+    def allow(self):
+        """Разрешение на вызов; в разомкнутом состоянии пропускает одну пробу"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if self._clock() < self._retry_at:
+                    return False
+                self._set_state(HALF_OPEN)
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._probe_in_flight = False
+            self._failures = 0
+            if self._state != CLOSED:
+                self._backoff = self.reset_timeout
+                self._set_state(CLOSED)
+                logger.info(f"✅ {self.name}: сервис снова доступен")
+
+    def record_failure(self):
+        with self._lock:
+            self._probe_in_flight = False
+            self._failures += 1
+            if self._state == HALF_OPEN:
+                self._backoff = min(self._backoff * 2, self.max_reset_timeout)
+            elif self._failures < self.failure_threshold:
+                return
+            if self._state == OPEN:
+                return
+            self._retry_at = self._clock() + self._backoff
+            self._set_state(OPEN)
+            logger.warning(f"🔌 {self.name}: предохранитель разомкнут на {self._backoff:.0f} с "
+                           f"после {self._failures} ошибок подряд")
+
+    def release(self):
+        """Снятие пробы без результата (вызов прерван до ответа сервиса)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def describe(self):
+        """Состояние для вывода пользователю"""
+        text = f"{STATE_TITLES[self._state]}, ошибок подряд: {self._failures}"
+        if self._state == OPEN:
+            text += f", повтор через {self.retry_in:.0f} с"
+        return text
+
+    def _set_state(self, state):
+        self._state = state
+        CIRCUIT_STATE.set(STATE_CODES[state], name=self.name)
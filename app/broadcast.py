@@ -0,0 +1,349 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+
+# Результаты отправки одному получателю
+SENT = "sent"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+RETRY_PAGE_SECONDS = 30
+
+BROADCAST_MESSAGES = REGISTRY.counter(
+    "vpnbot_broadcast_messages_total", "Сообщения рассылок по результату", ("result",))
+NOTIFICATIONS = REGISTRY.counter(
+    "vpnbot_notifications_total", "Личные уведомления пользователям по результату", ("result",))
+SEND_RETRIES = REGISTRY.counter(
+    "vpnbot_send_retries_total", "Повторные отправки сообщений рассылок и уведомлений", ("reason",))
+
+
+def _seconds(value):
+    """retry_after из RetryAfter: int или timedelta в зависимости от версии PTB"""
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+async def send_message(bot, scheduler, chat_id, text, max_attempts=5):
+    """Отправка сообщения через планировщик с повторами; возвращает SENT, FAILED или BLOCKED"""
+    for attempt in range(1, max_attempts + 1):
+        await scheduler.acquire(chat_id)
+        try:
+            await bot.send_message(chat_id, text)
+            return SENT
+        except RetryAfter as e:
+            # Ограничение действует на весь бот: приостанавливаем все отправки
+            wait = _seconds(e.retry_after)
+            SEND_RETRIES.inc(reason="retry_after")
+            logger.warning(f"🚦 Flood control Telegram: пауза отправок на {wait:.0f} с")
+            scheduler.pause(wait)
+        except Forbidden:
+            return BLOCKED
+        except BadRequest as e:
+            logger.debug(f"⚠️ Сообщение для {chat_id} не отправлено: {e}")
+            return FAILED
+        except NetworkError as e:
+            SEND_RETRIES.inc(reason="network")
+            logger.debug(f"⚠️ Сетевая ошибка при отправке {chat_id} (попытка {attempt}): {e}")
+            await asyncio.sleep(min(2 ** attempt, 30))
+        except TelegramError as e:
+            logger.debug(f"⚠️ Сообщение для {chat_id} не отправлено: {e}")
+            return FAILED
+    return FAILED
+
+
+class SendScheduler:
+    """Планировщик отправок с глобальным лимитом и минимальным интервалом для одного чата
+
+    Отправки получают слоты по очереди, не чаще rate в секунду для всего
+    бота и не чаще раза в per_chat_interval секунд для одного чата. pause()
+    сдвигает все следующие слоты, когда Telegram отвечает RetryAfter.
+    """
+
+    def __init__(self, rate, per_chat_interval=1.0, max_chats=10000):
+        self.interval = 1 / rate
+        self.per_chat_interval = per_chat_interval
+        self.max_chats = max_chats
+        self._next = 0.0
+        self._chats = {}
+
+    async def acquire(self, chat_id):
+        """Ожидание слота для отправки в чат"""
+        now = time.monotonic()
+        slot = max(now, self._next, self._chats.get(chat_id, 0.0))
+        self._next = slot + self.interval
+        self._chats[chat_id] = slot + self.per_chat_interval
+        if len(self._chats) > self.max_chats:
+            self._chats = {chat: ready for chat, ready in self._chats.items() if ready > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds):
+        """Остановка всех отправок на seconds секунд (flood control Telegram)"""
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+@dataclass
+class BroadcastProgress:
+    """Состояние рассылки в памяти; в базу сохраняется после каждой страницы"""
+    id: int
+    text: str
+    total: int
+    last_user_id: int
+    sent: int
+    failed: int
+    blocked: int
+    started: float
+    status: str = RUNNING
+
+    @property
+    def processed(self):
+        return self.sent + self.failed + self.blocked
+
+    def describe(self, processed_at_start=0):
+        """Строка прогресса со скоростью и оценкой оставшегося времени"""
+        text = (f"📨 Рассылка #{self.id} ({self.status}): {self.processed}/{self.total}, "
+                f"доставлено {self.sent}, заблокировали бота {self.blocked}, ошибок {self.failed}")
+        elapsed = time.monotonic() - self.started
+        done_now = self.processed - processed_at_start
+        if self.status == RUNNING and elapsed > 0 and done_now > 0:
+            rate = done_now / elapsed
+            remaining = max(self.total - self.processed, 0) / rate
+            text += f", {rate:.1f} сообщ./с, осталось ~{remaining / 60:.0f} мин"
+        return text
+
+
+class Broadcaster:
+    """Рассылка сообщения всем пользователям из таблицы users
+
+    Получатели читаются страницами по page_size строк по возрастанию
+    users.id, отправки идут через SendScheduler не более чем concurrency
+    одновременно. После каждой страницы курсор и счетчики сохраняются в
+    таблицу broadcasts, поэтому после перезапуска рассылка продолжается с
+    первой незавершенной страницы (ее получатели могут получить сообщение
+    повторно). Одновременно выполняется одна рассылка.
+
+    С owner (ID реплики) перед каждой страницей продлевается аренда
+    рассылки в базе: при нескольких репликах рассылку ведет одна из них,
+    а отмена с любой реплики останавливает ее после текущей страницы.
+    """
+
+    def __init__(self, store, db_runner, scheduler, page_size=200, concurrency=10, max_attempts=5,
+                 owner=None, lease_ttl=300):
+        self.store = store
+        self.db_runner = db_runner
+        self.scheduler = scheduler
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.owner = owner
+        self.lease_ttl = lease_ttl
+        self.current = None
+        self._processed_at_start = 0
+        self._task = None
+        self._watcher = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def launch(self, bot, text, created_by):
+        """Создание и запуск новой рассылки; возвращает ее прогресс"""
+        if self.running:
+            raise RuntimeError(f"Рассылка #{self.current.id} еще выполняется")
+        running = await self.db_runner.run(self.store.running_broadcasts)
+        if running:
+            raise RuntimeError(f"Рассылка #{running[-1].id} еще выполняется")
+        row = await self.db_runner.run(self.store.create_broadcast, text, created_by)
+        logger.info(f"📨 Рассылка #{row.id} создана администратором {created_by}: {row.total} получателей")
+        self._start(bot, row)
+        return self.current
+
+    def start(self, bot):
+        """Подхват незавершенной рассылки сейчас и затем каждые lease_ttl секунд
+
+        Повторные проверки нужны, чтобы рассылку продолжила другая реплика,
+        если ведущая ее реплика упала и аренда истекла.
+        """
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch(bot), name="broadcast-resume")
+
+    async def _watch(self, bot):
+        while True:
+            try:
+                await self.resume(bot)
+            except Exception as e:
+                logger.error(f"❌ Ошибка проверки незавершенных рассылок: {e}")
+            await asyncio.sleep(self.lease_ttl)
+
+    async def resume(self, bot):
+        """Продолжение незавершенной рассылки после перезапуска или падения ведущей ее реплики"""
+        rows = await self.db_runner.run(self.store.running_broadcasts)
+        if rows and not self.running:
+            row = rows[-1]
+            logger.info(f"⏩ Продолжаем рассылку #{row.id} после пользователя {row.last_user_id}")
+            self._start(bot, row)
+
+    def _start(self, bot, row):
+        self.current = BroadcastProgress(row.id, row.text, row.total, row.last_user_id,
+                                         row.sent, row.failed, row.blocked, time.monotonic())
+        self._processed_at_start = self.current.processed
+        self._task = asyncio.create_task(self._run(bot, self.current), name=f"broadcast-{row.id}")
+
+    async def progress(self, broadcast_id=None):
+        """Описание прогресса текущей или сохраненной рассылки"""
+        if self.current and broadcast_id in (None, self.current.id):
+            return self.current.describe(self._processed_at_start)
+        row = await self.db_runner.run(self.store.get_broadcast, broadcast_id)
+        if row is None:
+            return None
+        return BroadcastProgress(row.id, row.text, row.total, row.last_user_id, row.sent, row.failed,
+                                 row.blocked, time.monotonic(), row.status).describe()
+
+    async def cancel(self):
+        """Отмена текущей рассылки; возвращает False, если рассылки нет"""
+        if not self.running:
+            # Рассылку может вести другая реплика: она остановится, увидев новое состояние
+            rows = await self.db_runner.run(self.store.running_broadcasts)
+            for row in rows:
+                await self.db_runner.run(self.store.save_broadcast_progress, row.id, row.last_user_id,
+                                         row.sent, row.failed, row.blocked, CANCELLED)
+                logger.info(f"🛑 Рассылка #{row.id} отменена")
+            return bool(rows)
+        self.current.status = CANCELLED
+        await self._stop_task()
+        await self._save(self.current, CANCELLED)
+        await self._release(self.current)
+        logger.info(f"🛑 Рассылка #{self.current.id} отменена: {self.current.describe()}")
+        return True
+
+    async def stop(self):
+        """Остановка при завершении бота; рассылка продолжится с последней сохраненной страницы"""
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+        if self.running:
+            await self._stop_task()
+
+    async def _stop_task(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _hold(self, progress):
+        """Продление аренды рассылки; False, если ее ведет другая реплика или она отменена"""
+        if self.owner is None:
+            return True
+        acquired = await self.db_runner.run(self.store.acquire_lease, f"broadcast:{progress.id}",
+                                            self.owner, self.lease_ttl)
+        if not acquired:
+            logger.debug(f"📨 Рассылка #{progress.id} выполняется другой репликой")
+            return False
+        row = await self.db_runner.run(self.store.get_broadcast, progress.id)
+        if row.status != RUNNING:
+            logger.info(f"🛑 Рассылка #{progress.id} остановлена: {row.status}")
+            return False
+        return True
+
+    async def _release(self, progress):
+        if self.owner is not None:
+            await self.db_runner.run(self.store.release_lease, f"broadcast:{progress.id}", self.owner)
+
+    async def _save(self, progress, status=None):
+        await self.db_runner.run(self.store.save_broadcast_progress, progress.id, progress.last_user_id,
+                                 progress.sent, progress.failed, progress.blocked, status)
+
+    async def _run(self, bot, progress):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(chat_id):
+            async with semaphore:
+                result = await send_message(bot, self.scheduler, chat_id, progress.text, self.max_attempts)
+            BROADCAST_MESSAGES.inc(result=result)
+            setattr(progress, result, getattr(progress, result) + 1)
+
+        while True:
+            checkpoint = (progress.sent, progress.failed, progress.blocked)
+            try:
+                if not await self._hold(progress):
+                    # Прогресс этой рассылки дальше читается из базы
+                    self.current = None
+                    await self._release(progress)
+                    return
+                page = await self.db_runner.run(self.store.recipients_after, progress.last_user_id, self.page_size)
+                if not page:
+                    break
+                await asyncio.gather(*(deliver(chat_id) for _, chat_id in page))
+                progress.last_user_id = page[-1][0]
+                await self._save(progress)
+            except Exception as e:
+                # Страница будет отправлена заново с последнего сохраненного курсора
+                logger.error(f"❌ Ошибка рассылки #{progress.id}, повтор через {RETRY_PAGE_SECONDS} с: {e}")
+                progress.sent, progress.failed, progress.blocked = checkpoint
+                await asyncio.sleep(RETRY_PAGE_SECONDS)
+
+        progress.status = DONE
+        await self._save(progress, DONE)
+        await self._release(progress)
+        logger.info(f"✅ {progress.describe()}")
+
+
+class Notifier:
+    """Очередь личных уведомлений, отправляемых через общий с рассылками SendScheduler
+
+    submit() можно вызывать из event loop без ожидания; при заполненной
+    очереди уведомление отбрасывается.
+    """
+
+    def __init__(self, scheduler, max_queue=10000, concurrency=4, max_attempts=5):
+        self.scheduler = scheduler
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self._queue = asyncio.Queue(max_queue)
+        self._workers = []
+
+    def start(self, bot):
+        """Запуск обработчиков очереди в текущем event loop"""
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._work(bot), name=f"notifier-{number}")
+                             for number in range(self.concurrency)]
+
+    def submit(self, chat_id, text):
+        """Постановка уведомления в очередь; False, если очередь заполнена"""
+        try:
+            self._queue.put_nowait((chat_id, text))
+            return True
+        except asyncio.QueueFull:
+            NOTIFICATIONS.inc(result="dropped")
+            logger.warning(f"⚠️ Очередь уведомлений заполнена, уведомление для {chat_id} отброшено")
+            return False
+
+    async def stop(self):
+        """Остановка обработчиков; неотправленные уведомления теряются"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self, bot):
+        while True:
+            chat_id, text = await self._queue.get()
+            try:
+                NOTIFICATIONS.inc(result=await send_message(bot, self.scheduler, chat_id, text, self.max_attempts))
+            except Exception as e:
+                logger.error(f"❌ Ошибка отправки уведомления {chat_id}: {e}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Ограниченный LRU-кэш с TTL и кэшированием отрицательных результатов
+
+    Отсутствие записи хранится как None с отдельным (обычно более коротким)
+    TTL. Версия кэша меняется при каждой записи через put/invalidate, что
+    позволяет не сохранять значение, прочитанное до параллельной записи.
+    """
+
+    def __init__(self, max_size, ttl, negative_ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Возвращает (найдено, значение); значение None - закэшированное отсутствие"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if time.monotonic() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def _store(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def fill(self, key, value, version):
+        """Сохранение значения, прочитанного из источника при указанной версии"""
+        with self._lock:
+            if version == self.version:
+                self._store(key, value)
+
+    def put(self, key, value):
+        """Запись через кэш после изменения источника"""
+        with self._lock:
+            self.version += 1
+            self._store(key, value)
+
+    def invalidate(self, key):
+        """Удаление записи после изменения источника"""
+        with self._lock:
+            self.version += 1
+            self._entries.pop(key, None)
+
+    def stats(self):
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
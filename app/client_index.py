@@ -0,0 +1,160 @@
+import logging
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# Форматы email из generate_client_email
+EMAIL_PATTERNS = (
+    re.compile(r"^[^@]*@telegram\.(\d+)\.vpn$"),
+    re.compile(r"^user(\d+)@telegram\.vpn$"),
+)
+
+
+def telegram_id_from_email(email):
+    """Извлечение Telegram ID из email, сгенерированного ботом"""
+    if not email:
+        return None
+    for pattern in EMAIL_PATTERNS:
+        match = pattern.match(email.lower())
+        if match:
+            return int(match.group(1))
+    return None
+
+
+@dataclass(frozen=True, slots=True)
+class ClientRecord:
+    """Клиент панели в индексе"""
+    client_id: str
+    email: str
+    inbound_id: int
+    telegram_id: int | None = None
+    panel: str | None = None
+
+
+def record_from_client(client, inbound_id, panel):
+    """Запись индекса для клиента py3xui; Telegram ID берется из email или tgId"""
+    telegram_id = telegram_id_from_email(client.email)
+    if telegram_id is None and client.tg_id and str(client.tg_id).isdigit():
+        telegram_id = int(client.tg_id)
+    return ClientRecord(str(client.id), client.email, inbound_id, telegram_id, panel)
+
+
+class ClientIndex:
+    """Индекс клиентов панели по Telegram ID, email и UUID
+
+    Строится одной выгрузкой всех инбаундов каждой панели, дополняется при
+    создании клиентов ботом и периодически перестраивается в фоне. Поиск O(1).
+    Также хранит число клиентов в каждом инбаунде для размещения новых.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._by_telegram_id = {}
+        self._by_email = {}
+        self._by_client_id = {}
+        self._counts = Counter()
+        # Клиенты, добавленные во время перестроения индекса
+        self._journal = None
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._by_client_id)
+
+    @staticmethod
+    def _put(record, by_telegram_id, by_email, by_client_id, counts):
+        previous = by_client_id.get(record.client_id)
+        if previous is None:
+            counts[(record.panel, record.inbound_id)] += 1
+        elif by_email.get(previous.email.lower()) is previous:
+            # Клиент переименован (например, привязан из запаса): старый email больше не его
+            del by_email[previous.email.lower()]
+        by_client_id[record.client_id] = record
+        by_email[record.email.lower()] = record
+        if record.telegram_id is not None:
+            by_telegram_id.setdefault(record.telegram_id, record)
+
+    def refresh(self, fetch_inbounds):
+        """Полное перестроение индекса; fetch_inbounds() возвращает {панель: инбаунды}"""
+        with self._refresh_lock:
+            self._rebuild(fetch_inbounds)
+
+    def ensure_loaded(self, fetch_inbounds):
+        """Первичная загрузка индекса; параллельные вызовы ждут одну загрузку"""
+        if self.loaded:
+            return
+        with self._refresh_lock:
+            if not self.loaded:
+                self._rebuild(fetch_inbounds)
+
+    def _rebuild(self, fetch_inbounds):
+        with self._lock:
+            self._journal = []
+        try:
+            inbounds_by_panel = fetch_inbounds()
+        except Exception:
+            with self._lock:
+                self._journal = None
+            raise
+
+        by_telegram_id, by_email, by_client_id, counts = {}, {}, {}, Counter()
+        for panel, inbounds in inbounds_by_panel.items():
+            for inbound in inbounds:
+                counts[(panel, inbound.id)] += 0
+                for client in inbound.settings.clients or []:
+                    if client.id is None or not client.email:
+                        continue
+                    record = record_from_client(client, inbound.id, panel)
+                    self._put(record, by_telegram_id, by_email, by_client_id, counts)
+
+        with self._lock:
+            for record in self._journal:
+                self._put(record, by_telegram_id, by_email, by_client_id, counts)
+            self._journal = None
+            self._by_telegram_id = by_telegram_id
+            self._by_email = by_email
+            self._by_client_id = by_client_id
+            self._counts = counts
+            self.loaded = True
+
+        logger.info(f"📇 Индекс клиентов обновлен: {len(by_client_id)} клиентов в {len(counts)} инбаундах")
+
+    def add(self, record):
+        """Добавление клиента, созданного ботом"""
+        with self._lock:
+            self._put(record, self._by_telegram_id, self._by_email, self._by_client_id, self._counts)
+            if self._journal is not None:
+                self._journal.append(record)
+
+    def remove(self, client_id):
+        """Удаление клиента, исключенного ботом"""
+        with self._lock:
+            record = self._by_client_id.pop(str(client_id), None)
+            if record is None:
+                return
+            self._counts[(record.panel, record.inbound_id)] -= 1
+            if self._by_email.get(record.email.lower()) is record:
+                del self._by_email[record.email.lower()]
+            if record.telegram_id is not None and self._by_telegram_id.get(record.telegram_id) is record:
+                del self._by_telegram_id[record.telegram_id]
+            if self._journal is not None:
+                self._journal = [added for added in self._journal if added.client_id != record.client_id]
+
+    def by_telegram_id(self, telegram_id):
+        """Поиск клиента по Telegram ID"""
+        return self._by_telegram_id.get(telegram_id)
+
+    def by_email(self, email):
+        """Поиск клиента по email"""
+        return self._by_email.get(email.lower())
+
+    def by_client_id(self, client_id):
+        """Поиск клиента по UUID"""
+        return self._by_client_id.get(str(client_id))
+
+    def count(self, panel, inbound_id):
+        """Число клиентов в инбаунде панели"""
+        return self._counts.get((panel, inbound_id), 0)
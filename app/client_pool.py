@@ -0,0 +1,97 @@
+import logging
+import uuid
+
+from metrics import REGISTRY
+from storage import SpareClient
+
+logger = logging.getLogger(__name__)
+
+# Email клиентов запаса: не совпадает с форматами бота, поэтому сверка и жизненный цикл их пропускают
+SPARE_EMAIL_DOMAIN = "pool.vpn"
+
+CLIENT_POOL_TAKES = REGISTRY.counter(
+    "vpnbot_client_pool_takes_total", "Регистрации из запаса клиентов по результату", ("result",))
+SPARE_CLIENTS = REGISTRY.gauge("vpnbot_client_pool_size", "Клиентов в запасе при последней проверке")
+
+
+def spare_email():
+    return f"spare-{uuid.uuid4().hex[:16]}@{SPARE_EMAIL_DOMAIN}"
+
+
+class ClientPool:
+    """Запас заранее созданных отключенных клиентов панели
+
+    Регистрация из запаса не ждет выбора инбаунда и окна пачки client.add:
+    take() извлекает клиента из базы (атомарно, в том числе между
+    репликами), после чего вызывающий код переименовывает и включает его
+    одним client.update. fill() пополняет запас до size пачками по
+    batch_size: create(target, spares) добавляет клиентов в панель одним
+    вызовом, после чего они записываются в базу; если запись не удалась,
+    лишних клиентов удалит из панели сверка (Reconciler, STRAY). Клиент,
+    привязать которого не удалось, возвращается в запас через put_back(),
+    только если панель не вызывалась (очередь заполнена, панель
+    недоступна, инбаунд занят другой репликой): иначе он мог быть изменен
+    в панели частично и исключается из запаса.
+
+    Привязки одного инбаунда выполняются по очереди под той же блокировкой
+    записи, что и client.add, поэтому одновременно привязывается не больше
+    max_binds клиентов, а пока идет запись пачки (contended), запас не
+    используется: при всплеске регистраций client.add пишет их пачкой, а
+    поток привязок не задерживает ее. acquire_bind() и release_bind()
+    вызываются из event loop.
+    """
+
+    def __init__(self, store, size, batch_size, create, max_binds=2):
+        self.store = store
+        self.size = size
+        self.batch_size = batch_size
+        self.max_binds = max_binds
+        self.binds = 0
+        self._create = create
+
+    def missing(self):
+        """Сколько клиентов не хватает до size"""
+        count = self.store.spare_client_count()
+        SPARE_CLIENTS.set(count)
+        return max(self.size - count, 0)
+
+    def fill(self, target):
+        """Добавление одной пачки в инбаунд target = (панель, ID инбаунда); возвращает число клиентов"""
+        missing = self.missing()
+        if not missing:
+            return 0
+        panel, inbound_id = target
+        spares = [SpareClient(str(uuid.uuid4()), spare_email(), panel, inbound_id)
+                  for _ in range(min(missing, self.batch_size))]
+        self._create(target, spares)
+        self.store.add_spare_clients(spares)
+        SPARE_CLIENTS.inc(len(spares))
+        logger.info(f"🧊 Запас клиентов пополнен на {len(spares)} в инбаунде {panel}/{inbound_id}")
+        return len(spares)
+
+    def acquire_bind(self, contended=False):
+        """Место для привязки клиента; False, если идет запись пачки или уже привязывается max_binds клиентов"""
+        if contended or self.binds >= self.max_binds:
+            CLIENT_POOL_TAKES.inc(result="busy")
+            return False
+        self.binds += 1
+        return True
+
+    def release_bind(self):
+        self.binds -= 1
+
+    def take(self, panels):
+        """Извлечение клиента из запаса панелей panels; None, если запас пуст"""
+        spare = self.store.take_spare_client(panels)
+        if spare is None:
+            CLIENT_POOL_TAKES.inc(result="empty")
+            return None
+        SPARE_CLIENTS.dec()
+        CLIENT_POOL_TAKES.inc(result="taken")
+        return spare
+
+    def put_back(self, spare):
+        """Возврат извлеченного клиента, который не изменялся в панели"""
+        self.store.add_spare_clients([spare])
+        SPARE_CLIENTS.inc()
+        CLIENT_POOL_TAKES.inc(result="returned")
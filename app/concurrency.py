@@ -0,0 +1,115 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Очередь пула потоков заполнена, задача не принята"""
+
+
+class BlockingRunner:
+    """Ограниченный пул потоков для блокирующих вызовов из асинхронного кода
+
+    У панели и базы данных отдельные пулы, поэтому медленная панель не
+    занимает потоки, нужные для чтения из базы. max_pending ограничивает
+    число выполняемых и ожидающих задач: сверх него run() выбрасывает
+    QueueFull вместо бесконечного роста очереди.
+    """
+
+    def __init__(self, name, max_workers, max_pending=None):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    @property
+    def saturated(self):
+        """Очередь заполнена: новые задачи будут отклонены"""
+        return self.max_pending is not None and self.pending >= self.max_pending
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнение блокирующей функции в пуле без блокировки event loop"""
+        if self.saturated:
+            raise QueueFull(f"Очередь пула {self.name} заполнена ({self.pending} задач)")
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    def shutdown(self, wait=True):
+        """Остановка пула потоков"""
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+        logger.info(f"🛑 Пул потоков {self.name} остановлен")
+
+
+class PeriodicTask:
+    """Фоновая асинхронная задача, выполняемая с заданным интервалом"""
+
+    def __init__(self, name, interval, func, run_immediately=True):
+        self.name = name
+        self.interval = interval
+        self._func = func
+        self._run_immediately = run_immediately
+        self._task = None
+
+    def start(self):
+        """Запуск задачи в текущем event loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(), name=self.name)
+
+    async def stop(self):
+        """Остановка задачи"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _loop(self):
+        if not self._run_immediately:
+            await asyncio.sleep(self.interval)
+        while True:
+            try:
+                await self._func()
+            except Exception as e:
+                logger.error(f"❌ Ошибка фоновой задачи {self.name}: {e}")
+            await asyncio.sleep(self.interval)
+
+
+class SingleFlight:
+    """Объединение параллельных асинхронных операций с одинаковым ключом
+
+    Пока операция по ключу выполняется, повторные вызовы ждут ее и
+    получают тот же результат вместо запуска новой.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def __contains__(self, key):
+        return key in self._inflight
+
+    async def run(self, key, func, *args, **kwargs):
+        """Выполнение func(*args) или ожидание уже запущенного вызова по ключу"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            logger.info(f"⏳ Операция {key} уже выполняется, ожидаем ее результат")
+        # shield: отмена одного ожидающего не прерывает операцию для остальных
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from http import HTTPStatus
+
+logger = logging.getLogger(__name__)
+
+MAX_HEADER_LINES = 100
+
+
+class HTTPResponse:
+    """Ответ локального HTTP сервера"""
+
+    def __init__(self, status=200, body=b"", headers=None):
+        self.status = status
+        self.body = body if isinstance(body, bytes) else body.encode()
+        self.headers = headers or {}
+
+
+class LocalHTTPServer:
+    """Минимальный асинхронный HTTP/1.1 сервер для служебных эндпоинтов
+
+    handler(method, path, headers) -> HTTPResponse вызывается в event loop бота.
+    Поддерживаются только запросы без тела (GET/HEAD) и keep-alive.
+    Сервер может быть доступен извне (прокси подписок), поэтому заголовки
+    должны прийти за header_timeout секунд, соединение без запросов
+    закрывается через idle_timeout, строки длиннее max_line и заголовки
+    больше max_header_bytes отклоняются, а сверх max_connections
+    соединений отвечает 503.
+    """
+
+    def __init__(self, name, host, port, handler, header_timeout=10, idle_timeout=30, max_connections=1000,
+                 max_line=8192, max_header_bytes=32768):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.header_timeout = header_timeout
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.max_line = max_line
+        self.max_header_bytes = max_header_bytes
+        self._handler = handler
+        self._server = None
+        self._connections = 0
+
+    async def start(self):
+        """Запуск прослушивания порта"""
+        self._server = await asyncio.start_server(self._serve, self.host, self.port, limit=self.max_line)
+        logger.info(f"🌐 {self.name}: http://{self.host}:{self.port}")
+
+    async def stop(self):
+        """Остановка сервера"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        if self._connections >= self.max_connections:
+            try:
+                await self._send(writer, HTTPResponse(503, b"Service Unavailable"), keep_alive=False)
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+            writer.close()
+            return
+
+        self._connections += 1
+        try:
+            while True:
+                # Ожидание следующего запроса на keep-alive соединении
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except ValueError:
+                    await self._send(writer, HTTPResponse(400, b"Bad Request"), keep_alive=False)
+                    break
+                if not request_line:
+                    break
+                try:
+                    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                except ValueError:
+                    await self._send(writer, HTTPResponse(400, b"Bad Request"), keep_alive=False)
+                    break
+
+                try:
+                    headers = await asyncio.wait_for(self._read_headers(reader), self.header_timeout)
+                except ValueError:
+                    await self._send(writer, HTTPResponse(431, b"Request Header Fields Too Large"), keep_alive=False)
+                    break
+
+                if method not in ('GET', 'HEAD'):
+                    response = HTTPResponse(405, b"Method Not Allowed")
+                else:
+                    try:
+                        response = await self._handler(method, path, headers)
+                    except Exception as e:
+                        logger.error(f"❌ Ошибка обработки запроса {path}: {e}")
+                        response = HTTPResponse(500, b"Internal Server Error")
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._send(writer, response, keep_alive, head_only=method == 'HEAD')
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            self._connections -= 1
+            writer.close()
+
+    async def _read_headers(self, reader):
+        """Чтение заголовков; ValueError, если они длиннее допустимого"""
+        headers = {}
+        size = 0
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            size += len(line)
+            if size > self.max_header_bytes:
+                raise ValueError("заголовки слишком длинные")
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        raise ValueError("слишком много заголовков")
+
+    async def _send(self, writer, response, keep_alive, head_only=False):
+        # Клиент, не читающий ответ, не должен держать соединение бесконечно
+        await asyncio.wait_for(self._write(writer, response, keep_alive, head_only), self.idle_timeout)
+
+    @staticmethod
+    async def _write(writer, response, keep_alive, head_only=False):
+        reason = HTTPStatus(response.status).phrase
+        headers = {
+            'Content-Length': str(len(response.body)),
+            'Connection': 'keep-alive' if keep_alive else 'close',
+            **response.headers
+        }
+        head = f"HTTP/1.1 {response.status} {reason}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(head.encode('latin-1') + b"\r\n")
+        if not head_only:
+            writer.write(response.body)
+        await writer.drain()
@@ -0,0 +1,250 @@
+import logging
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+
+from client_index import record_from_client
+
+logger = logging.getLogger(__name__)
+
+DAY_MS = 86400 * 1000
+
+# Фазы жизненного цикла клиента; ACTIVE в базе не хранится
+ACTIVE = "active"
+WARNED = "warned"        # израсходовано не меньше warn_percent трафика
+EXPIRING = "expiring"    # до окончания срока не больше expiry_warn_days
+DEPLETED = "depleted"    # трафик израсходован
+EXPIRED = "expired"      # срок действия истек
+RENEWED = "renewed"      # срок продлен, трафик сброшен (только уведомление)
+
+# Фазы, в которых клиент отключается
+DISABLED_PHASES = (DEPLETED, EXPIRED)
+
+
+@dataclass(frozen=True, slots=True)
+class LifecyclePolicy:
+    """Пороги и правила жизненного цикла клиентов
+
+    period_days=0 - клиенты бессрочные (как при создании ботом). Иначе
+    клиентам без срока назначается срок period_days, а по его окончании
+    клиент отключается или, с auto_renew, продлевается на период со
+    сбросом трафика.
+    """
+    warn_percent: int = 80
+    period_days: int = 0
+    expiry_warn_days: int = 3
+    auto_renew: bool = False
+
+    def classify(self, used, total, expiry_time, now_ms):
+        """Фаза клиента по израсходованному трафику и сроку действия"""
+        # Отрицательный срок в 3x-ui отсчитывается от первого подключения
+        expires = expiry_time > 0
+        if expires and expiry_time <= now_ms:
+            return EXPIRED
+        if total and used >= total:
+            return DEPLETED
+        if expires and expiry_time - now_ms <= self.expiry_warn_days * DAY_MS:
+            return EXPIRING
+        if total and used * 100 >= total * self.warn_percent:
+            return WARNED
+        return ACTIVE
+
+
+@dataclass(frozen=True, slots=True)
+class ClientChange:
+    """Изменение клиента в панели; None - поле не меняется"""
+    email: str
+    enable: bool | None = None
+    expiry_time: int | None = None
+    reset_traffic: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class Notification:
+    """Уведомление пользователю о смене фазы клиента"""
+    telegram_id: int
+    kind: str
+    used: int
+    total: int
+    expiry_time: int
+
+
+@dataclass(frozen=True, slots=True)
+class SweepReport:
+    """Итог прохода"""
+    checked: int
+    changed: int
+    updated_inbounds: int
+    failed_inbounds: int
+    notifications: tuple
+
+
+def apply_client_changes(session, inbound_id, changes):
+    """Применение изменений клиентов инбаунда одним inbound.update
+
+    Инбаунд перечитывается непосредственно перед записью, так как
+    inbound.update заменяет весь список клиентов. Сброс трафика в API
+    3x-ui есть только для одного клиента, поэтому выполняется отдельными
+    вызовами и только для продлеваемых клиентов. Вызывающий код должен
+    держать блокировку записи инбаунда (Panel.write_lock), которая при
+    нескольких репликах включает аренду инбаунда в общей базе.
+    """
+    # Сначала сброс трафика: если запись инбаунда не удастся, продление повторится целиком
+    for change in changes:
+        if change.reset_traffic:
+            session.call("client.reset_stats", inbound_id, change.email)
+
+    by_email = {change.email: change for change in changes}
+    inbound = session.call("inbound.get_by_id", inbound_id)
+    for client in inbound.settings.clients or []:
+        change = by_email.get((client.email or "").lower())
+        if change is None:
+            continue
+        if change.enable is not None:
+            client.enable = change.enable
+        if change.expiry_time is not None:
+            client.expiry_time = change.expiry_time
+    session.call("inbound.update", inbound_id, inbound)
+
+
+class LifecycleSweeper:
+    """Периодическая проверка трафика и сроков клиентов бота
+
+    Работает по общей выгрузке инбаундов (один запрос на панель). Для
+    каждого клиента бота вычисляется фаза (LifecyclePolicy.classify) и
+    сравнивается с сохраненной; клиенты, чья фаза не изменилась, дальше не
+    обрабатываются. Изменения клиентов одного инбаунда применяются одним
+    вызовом apply(панель, инбаунд, изменения); после успешной записи новые
+    фазы сохраняются в базу одной транзакцией и возвращаются уведомления.
+    Если запись в инбаунд не удалась, его клиенты обрабатываются повторно
+    на следующем проходе.
+    """
+
+    def __init__(self, store, policy, apply):
+        self.store = store
+        self.policy = policy
+        self._apply = apply
+        self._phases = None
+        self.last_report = None
+
+    def forget(self):
+        """Сброс запомненных фаз: следующий проход перечитает их из базы"""
+        self._phases = None
+
+    def run(self, inbounds_by_panel, now_ms=None):
+        """Проход по выгрузке инбаундов {панель: инбаунды}"""
+        now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+        if self._phases is None:
+            self._phases = self.store.lifecycle_phases()
+
+        checked = 0
+        # (панель, инбаунд) -> [(email, новая фаза, изменение или None, уведомление или None)]
+        pending = defaultdict(list)
+        for panel, inbounds in inbounds_by_panel.items():
+            for inbound in inbounds:
+                for item in self._inbound_changes(panel, inbound, now_ms):
+                    pending[(panel, inbound.id)].append(item)
+                checked += len(inbound.settings.clients or [])
+
+        updated = failed = changed = 0
+        saved = {}
+        notifications = []
+        for (panel, inbound_id), items in pending.items():
+            changes = [change for _, _, change, _ in items if change is not None]
+            if changes:
+                try:
+                    self._apply(panel, inbound_id, changes)
+                    updated += 1
+                except Exception as e:
+                    logger.error(f"❌ Не удалось обновить клиентов инбаунда {panel}/{inbound_id}: {e}")
+                    failed += 1
+                    continue
+            for email, phase, _, notification in items:
+                saved[email] = None if phase == ACTIVE else phase
+                if notification is not None:
+                    notifications.append(notification)
+            changed += len(items)
+
+        if saved:
+            self.store.save_lifecycle_phases(saved)
+            for email, phase in saved.items():
+                if phase is None:
+                    self._phases.pop(email, None)
+                else:
+                    self._phases[email] = phase
+
+        self.last_report = SweepReport(checked, changed, updated, failed, tuple(notifications))
+        self._log(self.last_report)
+        return self.last_report
+
+    def _inbound_changes(self, panel, inbound, now_ms):
+        stats = {(item.email or "").lower(): item for item in inbound.client_stats or []}
+        for client in inbound.settings.clients or []:
+            if not client.email:
+                continue
+            record = record_from_client(client, inbound.id, panel)
+            if record.telegram_id is None:
+                # Клиенты, созданные вручную, не обслуживаются
+                continue
+            email = client.email.lower()
+            usage = stats.get(email)
+            used = usage.up + usage.down if usage else 0
+            total = client.total_gb or (usage.total if usage else 0)
+            item = self._client_change(email, record.telegram_id, client, used, total, now_ms)
+            if item is not None:
+                yield item
+
+    def _client_change(self, email, telegram_id, client, used, total, now_ms):
+        """Новая фаза, изменение и уведомление для клиента или None, если ничего не изменилось"""
+        policy = self.policy
+        previous = self._phases.get(email, ACTIVE)
+        expiry_time = client.expiry_time
+        enable = None
+        renewed = False
+
+        if policy.period_days and expiry_time == 0:
+            # Назначение срока клиенту, созданному без него
+            expiry_time = now_ms + policy.period_days * DAY_MS
+        elif (policy.auto_renew and policy.period_days
+              and policy.classify(used, total, expiry_time, now_ms) == EXPIRED):
+            period = policy.period_days * DAY_MS
+            expiry_time += ((now_ms - expiry_time) // period + 1) * period
+            enable, renewed, used = True, True, 0
+
+        phase = policy.classify(used, total, expiry_time, now_ms)
+        if phase == previous and expiry_time == client.expiry_time:
+            return None
+
+        if not renewed:
+            if phase in DISABLED_PHASES and client.enable:
+                enable = False
+            elif phase not in DISABLED_PHASES and previous in DISABLED_PHASES and not client.enable:
+                # Трафик сброшен или срок продлен в панели: включаем отключенного ботом клиента
+                enable = True
+
+        change = None
+        if enable is not None or expiry_time != client.expiry_time:
+            change = ClientChange(
+                email,
+                enable=enable,
+                expiry_time=expiry_time if expiry_time != client.expiry_time else None,
+                reset_traffic=renewed
+            )
+
+        kind = RENEWED if renewed else phase
+        notification = None
+        if kind not in (ACTIVE, previous):
+            notification = Notification(telegram_id, kind, used, total, expiry_time)
+        return email, phase, change, notification
+
+    @staticmethod
+    def _log(report):
+        kinds = Counter(notification.kind for notification in report.notifications)
+        if report.changed or report.failed_inbounds:
+            logger.info(
+                f"⏳ Жизненный цикл: клиентов {report.checked}, изменилось {report.changed}, "
+                f"обновлено инбаундов {report.updated_inbounds}, ошибок {report.failed_inbounds}, "
+                f"уведомлений {dict(kinds)}"
+            )
+        else:
+            logger.debug(f"⏳ Жизненный цикл: клиентов {report.checked}, изменений нет")
@@ -0,0 +1,128 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JSONFormatter(logging.Formatter):
+    """Одна JSON-строка на запись для систем сбора логов"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" (пропущено похожих: {suppressed})"
+        return text
+
+
+class RepeatFilter(logging.Filter):
+    """Ограничение повторяющихся строк: не больше burst записей из одного места кода за period секунд
+
+    Место определяется файлом и строкой вызова, поэтому f-строки с разными
+    значениями считаются одной строкой. Ограничиваются только записи уровня
+    max_level и ниже (по умолчанию DEBUG): строки выше него - аудит
+    регистраций, исправления сверки, предупреждения - не теряются. Число пропущенных за
+    окно записей добавляется к первой записи следующего окна.
+    """
+
+    def __init__(self, burst, period, max_level=logging.DEBUG):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.max_level = max_level
+        self._lock = threading.Lock()
+        # Место вызова -> [начало окна, записей в окне, пропущено]
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class _LocalQueueHandler(QueueHandler):
+    """QueueHandler для очереди внутри процесса: форматирование целиком в потоке записи"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def parse_levels(spec):
+    """Разбор уровней по логгерам: "panel=WARNING,httpx=WARNING" -> {имя: уровень}"""
+    levels = {}
+    for item in (spec or "").split(","):
+        name, _, level = item.strip().partition("=")
+        if name and level:
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level="INFO", json_format=False, levels=None, sample=None):
+    """Настройка логирования через очередь и отдельный поток записи
+
+    Обработчики, пишущие в поток вывода, вызываются в потоке QueueListener,
+    поэтому event loop и пулы потоков не ждут ввода-вывода логов.
+    levels - уровни отдельных логгеров, sample - пара (burst, period) для
+    RepeatFilter (только записи DEBUG) или None.
+    """
+    output = logging.StreamHandler()
+    output.setFormatter(JSONFormatter() if json_format else TextFormatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    handler = _LocalQueueHandler(records)
+    if sample:
+        handler.addFilter(RepeatFilter(*sample))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    listener = QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,275 @@
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from http_endpoint import HTTPResponse, LocalHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин задержек в секундах: от быстрых чтений SQLite до медленных панелей
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение; может задаваться функцией, вычисляемой при выгрузке"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._callbacks = []
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, func):
+        """func() -> {кортеж значений меток: значение}; вызывается при каждой выгрузке"""
+        self._callbacks.append(func)
+
+    def render(self):
+        for func in self._callbacks:
+            try:
+                values = func()
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось вычислить метрику {self.name}: {e}")
+                continue
+            with self._lock:
+                self._values.update(values)
+        return super().render()
+
+
+class Histogram(_Metric):
+    """Распределение длительностей по корзинам"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счетчики корзин (последняя - +Inf), сумма, количество
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_sample(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, float('inf')), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, (("le", _format_value(float(bound))),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса и их выгрузка в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name in self._metrics:
+                raise ValueError(f"Метрика {name} уже зарегистрирована")
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_DURATION = REGISTRY.histogram(
+    "vpnbot_handler_duration_seconds", "Длительность обработки обновления Telegram", ("handler",))
+HANDLER_ERRORS = REGISTRY.counter(
+    "vpnbot_handler_errors_total", "Ошибки обработчиков Telegram", ("handler",))
+HANDLER_IN_FLIGHT = REGISTRY.gauge(
+    "vpnbot_handler_in_flight", "Обновления Telegram в обработке", ("handler",))
+
+PANEL_DURATION = REGISTRY.histogram(
+    "vpnbot_panel_request_duration_seconds", "Длительность операций панели 3x-ui", ("panel", "operation"))
+PANEL_ERRORS = REGISTRY.counter(
+    "vpnbot_panel_errors_total", "Ошибки операций панели 3x-ui", ("panel", "operation"))
+PANEL_IN_FLIGHT = REGISTRY.gauge(
+    "vpnbot_panel_in_flight", "Операции панели 3x-ui в процессе", ("panel",))
+
+DB_DURATION = REGISTRY.histogram(
+    "vpnbot_db_duration_seconds", "Длительность запросов к базе данных", ("operation",))
+DB_ERRORS = REGISTRY.counter(
+    "vpnbot_db_errors_total", "Ошибки запросов к базе данных", ("operation",))
+DB_IN_FLIGHT = REGISTRY.gauge(
+    "vpnbot_db_in_flight", "Запросы к базе данных в процессе")
+
+CACHE_HIT_RATIO = REGISTRY.gauge(
+    "vpnbot_cache_hit_ratio", "Доля попаданий в кэш", ("cache",))
+CACHE_SIZE = REGISTRY.gauge(
+    "vpnbot_cache_entries", "Число записей в кэше", ("cache",))
+
+
+@contextmanager
+def track(duration, errors, in_flight=None, in_flight_labels=None, **labels):
+    """Замер длительности блока с учетом ошибок и числа выполняемых операций"""
+    gauge_labels = labels if in_flight_labels is None else in_flight_labels
+    if in_flight is not None:
+        in_flight.inc(**gauge_labels)
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        errors.inc(**labels)
+        raise
+    finally:
+        duration.observe(time.perf_counter() - started, **labels)
+        if in_flight is not None:
+            in_flight.dec(**gauge_labels)
+
+
+def timed_db(operation):
+    """Декоратор замера функции работы с базой данных"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track(DB_DURATION, DB_ERRORS, DB_IN_FLIGHT, {}, operation=operation):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_handler(handler):
+    """Декоратор замера асинхронного обработчика Telegram"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with track_handler(handler):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def track_handler(handler):
+    return track(HANDLER_DURATION, HANDLER_ERRORS, HANDLER_IN_FLIGHT, handler=handler)
+
+
+def track_panel(panel, operation):
+    return track(PANEL_DURATION, PANEL_ERRORS, PANEL_IN_FLIGHT, {"panel": panel},
+                 panel=panel, operation=operation)
+
+
+def register_cache(name, cache):
+    """Выгрузка доли попаданий и размера кэша со stats() в стиле TTLCache"""
+    def hit_ratio():
+        return {(name,): cache.stats()['hit_ratio']}
+
+    def size():
+        return {(name,): cache.stats()['size']}
+
+    CACHE_HIT_RATIO.set_function(hit_ratio)
+    CACHE_SIZE.set_function(size)
+
+
+class MetricsServer(LocalHTTPServer):
+    """Локальный эндпоинт /metrics для Prometheus"""
+
+    def __init__(self, host, port, registry=REGISTRY):
+        super().__init__("Метрики", host, port, self._handle)
+        self.registry = registry
+
+    async def _handle(self, method, path, headers):
+        if path.split('?', 1)[0] != '/metrics':
+            return HTTPResponse(404, b"Not Found")
+        return HTTPResponse(200, self.registry.render(), {'Content-Type': CONTENT_TYPE})
@@ -0,0 +1,264 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from breaker import CircuitBreaker
+from metrics import track_panel
+
+logger = logging.getLogger(__name__)
+
+# Коды, которыми 3x-ui отвечает на запросы с просроченной или чужой сессией
+AUTH_REJECT_STATUSES = (401, 403, 404)
+
+
+def is_auth_rejection(error):
+    """Проверяет, что панель отклонила запрос из-за сессии"""
+    if isinstance(error, requests.exceptions.JSONDecodeError):
+        # Вместо JSON панель вернула страницу логина
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code in AUTH_REJECT_STATUSES
+    return False
+
+
+class PanelUnavailable(Exception):
+    """Панель недоступна: предохранитель разомкнут и вызов не выполнялся"""
+
+
+def is_outage_error(error):
+    """Проверяет, что ошибка говорит о недоступности панели, а не об отказе в операции"""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          requests.exceptions.RetryError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    return False
+
+
+def is_missing_record_error(error):
+    """Проверяет, что панель сообщила об отсутствии инбаунда"""
+    return "not found" in str(error).lower()
+
+
+def is_rejection_error(error):
+    """Проверяет, что панель получила запрос и отказала в самой операции (4xx или success=false)
+
+    Отказы из-за сессии и отсутствующего инбаунда сюда не входят: они
+    относятся ко всему запросу, а не к переданным данным.
+    """
+    if is_auth_rejection(error) or is_missing_record_error(error):
+        return False
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return 400 <= error.response.status_code < 500
+    # Ответ success=false py3xui выбрасывает как ValueError
+    return isinstance(error, ValueError)
+
+
+def _bind_http_session(sub_api, http, timeout=None):
+    """Направляет запросы под-API py3xui через общий пул соединений с таймаутом"""
+    original = sub_api._request_with_retry
+
+    def request_with_retry(method, url, headers, **kwargs):
+        if timeout:
+            kwargs.setdefault("timeout", timeout)
+        return original(getattr(http, method.__name__), url, headers, **kwargs)
+
+    sub_api._request_with_retry = request_with_retry
+
+
+class XUISession:
+    """Долгоживущая сессия 3x-ui, общая для всех обработчиков
+
+    Логинится один раз, переиспользует cookie и пул HTTP соединений и
+    перелогинивается только когда панель отклоняет текущую сессию.
+    Все вызовы идут через предохранитель: при недоступности панели они
+    сразу завершаются PanelUnavailable, не дожидаясь таймаутов.
+    """
+
+    def __init__(self, url, username, password, use_tls_verify=False, pool_size=10, name="main",
+                 request_timeout=10, request_retries=2, breaker_threshold=5, breaker_reset=5.0,
+                 breaker_max_reset=300.0):
+        self.url = url
+        self.name = name
+        self._request_timeout = request_timeout
+        self._request_retries = request_retries
+        self.breaker = CircuitBreaker(
+            f"Панель {name}", breaker_threshold, breaker_reset, breaker_max_reset
+        )
+        self._username = username
+        self._password = password
+        self._use_tls_verify = use_tls_verify
+        self._pool_size = pool_size
+        self._lock = threading.Lock()
+        self._api = None
+        self._logged_in = False
+        # Номер текущей сессии: позволяет не перелогиниваться повторно,
+        # если сессию уже обновил другой поток
+        self._generation = 0
+
+    def _create_api(self):
+        """Создание клиента py3xui поверх общего пула соединений"""
+        # py3xui загружается долго, поэтому импортируется при первом обращении к панели
+        from py3xui import Api
+
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+        http.mount("http://", adapter)
+        http.mount("https://", adapter)
+
+        api = Api(self.url, self._username, self._password, use_tls_verify=self._use_tls_verify)
+        for sub_api in (api.client, api.inbound, api.database, api.server):
+            _bind_http_session(sub_api, http, self._request_timeout)
+            sub_api.max_retries = self._request_retries
+        return api
+
+    def _login(self, stale_generation=None):
+        """Авторизация в панели; параллельные вызовы выполняют один логин"""
+        with self._lock:
+            if self._logged_in and self._generation != stale_generation:
+                return self._api, self._generation
+
+            if self._api is None:
+                self._api = self._create_api()
+            self._logged_in = False
+            try:
+                with track_panel(self.name, "login"):
+                    self._api.login()
+            except Exception as e:
+                logger.error(f"❌ Ошибка авторизации в 3x-ui: {e}")
+                raise
+            self._logged_in = True
+            self._generation += 1
+            logger.info("✅ Успешная авторизация в 3x-ui")
+            return self._api, self._generation
+
+    def ensure_login(self):
+        """Гарантирует наличие активной сессии"""
+        try:
+            self._guarded(self._login)
+            return True
+        except Exception:
+            return False
+
+    def invalidate(self):
+        """Сброс сессии: следующий вызов выполнит новый логин"""
+        with self._lock:
+            self._logged_in = False
+
+    @property
+    def available(self):
+        """Панель не считается недоступной предохранителем"""
+        return self.breaker.available
+
+    def _guarded(self, func, *args, **kwargs):
+        """Вызов через предохранитель: ошибки связи размыкают его, ответы панели - замыкают"""
+        if not self.breaker.allow():
+            raise PanelUnavailable(f"Панель {self.name} временно недоступна")
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_outage_error(e):
+                self.breaker.record_failure()
+            else:
+                # Панель ответила, хоть и ошибкой: связь есть
+                self.breaker.record_success()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def call(self, operation, *args, **kwargs):
+        """Вызов операции py3xui вида "inbound.get_list" с обновлением сессии
+
+        При отказе панели из-за сессии выполняется один повторный логин и
+        повтор запроса; остальные ошибки пробрасываются вызывающему коду.
+        Если предохранитель разомкнут, сразу выбрасывается PanelUnavailable.
+        """
+        return self._guarded(self._call, operation, *args, **kwargs)
+
+    def _call(self, operation, *args, **kwargs):
+        api, generation = self._login()
+        try:
+            with track_panel(self.name, operation):
+                return self._resolve(api, operation)(*args, **kwargs)
+        except Exception as e:
+            if not is_auth_rejection(e):
+                raise
+            logger.warning(f"🔄 Панель отклонила сессию ({operation}), выполняем повторный вход")
+
+        api, _ = self._login(stale_generation=generation)
+        with track_panel(self.name, operation):
+            return self._resolve(api, operation)(*args, **kwargs)
+
+    @staticmethod
+    def _resolve(api, operation):
+        """Поиск метода py3xui по имени операции"""
+        target = api
+        for part in operation.split("."):
+            target = getattr(target, part)
+        return target
+
+
+@dataclass(frozen=True, slots=True)
+class InboundInfo:
+    """Метаданные инбаунда, в который бот добавляет клиентов"""
+    id: int
+    remark: str
+    port: int
+    protocol: str
+
+    @classmethod
+    def from_inbound(cls, inbound):
+        return cls(inbound.id, inbound.remark, inbound.port, inbound.protocol)
+
+
+class InboundCache:
+    """Кэш найденного инбаунда с TTL
+
+    Параллельные вызовы при пустом кэше ждут одно разрешение, поэтому
+    создание инбаунда выполняется не более одного раза.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._info = None
+        self._expires_at = 0.0
+
+    @property
+    def info(self):
+        return self._info
+
+    def get(self, resolve):
+        """Возвращает инбаунд из кэша или разрешает его вызовом resolve()"""
+        if self._info is not None and time.monotonic() < self._expires_at:
+            return self._info
+
+        with self._lock:
+            if self._info is not None and time.monotonic() < self._expires_at:
+                return self._info
+
+            inbound = resolve()
+            if inbound is None:
+                if self._info is not None:
+                    # Проверка не удалась, но инбаунд не пропадал: используем прежний
+                    logger.warning(f"⚠️ Не удалось обновить инбаунд, используем кэш: ID {self._info.id}")
+                return self._info
+
+            self._info = InboundInfo.from_inbound(inbound)
+            self._expires_at = time.monotonic() + self.ttl
+            logger.info(f"📌 Инбаунд закэширован: {self._info.remark} (ID: {self._info.id}, порт: {self._info.port})")
+            return self._info
+
+    def invalidate(self):
+        """Сброс кэша, когда панель сообщает об отсутствии инбаунда"""
+        with self._lock:
+            self._info = None
+            self._expires_at = 0.0
+        logger.warning("🗑️ Кэш инбаунда сброшен")
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+
+from panel import is_rejection_error
+
+logger = logging.getLogger(__name__)
+
+
+def add_clients_with_fallback(add_clients, target, clients):
+    """Добавление пачки; возвращает ошибку (или None) для каждого клиента
+
+    Если панель отклоняет пачку (4xx или success=false), клиенты
+    добавляются по одному, чтобы ошибку получил только виновный. При
+    недоступности панели, таймауте или занятом инбаунде неизвестно, записана
+    ли пачка, и повтор по одному мог бы создать клиентов дважды: ошибку
+    получает вся пачка, а клиентов, которые все же записаны, найдет сверка.
+    """
+    try:
+        add_clients(target, clients)
+        logger.info(f"📦 Инбаунд {target}: записано клиентов одной пачкой: {len(clients)}")
+        return [None] * len(clients)
+    except Exception as e:
+        if len(clients) == 1 or not is_rejection_error(e):
+            return [e] * len(clients)
+        logger.warning(f"⚠️ Пачка из {len(clients)} клиентов отклонена ({e}), добавляем по одному")
+
+    errors = []
+    for client in clients:
+        try:
+            add_clients(target, [client])
+            errors.append(None)
+        except Exception as e:
+            logger.error(f"❌ Не удалось добавить клиента {client.email}: {e}")
+            errors.append(e)
+    return errors
+
+
+class ClientBatcher:
+    """Пакетное добавление клиентов в 3x-ui
+
+    Каждое добавление клиента переписывает JSON настроек инбаунда целиком,
+    поэтому регистрации копятся в течение короткого окна (или до
+    max_batch штук) и добавляются одним вызовом client.add на инбаунд.
+    Ключ target (например, пара панель/ID инбаунда) передается в add_clients.
+    Если панель отклонила пачку, клиенты добавляются по одному, чтобы
+    ошибка одного клиента не затронула остальных (add_clients_with_fallback).
+    """
+
+    def __init__(self, add_clients, runner, window, max_batch):
+        self._add_clients = add_clients
+        self._runner = runner
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}
+        self._timers = {}
+        self._tasks = set()
+
+    @property
+    def busy(self):
+        """Есть накопленные или записываемые клиенты"""
+        return bool(self._pending or self._tasks)
+
+    async def submit(self, target, client):
+        """Добавление клиента в очередь; завершается после записи в панель"""
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.setdefault(target, [])
+        pending.append((client, future))
+
+        if len(pending) >= self.max_batch:
+            # Пачка заполнена: отправляем сразу, не дожидаясь окна
+            timer = self._timers.pop(target, None)
+            if timer is not None:
+                timer.cancel()
+            self._spawn(self._write(target, self._pending.pop(target)))
+        elif target not in self._timers:
+            self._timers[target] = self._spawn(self._flush_after(target, self.window))
+
+        await future
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_after(self, target, delay):
+        await asyncio.sleep(delay)
+        self._timers.pop(target, None)
+        await self._flush(target)
+
+    async def _flush(self, target):
+        batch = self._pending.pop(target, [])
+        if batch:
+            await self._write(target, batch)
+
+    async def _write(self, target, batch):
+        clients = [client for client, _ in batch]
+        try:
+            errors = await self._runner.run(self._add_batch, target, clients)
+        except Exception as e:
+            # Пачка не попала в пул (например, очередь заполнена)
+            errors = [e] * len(batch)
+
+        for (_, future), error in zip(batch, errors):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def _add_batch(self, target, clients):
+        return add_clients_with_fallback(self._add_clients, target, clients)
+
+    async def flush_all(self):
+        """Немедленная запись всех накопленных клиентов"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        await asyncio.gather(*(self._flush(target) for target in list(self._pending)))
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+USER = "user"
+GLOBAL = "global"
+
+RATE_LIMITED = REGISTRY.counter(
+    "vpnbot_rate_limited_total", "Запросы, отклоненные ограничением частоты", ("action", "scope"))
+
+
+def parse_rate(spec):
+    """Разбор лимита вида "N/S" (N действий за S секунд); пустое значение или 0 отключают лимит"""
+    if not spec or spec.strip() in ("0", "off"):
+        return None
+    count, _, period = spec.partition("/")
+    count, period = int(count), float(period or 1)
+    if count <= 0 or period <= 0:
+        raise ValueError(f"Некорректный лимит: {spec} (ожидается N/S, например 3/60)")
+    return count, period
+
+
+class TokenBucket:
+    """Корзина токенов: до capacity действий подряд, пополнение capacity за period секунд"""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, period, now):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """Списание токена; возвращает 0 или число секунд до появления токена"""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """Ограничение частоты дорогого действия для каждого пользователя и для всех вместе
+
+    user_rate и global_rate - пары (N, S) из parse_rate или None. Корзины
+    пользователей хранятся в LRU до max_users штук; полностью
+    восстановившиеся корзины удаляются, так как не отличаются от новых.
+    """
+
+    def __init__(self, action, user_rate=None, global_rate=None, max_users=100000):
+        self.action = action
+        self.user_rate = user_rate
+        self.global_rate = global_rate
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+        now = time.monotonic()
+        self._global = TokenBucket(*global_rate, now) if global_rate else None
+
+    def check(self, user_id):
+        """Попытка выполнить действие: None, если разрешено, иначе (область, секунд до повтора)"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = None
+            if self.user_rate:
+                bucket = self._user_bucket(user_id, now)
+                wait = bucket.take(now)
+                if wait:
+                    return self._reject(USER, wait)
+
+            if self._global is not None:
+                wait = self._global.take(now)
+                if wait:
+                    if bucket is not None:
+                        # Действие не выполнено: не расходуем лимит пользователя
+                        bucket.refund()
+                    return self._reject(GLOBAL, wait)
+        return None
+
+    def _user_bucket(self, user_id, now):
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(*self.user_rate, now)
+            if len(self._users) > self.max_users:
+                self._evict(now)
+        else:
+            self._users.move_to_end(user_id)
+        return bucket
+
+    def _evict(self, now):
+        # Давно не использованные корзины в начале LRU: сначала удаляем восстановившиеся
+        for user_id, bucket in list(islice(self._users.items(), 100)):
+            if bucket.full(now):
+                del self._users[user_id]
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def _reject(self, scope, wait):
+        RATE_LIMITED.inc(action=self.action, scope=scope)
+        logger.info(f"🚦 Лимит {self.action} ({scope}): повтор через {wait:.0f} с")
+        return scope, wait
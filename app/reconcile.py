@@ -0,0 +1,249 @@
+import hashlib
+import logging
+from collections import Counter
+from dataclasses import dataclass, replace
+
+from client_index import ClientRecord, record_from_client
+from client_pool import SPARE_EMAIL_DOMAIN
+
+logger = logging.getLogger(__name__)
+
+# Виды расхождений
+ORPHAN = "orphan"        # клиент бота в панели без строки в базе
+DANGLING = "dangling"    # строка в базе без клиента в панели
+MOVED = "moved"          # клиент найден в другой панели или инбаунде
+DUPLICATE = "duplicate"  # лишний клиент пользователя, у которого уже есть другой
+STRAY = "stray"          # клиент запаса в панели без строки в spare_clients
+
+
+@dataclass(frozen=True, slots=True)
+class Finding:
+    """Расхождение между базой и панелью"""
+    kind: str
+    panel: str
+    inbound_id: int
+    telegram_id: int | None
+    client_id: str | None
+    email: str | None
+    # Номер прохода, на котором расхождение найдено впервые
+    first_seen: int = 0
+    # Для MOVED: фактическое размещение клиента (панель, инбаунд)
+    target: tuple | None = None
+
+    @property
+    def identity(self):
+        return self.kind, self.client_id, self.telegram_id
+
+
+@dataclass(frozen=True, slots=True)
+class ReconcileReport:
+    """Итог прохода сверки"""
+    checked: int
+    skipped: int
+    findings: tuple
+    repaired: int
+
+    def counts(self):
+        return Counter(finding.kind for finding in self.findings)
+
+
+def _checksum(records):
+    digest = hashlib.blake2b(digest_size=16)
+    for client_id in sorted(records):
+        record = records[client_id]
+        digest.update(f"{client_id}|{record.email.lower()}|{record.telegram_id}\n".encode())
+    return digest.hexdigest()
+
+
+class Reconciler:
+    """Инкрементальная сверка таблицы users с клиентами панелей
+
+    Клиенты бота в панели (с Telegram ID в email или tgId) сопоставляются со
+    строками базы по UUID. Для каждого инбаунда считается контрольная сумма
+    клиентов панели и отпечаток строк базы; инбаунды, у которых обе суммы не
+    изменились с прошлого прохода, пропускаются вместе с найденными ранее
+    расхождениями. Раз в full_every проходов проверяется все.
+
+    В режиме repair исправляются только расхождения, найденные повторно
+    (не в первом проходе): так не трогаются регистрации, которые добавили
+    клиента в панель, но еще не записали пользователя в базу.
+    Лишние клиенты (DUPLICATE) только показываются в отчете.
+
+    Клиенты запаса (email в домене SPARE_EMAIL_DOMAIN) проверяются на
+    каждом проходе по таблице spare_clients: клиент без строки остается в
+    панели, если пополнение запаса упало между client.add и записью в базу
+    или извлеченного клиента не удалось привязать. Такие клиенты (STRAY)
+    удаляет delete_spare(record), также только со второго прохода: пополнение
+    и извлечение, идущие во время сверки, успевают завершиться.
+    """
+
+    def __init__(self, store, default_panel, default_inbound_id, adopt, invalidate,
+                 repair=False, full_every=12, delete_spare=None):
+        self.store = store
+        self.default_key = (default_panel, default_inbound_id)
+        self._adopt = adopt
+        self._invalidate = invalidate
+        self._delete_spare = delete_spare
+        self.repair = repair
+        self.full_every = full_every
+        self._pass = 0
+        self._signatures = {}
+        self._findings = {}
+        self._strays = {}
+        self.last_report = None
+
+    def run(self, inbounds_by_panel):
+        """Проход сверки по выгрузке инбаундов {панель: инбаунды}"""
+        self._pass += 1
+        full = self.full_every <= 1 or self._pass % self.full_every == 1
+
+        panel_groups, locations, spares = self._panel_groups(inbounds_by_panel)
+        fingerprints = self.store.location_fingerprints(*self.default_key)
+
+        checked = skipped = 0
+        findings = {}
+        for key in panel_groups.keys() | fingerprints.keys():
+            records = panel_groups.get(key, {})
+            signature = (_checksum(records), fingerprints.get(key))
+            if not full and self._signatures.get(key) == signature:
+                findings[key] = self._findings.get(key, {})
+                skipped += 1
+                continue
+
+            previous = self._findings.get(key, {})
+            current = {}
+            for finding in self._diff(key, records, locations):
+                known = previous.get(finding.identity)
+                first_seen = known.first_seen if known else self._pass
+                current[finding.identity] = replace(finding, first_seen=first_seen)
+            findings[key] = current
+            self._signatures[key] = signature
+            checked += 1
+
+        for key in self._signatures.keys() - findings.keys():
+            del self._signatures[key]
+        self._findings = findings
+        # Запас меняется без изменения users, поэтому проверяется на каждом проходе
+        self._strays = self._stray_spares(spares)
+
+        repaired = self._repair() if self.repair else 0
+        all_findings = tuple(finding for group in findings.values() for finding in group.values())
+        all_findings += tuple(self._strays.values())
+        self.last_report = ReconcileReport(checked, skipped, all_findings, repaired)
+        self._log(self.last_report)
+        return self.last_report
+
+    @staticmethod
+    def _panel_groups(inbounds_by_panel):
+        """Клиенты бота по инбаундам, размещение каждого клиента по UUID и клиенты запаса"""
+        groups, locations, spares = {}, {}, {}
+        for panel, inbounds in inbounds_by_panel.items():
+            for inbound in inbounds:
+                key = (panel, inbound.id)
+                records = groups.setdefault(key, {})
+                for client in inbound.settings.clients or []:
+                    if client.id is None or not client.email:
+                        continue
+                    record = record_from_client(client, inbound.id, panel)
+                    if record.telegram_id is None:
+                        if record.email.lower().endswith(f"@{SPARE_EMAIL_DOMAIN}"):
+                            spares[record.client_id] = record
+                        # Клиенты, созданные вручную, не сверяются
+                        continue
+                    records[record.client_id] = record
+                    locations[record.client_id] = key
+        return groups, locations, spares
+
+    def _stray_spares(self, spares):
+        # Строки читаются после выгрузки панели: клиент, записанный в запас до нее, не считается лишним
+        known = self.store.spare_client_ids() if spares else set()
+        strays = {}
+        for client_id, record in spares.items():
+            if client_id in known:
+                continue
+            finding = Finding(STRAY, record.panel, record.inbound_id, None, client_id, record.email)
+            previous = self._strays.get(finding.identity)
+            strays[finding.identity] = replace(finding, first_seen=previous.first_seen if previous else self._pass)
+        return strays
+
+    def _diff(self, key, records, locations):
+        panel, inbound_id = key
+        seen = set()
+
+        rows = self.store.iter_users_at(panel, inbound_id, include_unplaced=key == self.default_key)
+        for row in rows:
+            client_id = row.xui_client_id
+            if client_id in records:
+                seen.add(client_id)
+                if (row.panel, row.inbound_id) != key:
+                    # Старая строка без размещения: дописываем фактическое
+                    yield Finding(MOVED, panel, inbound_id, row.telegram_id, client_id, row.email, target=key)
+            elif client_id in locations:
+                yield Finding(MOVED, panel, inbound_id, row.telegram_id, client_id, row.email,
+                              target=locations[client_id])
+            else:
+                yield Finding(DANGLING, panel, inbound_id, row.telegram_id, client_id, row.email)
+
+        for client_id, record in records.items():
+            if client_id in seen or self.store.get_user_by_client_id(client_id):
+                # Строка найдена в другом инбаунде: учтена как MOVED там
+                continue
+            kind = DUPLICATE if self.store.get_user(record.telegram_id) else ORPHAN
+            yield Finding(kind, panel, inbound_id, record.telegram_id, client_id, record.email)
+
+    def _repair(self):
+        repaired = 0
+        for key, group in [*self._findings.items(), (None, self._strays)]:
+            for identity, finding in list(group.items()):
+                if finding.first_seen >= self._pass or finding.kind == DUPLICATE:
+                    continue
+                try:
+                    if not self._repair_finding(finding):
+                        continue
+                except Exception as e:
+                    logger.error(f"❌ Не удалось исправить расхождение {finding.kind} "
+                                 f"(Telegram ID {finding.telegram_id}): {e}")
+                    continue
+                del group[identity]
+                # Инбаунд изменился: проверим его заново на следующем проходе
+                self._signatures.pop(key, None)
+                if finding.target:
+                    self._signatures.pop(finding.target, None)
+                repaired += 1
+        return repaired
+
+    def _repair_finding(self, finding):
+        if finding.kind == ORPHAN:
+            record = ClientRecord(finding.client_id, finding.email, finding.inbound_id,
+                                  finding.telegram_id, finding.panel)
+            if not self._adopt(record):
+                return False
+            logger.info(f"🩹 Клиент {finding.email} записан в базу для Telegram ID {finding.telegram_id}")
+        elif finding.kind == DANGLING:
+            self.store.delete_user(finding.telegram_id)
+            self._invalidate(finding.telegram_id)
+            logger.info(f"🩹 Удалена запись Telegram ID {finding.telegram_id}: клиента {finding.client_id} нет в панели")
+        elif finding.kind == MOVED:
+            self.store.update_location(finding.telegram_id, *finding.target)
+            self._invalidate(finding.telegram_id)
+            logger.info(f"🩹 Размещение Telegram ID {finding.telegram_id} обновлено: {finding.target[0]}/{finding.target[1]}")
+        elif finding.kind == STRAY:
+            if self._delete_spare is None:
+                return False
+            self._delete_spare(ClientRecord(finding.client_id, finding.email, finding.inbound_id, None, finding.panel))
+            logger.info(f"🩹 Из панели {finding.panel} удален клиент запаса {finding.email} без строки в базе")
+        return True
+
+    def _log(self, report):
+        counts = report.counts()
+        summary = ", ".join(f"{kind}: {count}" for kind, count in sorted(counts.items())) or "нет"
+        message = (
+            f"🧮 Сверка базы и панели: проверено инбаундов {report.checked}, "
+            f"без изменений {report.skipped}, расхождения: {summary}"
+        )
+        if report.repaired:
+            message += f", исправлено {report.repaired}"
+        if counts:
+            logger.warning(message)
+        else:
+            logger.info(message)
@@ -0,0 +1,197 @@
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+
+from panel import XUISession, InboundCache
+
+logger = logging.getLogger(__name__)
+
+
+class InboundWriteLock:
+    """Блокировка записи клиентов инбаунда
+
+    Внутри процесса - threading.Lock. С общей базой (use_leases) поверх
+    нее берется аренда inbound:{панель}/{ID}: client.add и перезапись
+    инбаунда с другой реплики между чтением и записью инбаунда стерли бы
+    добавленных ею клиентов. Аренда ждется до wait секунд, затем
+    выбрасывается TimeoutError.
+    """
+
+    def __init__(self, name, poll_interval=0.05):
+        self.name = name
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._leases = None
+
+    def use_leases(self, store, owner, ttl=60, wait=60):
+        """Включение аренды в общей базе store от имени реплики owner"""
+        self._leases = (store, owner, ttl, wait)
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._leases is None:
+            return self
+        store, owner, ttl, wait = self._leases
+        deadline = time.monotonic() + wait
+        try:
+            while not store.acquire_lease(self.name, owner, ttl):
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Инбаунд {self.name} занят другой репликой дольше {wait} с")
+                time.sleep(self.poll_interval)
+        except BaseException:
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if self._leases is not None:
+                store, owner, _, _ = self._leases
+                store.release_lease(self.name, owner)
+        finally:
+            self._lock.release()
+
+
+@dataclass(eq=False)
+class InboundTarget:
+    """Инбаунд панели, в который можно добавлять клиентов"""
+    panel: "Panel"
+    inbound_id: int
+    port: int
+    capacity: int
+    cache: InboundCache = field(repr=False)
+
+    @property
+    def resolved_id(self):
+        """ID инбаунда после разрешения (может отличаться от настроенного)"""
+        info = self.cache.info
+        return info.id if info else self.inbound_id
+
+    @property
+    def name(self):
+        return f"{self.panel.name}/{self.inbound_id}"
+
+
+class Panel:
+    """Панель 3x-ui со своей сессией и набором инбаундов"""
+
+    def __init__(self, name, url, username, password, inbounds, inbound_cache_ttl, **session_options):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.session = XUISession(url, username, password, use_tls_verify=False, name=name, **session_options)
+        self.targets = [
+            InboundTarget(
+                panel=self,
+                inbound_id=int(inbound['id']),
+                port=int(inbound.get('port', 443)),
+                capacity=int(inbound.get('capacity', 0)),
+                cache=InboundCache(inbound_cache_ttl)
+            )
+            for inbound in inbounds
+        ]
+        # Добавление клиентов и перезапись инбаунда целиком не должны пересекаться
+        self._write_locks = {}
+        self._leases = None
+
+    def use_leases(self, store, owner, ttl=60, wait=60):
+        """Блокировки записи инбаундов через аренды в общей для реплик базе"""
+        self._leases = (store, owner, ttl, wait)
+        for lock in list(self._write_locks.values()):
+            lock.use_leases(*self._leases)
+
+    def write_lock(self, inbound_id):
+        """Блокировка записи клиентов инбаунда (InboundWriteLock)"""
+        lock = self._write_locks.get(inbound_id)
+        if lock is None:
+            candidate = InboundWriteLock(f"inbound:{self.name}/{inbound_id}")
+            if self._leases is not None:
+                candidate.use_leases(*self._leases)
+            lock = self._write_locks.setdefault(inbound_id, candidate)
+        return lock
+
+    def invalidate_inbound(self, inbound_id):
+        """Сброс кэша инбаунда, который панель считает отсутствующим"""
+        for target in self.targets:
+            if target.resolved_id == inbound_id:
+                target.cache.invalidate()
+
+
+def load_panels(shards_json, default_shard, inbound_cache_ttl, **session_options):
+    """Создание панелей из JSON-описания XUI_SHARDS или одной панели по умолчанию
+
+    Формат: [{"name": "de-1", "url": "...", "username": "...", "password": "...",
+    "inbounds": [{"id": 1, "port": 443, "capacity": 5000}]}]. Не указанные
+    url/username/password берутся из панели по умолчанию. session_options
+    (размер пула, таймауты, настройки предохранителя) передаются в XUISession.
+    """
+    shards = json.loads(shards_json) if shards_json else [default_shard]
+
+    panels = []
+    for shard in shards:
+        config = {**default_shard, **shard}
+        panels.append(Panel(
+            name=config['name'],
+            url=config['url'],
+            username=config['username'],
+            password=config['password'],
+            inbounds=config['inbounds'],
+            inbound_cache_ttl=inbound_cache_ttl,
+            **session_options
+        ))
+
+    names = [panel.name for panel in panels]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Имена панелей в XUI_SHARDS должны быть уникальными: {names}")
+    return panels
+
+
+class ShardPlacement:
+    """Выбор панели и инбаунда для нового клиента по текущей заполненности"""
+
+    def __init__(self, panels):
+        self.panels = panels
+        self.by_name = {panel.name: panel for panel in panels}
+        self.targets = [target for panel in panels for target in panel.targets]
+
+    @property
+    def default_panel(self):
+        return self.panels[0]
+
+    def panel(self, name):
+        """Панель по имени; для старых записей без панели - панель по умолчанию"""
+        return self.by_name.get(name) or self.default_panel
+
+    @property
+    def available(self):
+        """Есть ли панель, которую предохранитель не считает недоступной"""
+        return any(panel.session.available for panel in self.panels)
+
+    def choose(self, count_clients):
+        """Инбаунд с наименьшей заполненностью; None, если все заполнены
+
+        count_clients(panel_name, inbound_id) возвращает текущее число клиентов.
+        Емкость 0 означает отсутствие ограничения. Инбаунды с емкостью
+        сравниваются по доле заполнения и выбираются первыми, инбаунды без
+        ограничения - по числу клиентов, когда инбаунды с емкостью заполнены:
+        доля и число клиентов в одном сравнении несопоставимы. Инбаунды
+        недоступных панелей пропускаются.
+        """
+        best, best_load = None, None
+        for target in self.targets:
+            if not target.panel.session.available:
+                continue
+            count = count_clients(target.panel.name, target.resolved_id)
+            if target.capacity:
+                if count >= target.capacity:
+                    continue
+                load = (0, count / target.capacity)
+            else:
+                load = (1, count)
+            if best is None or load < best_load:
+                best, best_load = target, load
+
+        if best is None and self.available:
+            logger.error("❌ Все инбаунды заполнены, новых клиентов размещать некуда")
+        return best
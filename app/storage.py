@@ -0,0 +1,589 @@
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+from metrics import timed_db
+
+logger = logging.getLogger(__name__)
+
+# Настройки соединений: WAL позволяет читать параллельно с записью
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=67108864",
+)
+
+# Миграции схемы; номер примененной миграции хранится в PRAGMA user_version
+MIGRATIONS = (
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE,
+            username TEXT,
+            full_name TEXT,
+            language_code TEXT,
+            subscription_url TEXT,
+            xui_client_id TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    (
+        "ALTER TABLE users ADD COLUMN email TEXT",
+        # telegram_id индексируется ограничением UNIQUE
+        "CREATE INDEX IF NOT EXISTS idx_users_xui_client_id ON users (xui_client_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_email ON users (email)",
+    ),
+    (
+        # Панель и инбаунд, в которых размещен клиент пользователя
+        "ALTER TABLE users ADD COLUMN panel TEXT",
+        "ALTER TABLE users ADD COLUMN inbound_id INTEGER",
+    ),
+    (
+        # Выборка пользователей инбаунда при сверке с панелью
+        "CREATE INDEX IF NOT EXISTS idx_users_location ON users (panel, inbound_id)",
+    ),
+    (
+        # Рассылки: last_user_id - курсор по users.id, до которого все отправлено
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            created_by INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME
+        )
+        ''',
+    ),
+    (
+        # Последняя фаза жизненного цикла клиентов панели; активные клиенты не хранятся
+        '''
+        CREATE TABLE IF NOT EXISTS client_lifecycle (
+            email TEXT PRIMARY KEY,
+            phase TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    (
+        # Аренды для координации реплик: регистрация пользователя, фоновые задачи
+        '''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+    ),
+    (
+        # Запас заранее созданных отключенных клиентов панели для быстрой регистрации
+        '''
+        CREATE TABLE IF NOT EXISTS spare_clients (
+            client_id TEXT PRIMARY KEY,
+            email TEXT NOT NULL,
+            panel TEXT,
+            inbound_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+)
+
+# Текущее время базы в секундах Unix
+SQLITE_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+USER_COLUMNS = (
+    "id, telegram_id, username, full_name, language_code, "
+    "subscription_url, xui_client_id, email, created_at, panel, inbound_id"
+)
+
+
+@dataclass(frozen=True, slots=True)
+class UserRow:
+    """Запись пользователя из таблицы users"""
+    id: int
+    telegram_id: int
+    username: str | None
+    full_name: str | None
+    language_code: str | None
+    subscription_url: str | None
+    xui_client_id: str | None
+    email: str | None
+    created_at: str
+    panel: str | None
+    inbound_id: int | None
+
+
+BROADCAST_COLUMNS = "id, text, created_by, status, total, last_user_id, sent, failed, blocked, created_at, finished_at"
+
+
+@dataclass(frozen=True, slots=True)
+class BroadcastRow:
+    """Запись рассылки из таблицы broadcasts"""
+    id: int
+    text: str
+    created_by: int | None
+    status: str
+    total: int
+    last_user_id: int
+    sent: int
+    failed: int
+    blocked: int
+    created_at: str
+    finished_at: str | None
+
+
+SPARE_COLUMNS = "client_id, email, panel, inbound_id"
+
+
+@dataclass(frozen=True, slots=True)
+class SpareClient:
+    """Заранее созданный отключенный клиент панели из таблицы spare_clients"""
+    client_id: str
+    email: str
+    panel: str | None
+    inbound_id: int | None
+
+
+class DuplicateUser(Exception):
+    """Пользователь с таким Telegram ID уже есть в базе"""
+
+
+class UserStorage(ABC):
+    """Интерфейс хранилища пользователей, рассылок и аренд
+
+    Реализации: SQLiteUserStore (локальный файл, одна реплика бота) и
+    PostgresUserStore (общая база для нескольких реплик). Методы
+    блокирующие и вызываются из пула потоков базы.
+    """
+
+    @abstractmethod
+    def init(self):
+        """Подключение и применение миграций"""
+
+    @abstractmethod
+    def add_user(self, telegram_id, username, full_name, language_code, subscription_url, xui_client_id,
+                 email=None, panel=None, inbound_id=None):
+        """Добавление пользователя; при дубликате выбрасывает DuplicateUser"""
+
+    @abstractmethod
+    def get_user(self, telegram_id):
+        """Пользователь по Telegram ID или None"""
+
+    @abstractmethod
+    def get_user_by_client_id(self, client_id):
+        """Пользователь по UUID клиента панели или None"""
+
+    @abstractmethod
+    def location_fingerprints(self, default_panel, default_inbound_id):
+        """{(панель, инбаунд): (число строк, сумма id, max id)}"""
+
+    @abstractmethod
+    def iter_users(self, batch_size=1000):
+        """Потоковое чтение всех пользователей по порядку добавления"""
+
+    @abstractmethod
+    def existing_telegram_ids(self, telegram_ids):
+        """Telegram ID из списка, которые уже есть в базе"""
+
+    @abstractmethod
+    def add_users(self, users):
+        """Пакетное добавление без дубликатов; возвращает число добавленных строк"""
+
+    @abstractmethod
+    def iter_users_at(self, panel, inbound_id, include_unplaced=False, batch_size=1000):
+        """Потоковое чтение пользователей инбаунда"""
+
+    @abstractmethod
+    def update_location(self, telegram_id, panel, inbound_id):
+        """Перенос пользователя в другую панель или инбаунд"""
+
+    @abstractmethod
+    def delete_user(self, telegram_id):
+        """Удаление пользователя; True, если строка была"""
+
+    @abstractmethod
+    def recipients_after(self, last_user_id, limit):
+        """Страница пар (id, telegram_id) после курсора"""
+
+    @abstractmethod
+    def create_broadcast(self, text, created_by):
+        """Новая рассылка по всем текущим пользователям"""
+
+    @abstractmethod
+    def get_broadcast(self, broadcast_id=None):
+        """Рассылка по ID или последняя"""
+
+    @abstractmethod
+    def running_broadcasts(self):
+        """Незавершенные рассылки"""
+
+    @abstractmethod
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, blocked, status=None):
+        """Сохранение курсора, счетчиков и (необязательно) состояния рассылки"""
+
+    @abstractmethod
+    def lifecycle_phases(self):
+        """Сохраненные фазы жизненного цикла {email: фаза}"""
+
+    @abstractmethod
+    def save_lifecycle_phases(self, phases):
+        """Запись фаз {email: фаза}; None удаляет строку"""
+
+    @abstractmethod
+    def spare_client_count(self):
+        """Число клиентов в запасе"""
+
+    @abstractmethod
+    def spare_client_ids(self):
+        """UUID всех клиентов запаса"""
+
+    @abstractmethod
+    def add_spare_clients(self, spares):
+        """Добавление клиентов SpareClient в запас"""
+
+    @abstractmethod
+    def take_spare_client(self, panels):
+        """Извлечение самого старого клиента запаса из панелей panels или None"""
+
+    @abstractmethod
+    def acquire_lease(self, name, owner, ttl):
+        """Захват или продление аренды name на ttl секунд; False, если она у другого владельца"""
+
+    @abstractmethod
+    def release_lease(self, name, owner):
+        """Освобождение аренды, если она принадлежит owner"""
+
+    @abstractmethod
+    def close(self):
+        """Закрытие соединений"""
+
+
+class SQLiteUserStore(UserStorage):
+    """Хранилище пользователей на SQLite
+
+    Запись идет через одно постоянное соединение под блокировкой, чтение -
+    через собственное соединение каждого потока, поэтому в режиме WAL
+    чтения не ждут записей.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+    def _connect(self, read_only=False):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect(read_only=True)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    @timed_db("init")
+    def init(self):
+        """Открытие соединения и применение миграций"""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            version = self._writer.execute("PRAGMA user_version").fetchone()[0]
+            for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                with self._writer:
+                    self._writer.execute("BEGIN")
+                    for statement in statements:
+                        self._writer.execute(statement)
+                    self._writer.execute(f"PRAGMA user_version={number}")
+                logger.info(f"🧱 Применена миграция БД #{number}")
+
+    @timed_db("add_user")
+    def add_user(self, telegram_id, username, full_name, language_code, subscription_url, xui_client_id,
+                 email=None, panel=None, inbound_id=None):
+        """Добавление пользователя; при дубликате выбрасывает DuplicateUser"""
+        try:
+            with self._write_lock, self._writer:
+                row = self._writer.execute(
+                    f"""INSERT INTO users (telegram_id, username, full_name, language_code, subscription_url,
+                                           xui_client_id, email, panel, inbound_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        RETURNING {USER_COLUMNS}""",
+                    (telegram_id, username, full_name, language_code, subscription_url,
+                     xui_client_id, email, panel, inbound_id)
+                ).fetchone()
+        except sqlite3.IntegrityError as e:
+            raise DuplicateUser(telegram_id) from e
+        return UserRow(*row)
+
+    @timed_db("get_user")
+    def get_user(self, telegram_id):
+        """Получение пользователя по Telegram ID"""
+        row = self._reader().execute(
+            f"SELECT {USER_COLUMNS} FROM users WHERE telegram_id = ?", (telegram_id,)
+        ).fetchone()
+        return UserRow(*row) if row else None
+
+    @timed_db("get_user_by_client_id")
+    def get_user_by_client_id(self, client_id):
+        """Получение пользователя по UUID клиента панели"""
+        row = self._reader().execute(
+            f"SELECT {USER_COLUMNS} FROM users WHERE xui_client_id = ?", (str(client_id),)
+        ).fetchone()
+        return UserRow(*row) if row else None
+
+    @timed_db("location_fingerprints")
+    def location_fingerprints(self, default_panel, default_inbound_id):
+        """Отпечатки строк каждого инбаунда: {(панель, инбаунд): (число, сумма id, max id)}
+
+        Строки без панели или инбаунда относятся к инбаунду по умолчанию.
+        """
+        rows = self._reader().execute(
+            """SELECT COALESCE(panel, ?), COALESCE(inbound_id, ?), COUNT(*), TOTAL(id), MAX(id)
+               FROM users GROUP BY 1, 2""",
+            (default_panel, default_inbound_id)
+        ).fetchall()
+        return {(panel, inbound_id): (count, total, max_id) for panel, inbound_id, count, total, max_id in rows}
+
+    def iter_users(self, batch_size=1000):
+        """Потоковое чтение всех пользователей по порядку добавления"""
+        cursor = self._reader().execute(f"SELECT {USER_COLUMNS} FROM users ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield UserRow(*row)
+
+    @timed_db("existing_telegram_ids")
+    def existing_telegram_ids(self, telegram_ids):
+        """Telegram ID из списка, которые уже есть в базе"""
+        telegram_ids = list(telegram_ids)
+        if not telegram_ids:
+            return set()
+        placeholders = ", ".join("?" * len(telegram_ids))
+        rows = self._reader().execute(
+            f"SELECT telegram_id FROM users WHERE telegram_id IN ({placeholders})", telegram_ids
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    @timed_db("add_users")
+    def add_users(self, users):
+        """Добавление пачки пользователей одной транзакцией; существующие Telegram ID пропускаются
+
+        users - словари с полями таблицы users; created_at можно не указывать.
+        Возвращает число добавленных строк.
+        """
+        with self._write_lock, self._writer:
+            before = self._writer.total_changes
+            self._writer.executemany(
+                """INSERT INTO users (telegram_id, username, full_name, language_code, subscription_url,
+                                      xui_client_id, email, panel, inbound_id, created_at)
+                   VALUES (:telegram_id, :username, :full_name, :language_code, :subscription_url,
+                           :xui_client_id, :email, :panel, :inbound_id, COALESCE(:created_at, CURRENT_TIMESTAMP))
+                   ON CONFLICT (telegram_id) DO NOTHING""",
+                [{'created_at': None, **user} for user in users]
+            )
+            return self._writer.total_changes - before
+
+    def iter_users_at(self, panel, inbound_id, include_unplaced=False, batch_size=1000):
+        """Потоковое чтение пользователей инбаунда пачками по batch_size строк"""
+        sql = f"SELECT {USER_COLUMNS} FROM users WHERE (panel = ? AND inbound_id = ?)"
+        if include_unplaced:
+            sql += " OR panel IS NULL OR inbound_id IS NULL"
+        cursor = self._reader().execute(sql, (panel, inbound_id))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield UserRow(*row)
+
+    @timed_db("update_location")
+    def update_location(self, telegram_id, panel, inbound_id):
+        """Перенос пользователя в другую панель или инбаунд"""
+        with self._write_lock, self._writer:
+            self._writer.execute(
+                "UPDATE users SET panel = ?, inbound_id = ? WHERE telegram_id = ?",
+                (panel, inbound_id, telegram_id)
+            )
+
+    @timed_db("delete_user")
+    def delete_user(self, telegram_id):
+        """Удаление пользователя; возвращает True, если строка была"""
+        with self._write_lock, self._writer:
+            cursor = self._writer.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
+        return cursor.rowcount > 0
+
+    @timed_db("recipients_after")
+    def recipients_after(self, last_user_id, limit):
+        """Страница получателей рассылки: пары (id, telegram_id) с id больше курсора"""
+        return self._reader().execute(
+            "SELECT id, telegram_id FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_user_id, limit)
+        ).fetchall()
+
+    @timed_db("create_broadcast")
+    def create_broadcast(self, text, created_by):
+        """Создание рассылки по всем текущим пользователям"""
+        with self._write_lock, self._writer:
+            row = self._writer.execute(
+                f"""INSERT INTO broadcasts (text, created_by, total)
+                    VALUES (?, ?, (SELECT COUNT(*) FROM users))
+                    RETURNING {BROADCAST_COLUMNS}""",
+                (text, created_by)
+            ).fetchone()
+        return BroadcastRow(*row)
+
+    @timed_db("get_broadcast")
+    def get_broadcast(self, broadcast_id=None):
+        """Рассылка по ID или последняя созданная"""
+        if broadcast_id is None:
+            row = self._reader().execute(
+                f"SELECT {BROADCAST_COLUMNS} FROM broadcasts ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+        else:
+            row = self._reader().execute(
+                f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?", (broadcast_id,)
+            ).fetchone()
+        return BroadcastRow(*row) if row else None
+
+    @timed_db("running_broadcasts")
+    def running_broadcasts(self):
+        """Незавершенные рассылки, которые нужно продолжить"""
+        rows = self._reader().execute(
+            f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running' ORDER BY id"
+        ).fetchall()
+        return [BroadcastRow(*row) for row in rows]
+
+    @timed_db("save_broadcast_progress")
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, blocked, status=None):
+        """Сохранение курсора и счетчиков рассылки; со status - смена состояния"""
+        with self._write_lock, self._writer:
+            self._writer.execute(
+                """UPDATE broadcasts
+                   SET last_user_id = ?, sent = ?, failed = ?, blocked = ?,
+                       status = COALESCE(?, status),
+                       finished_at = CASE WHEN ? IN ('done', 'cancelled') THEN CURRENT_TIMESTAMP
+                                          ELSE finished_at END
+                   WHERE id = ?""",
+                (last_user_id, sent, failed, blocked, status, status, broadcast_id)
+            )
+
+    @timed_db("lifecycle_phases")
+    def lifecycle_phases(self):
+        """Сохраненные фазы клиентов: {email: фаза}"""
+        return dict(self._reader().execute("SELECT email, phase FROM client_lifecycle").fetchall())
+
+    @timed_db("save_lifecycle_phases")
+    def save_lifecycle_phases(self, phases):
+        """Запись изменившихся фаз {email: фаза}; None вместо фазы удаляет строку"""
+        with self._write_lock, self._writer:
+            self._writer.executemany(
+                """INSERT INTO client_lifecycle (email, phase) VALUES (?, ?)
+                   ON CONFLICT (email) DO UPDATE SET phase = excluded.phase, updated_at = CURRENT_TIMESTAMP""",
+                [(email, phase) for email, phase in phases.items() if phase is not None]
+            )
+            self._writer.executemany(
+                "DELETE FROM client_lifecycle WHERE email = ?",
+                [(email,) for email, phase in phases.items() if phase is None]
+            )
+
+    @timed_db("spare_client_count")
+    def spare_client_count(self):
+        return self._reader().execute("SELECT COUNT(*) FROM spare_clients").fetchone()[0]
+
+    @timed_db("spare_client_ids")
+    def spare_client_ids(self):
+        return {row[0] for row in self._reader().execute("SELECT client_id FROM spare_clients")}
+
+    @timed_db("add_spare_clients")
+    def add_spare_clients(self, spares):
+        with self._write_lock, self._writer:
+            self._writer.executemany(
+                "INSERT INTO spare_clients (client_id, email, panel, inbound_id) VALUES (?, ?, ?, ?)",
+                [(spare.client_id, spare.email, spare.panel, spare.inbound_id) for spare in spares]
+            )
+
+    @timed_db("take_spare_client")
+    def take_spare_client(self, panels):
+        """Удаление и возврат клиента запаса: строку получает только один вызов"""
+        panels = list(panels)
+        if not panels:
+            return None
+        placeholders = ", ".join("?" * len(panels))
+        with self._write_lock, self._writer:
+            row = self._writer.execute(
+                f"""DELETE FROM spare_clients
+                    WHERE client_id = (SELECT client_id FROM spare_clients WHERE panel IN ({placeholders})
+                                       ORDER BY rowid LIMIT 1)
+                    RETURNING {SPARE_COLUMNS}""",
+                panels
+            ).fetchone()
+        return SpareClient(*row) if row else None
+
+    @timed_db("acquire_lease")
+    def acquire_lease(self, name, owner, ttl):
+        """Захват аренды, свободной, истекшей или уже принадлежащей owner"""
+        with self._write_lock, self._writer:
+            cursor = self._writer.execute(
+                f"""INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, {SQLITE_NOW} + ?)
+                    ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                    WHERE leases.owner = excluded.owner OR leases.expires_at < {SQLITE_NOW}""",
+                (name, owner, ttl)
+            )
+        return cursor.rowcount > 0
+
+    @timed_db("release_lease")
+    def release_lease(self, name, owner):
+        with self._write_lock, self._writer:
+            self._writer.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def close(self):
+        """Закрытие всех соединений"""
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+
+def open_store(database_url=None, sqlite_path=None, pool_size=4):
+    """Хранилище по DATABASE_URL: postgres://... - общая база, иначе локальный SQLite"""
+    if database_url and database_url.startswith(("postgres://", "postgresql://")):
+        # psycopg нужен только для общей базы
+        try:
+            from storage_postgres import PostgresUserStore
+        except ImportError as e:
+            raise RuntimeError(
+                f"Для DATABASE_URL с PostgreSQL установите зависимости из requirements-postgres.txt: {e}"
+            ) from e
+        return PostgresUserStore(database_url, pool_size)
+    if database_url and database_url.startswith("sqlite:///"):
+        sqlite_path = database_url[len("sqlite:///"):]
+    elif database_url:
+        raise ValueError(f"Неподдерживаемый DATABASE_URL: {database_url.split(':', 1)[0]}://...")
+    return SQLiteUserStore(sqlite_path)
@@ -0,0 +1,313 @@
+import logging
+
+import psycopg
+from psycopg_pool import ConnectionPool
+
+from metrics import timed_db
+from storage import (BROADCAST_COLUMNS, SPARE_COLUMNS, USER_COLUMNS, BroadcastRow, DuplicateUser, SpareClient,
+                     UserRow, UserStorage)
+
+logger = logging.getLogger(__name__)
+
+# Время в текстовом виде, как CURRENT_TIMESTAMP в SQLite (UTC)
+PG_TIMESTAMP = "to_char(now() AT TIME ZONE 'utc', 'YYYY-MM-DD HH24:MI:SS')"
+PG_NOW = "extract(epoch FROM clock_timestamp())"
+
+# Схема, эквивалентная миграциям SQLite; номер примененной миграции хранится в schema_version
+MIGRATIONS = (
+    (
+        f'''
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            telegram_id BIGINT UNIQUE,
+            username TEXT,
+            full_name TEXT,
+            language_code TEXT,
+            subscription_url TEXT,
+            xui_client_id TEXT,
+            email TEXT,
+            created_at TEXT DEFAULT {PG_TIMESTAMP},
+            panel TEXT,
+            inbound_id INTEGER
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_users_xui_client_id ON users (xui_client_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_email ON users (email)",
+        "CREATE INDEX IF NOT EXISTS idx_users_location ON users (panel, inbound_id)",
+        f'''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            text TEXT NOT NULL,
+            created_by BIGINT,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT DEFAULT {PG_TIMESTAMP},
+            finished_at TEXT
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS client_lifecycle (
+            email TEXT PRIMARY KEY,
+            phase TEXT NOT NULL,
+            updated_at TEXT DEFAULT {PG_TIMESTAMP}
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at DOUBLE PRECISION NOT NULL
+        )
+        ''',
+    ),
+    (
+        f'''
+        CREATE TABLE IF NOT EXISTS spare_clients (
+            client_id TEXT PRIMARY KEY,
+            email TEXT NOT NULL,
+            panel TEXT,
+            inbound_id INTEGER,
+            created_at TEXT DEFAULT {PG_TIMESTAMP}
+        )
+        ''',
+    ),
+)
+
+
+class PostgresUserStore(UserStorage):
+    """Хранилище пользователей в PostgreSQL для нескольких реплик бота
+
+    Соединения берутся из пула размером pool_size (по числу потоков базы).
+    Миграции применяются под advisory-блокировкой, поэтому реплики могут
+    запускаться одновременно.
+    """
+
+    def __init__(self, url, pool_size=4):
+        self.url = url
+        self.pool_size = pool_size
+        self._pool = None
+
+    @timed_db("init")
+    def init(self):
+        if self._pool is None:
+            self._pool = ConnectionPool(self.url, min_size=1, max_size=self.pool_size, open=True)
+        with self._pool.connection() as conn:
+            conn.execute("SELECT pg_advisory_xact_lock(hashtext('vpnbot:migrations'))")
+            conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+            row = conn.execute("SELECT version FROM schema_version").fetchone()
+            version = row[0] if row else 0
+            for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in statements:
+                    conn.execute(statement)
+                logger.info(f"🧱 Применена миграция PostgreSQL #{number}")
+            if version < len(MIGRATIONS):
+                if row:
+                    conn.execute("UPDATE schema_version SET version = %s", (len(MIGRATIONS),))
+                else:
+                    conn.execute("INSERT INTO schema_version (version) VALUES (%s)", (len(MIGRATIONS),))
+
+    def _fetchone(self, sql, params=()):
+        with self._pool.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params=()):
+        with self._pool.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _iterate(self, name, sql, params, batch_size):
+        # Серверный курсор: строки читаются пачками, а не целиком
+        with self._pool.connection() as conn, conn.cursor(name=name) as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield UserRow(*row)
+
+    @timed_db("add_user")
+    def add_user(self, telegram_id, username, full_name, language_code, subscription_url, xui_client_id,
+                 email=None, panel=None, inbound_id=None):
+        try:
+            row = self._fetchone(
+                f"""INSERT INTO users (telegram_id, username, full_name, language_code, subscription_url,
+                                       xui_client_id, email, panel, inbound_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING {USER_COLUMNS}""",
+                (telegram_id, username, full_name, language_code, subscription_url,
+                 xui_client_id, email, panel, inbound_id)
+            )
+        except psycopg.errors.UniqueViolation as e:
+            raise DuplicateUser(telegram_id) from e
+        return UserRow(*row)
+
+    @timed_db("get_user")
+    def get_user(self, telegram_id):
+        row = self._fetchone(f"SELECT {USER_COLUMNS} FROM users WHERE telegram_id = %s", (telegram_id,))
+        return UserRow(*row) if row else None
+
+    @timed_db("get_user_by_client_id")
+    def get_user_by_client_id(self, client_id):
+        row = self._fetchone(f"SELECT {USER_COLUMNS} FROM users WHERE xui_client_id = %s", (str(client_id),))
+        return UserRow(*row) if row else None
+
+    @timed_db("location_fingerprints")
+    def location_fingerprints(self, default_panel, default_inbound_id):
+        rows = self._fetchall(
+            """SELECT COALESCE(panel, %s), COALESCE(inbound_id, %s), COUNT(*), COALESCE(SUM(id), 0)::float8, MAX(id)
+               FROM users GROUP BY 1, 2""",
+            (default_panel, default_inbound_id)
+        )
+        return {(panel, inbound_id): (count, total, max_id) for panel, inbound_id, count, total, max_id in rows}
+
+    def iter_users(self, batch_size=1000):
+        return self._iterate("iter_users", f"SELECT {USER_COLUMNS} FROM users ORDER BY id", (), batch_size)
+
+    @timed_db("existing_telegram_ids")
+    def existing_telegram_ids(self, telegram_ids):
+        telegram_ids = list(telegram_ids)
+        if not telegram_ids:
+            return set()
+        rows = self._fetchall("SELECT telegram_id FROM users WHERE telegram_id = ANY(%s)", (telegram_ids,))
+        return {row[0] for row in rows}
+
+    @timed_db("add_users")
+    def add_users(self, users):
+        with self._pool.connection() as conn, conn.cursor() as cursor:
+            cursor.executemany(
+                """INSERT INTO users (telegram_id, username, full_name, language_code, subscription_url,
+                                      xui_client_id, email, panel, inbound_id, created_at)
+                   VALUES (%(telegram_id)s, %(username)s, %(full_name)s, %(language_code)s, %(subscription_url)s,
+                           %(xui_client_id)s, %(email)s, %(panel)s, %(inbound_id)s,
+                           COALESCE(%(created_at)s, """ + PG_TIMESTAMP + """))
+                   ON CONFLICT (telegram_id) DO NOTHING""",
+                [{'created_at': None, **user} for user in users]
+            )
+            return max(cursor.rowcount, 0)
+
+    def iter_users_at(self, panel, inbound_id, include_unplaced=False, batch_size=1000):
+        sql = f"SELECT {USER_COLUMNS} FROM users WHERE (panel = %s AND inbound_id = %s)"
+        if include_unplaced:
+            sql += " OR panel IS NULL OR inbound_id IS NULL"
+        return self._iterate("iter_users_at", sql, (panel, inbound_id), batch_size)
+
+    @timed_db("update_location")
+    def update_location(self, telegram_id, panel, inbound_id):
+        with self._pool.connection() as conn:
+            conn.execute(
+                "UPDATE users SET panel = %s, inbound_id = %s WHERE telegram_id = %s", (panel, inbound_id, telegram_id)
+            )
+
+    @timed_db("delete_user")
+    def delete_user(self, telegram_id):
+        with self._pool.connection() as conn:
+            return conn.execute("DELETE FROM users WHERE telegram_id = %s", (telegram_id,)).rowcount > 0
+
+    @timed_db("recipients_after")
+    def recipients_after(self, last_user_id, limit):
+        return self._fetchall(
+            "SELECT id, telegram_id FROM users WHERE id > %s ORDER BY id LIMIT %s", (last_user_id, limit)
+        )
+
+    @timed_db("create_broadcast")
+    def create_broadcast(self, text, created_by):
+        row = self._fetchone(
+            f"""INSERT INTO broadcasts (text, created_by, total)
+                VALUES (%s, %s, (SELECT COUNT(*) FROM users))
+                RETURNING {BROADCAST_COLUMNS}""",
+            (text, created_by)
+        )
+        return BroadcastRow(*row)
+
+    @timed_db("get_broadcast")
+    def get_broadcast(self, broadcast_id=None):
+        if broadcast_id is None:
+            row = self._fetchone(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts ORDER BY id DESC LIMIT 1")
+        else:
+            row = self._fetchone(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = %s", (broadcast_id,))
+        return BroadcastRow(*row) if row else None
+
+    @timed_db("running_broadcasts")
+    def running_broadcasts(self):
+        rows = self._fetchall(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running' ORDER BY id")
+        return [BroadcastRow(*row) for row in rows]
+
+    @timed_db("save_broadcast_progress")
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, blocked, status=None):
+        with self._pool.connection() as conn:
+            conn.execute(
+                f"""UPDATE broadcasts
+                    SET last_user_id = %s, sent = %s, failed = %s, blocked = %s,
+                        status = COALESCE(%s::text, status),
+                        finished_at = CASE WHEN %s::text IN ('done', 'cancelled') THEN {PG_TIMESTAMP}
+                                           ELSE finished_at END
+                    WHERE id = %s""",
+                (last_user_id, sent, failed, blocked, status, status, broadcast_id)
+            )
+
+    @timed_db("lifecycle_phases")
+    def lifecycle_phases(self):
+        return dict(self._fetchall("SELECT email, phase FROM client_lifecycle"))
+
+    @timed_db("save_lifecycle_phases")
+    def save_lifecycle_phases(self, phases):
+        with self._pool.connection() as conn, conn.cursor() as cursor:
+            cursor.executemany(
+                f"""INSERT INTO client_lifecycle (email, phase) VALUES (%s, %s)
+                    ON CONFLICT (email) DO UPDATE SET phase = excluded.phase, updated_at = {PG_TIMESTAMP}""",
+                [(email, phase) for email, phase in phases.items() if phase is not None]
+            )
+            cursor.execute(
+                "DELETE FROM client_lifecycle WHERE email = ANY(%s)",
+                ([email for email, phase in phases.items() if phase is None],)
+            )
+
+    @timed_db("spare_client_count")
+    def spare_client_count(self):
+        return self._fetchone("SELECT COUNT(*) FROM spare_clients")[0]
+
+    @timed_db("spare_client_ids")
+    def spare_client_ids(self):
+        return {row[0] for row in self._fetchall("SELECT client_id FROM spare_clients")}
+
+    @timed_db("add_spare_clients")
+    def add_spare_clients(self, spares):
+        with self._pool.connection() as conn, conn.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO spare_clients (client_id, email, panel, inbound_id) VALUES (%s, %s, %s, %s)",
+                [(spare.client_id, spare.email, spare.panel, spare.inbound_id) for spare in spares]
+            )
+
+    @timed_db("take_spare_client")
+    def take_spare_client(self, panels):
+        # SKIP LOCKED: параллельные регистрации на разных репликах получают разных клиентов без ожидания
+        row = self._fetchone(
+            f"""DELETE FROM spare_clients
+                WHERE client_id = (SELECT client_id FROM spare_clients WHERE panel = ANY(%s)
+                                   ORDER BY created_at, client_id LIMIT 1 FOR UPDATE SKIP LOCKED)
+                RETURNING {SPARE_COLUMNS}""",
+            (list(panels),)
+        )
+        return SpareClient(*row) if row else None
+
+    @timed_db("acquire_lease")
+    def acquire_lease(self, name, owner, ttl):
+        row = self._fetchone(
+            f"""INSERT INTO leases (name, owner, expires_at) VALUES (%s, %s, {PG_NOW} + %s)
+                ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < {PG_NOW}
+                RETURNING name""",
+            (name, owner, ttl)
+        )
+        return row is not None
+
+    @timed_db("release_lease")
+    def release_lease(self, name, owner):
+        with self._pool.connection() as conn:
+            conn.execute("DELETE FROM leases WHERE name = %s AND owner = %s", (name, owner))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
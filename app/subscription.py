@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import re
+import time
+from dataclasses import dataclass
+
+import httpx
+
+from cache import TTLCache
+from concurrency import SingleFlight
+from http_endpoint import HTTPResponse, LocalHTTPServer
+from metrics import REGISTRY, register_cache
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION_PATH = re.compile(r"^/sub/(\d+)/([0-9A-Za-z-]{1,64})$")
+
+# Заголовки ответа панели, которые читают клиенты подписок (V2RayN, V2RayNG, Shadowrocket)
+FORWARDED_HEADERS = (
+    "content-type",
+    "content-disposition",
+    "subscription-userinfo",
+    "profile-update-interval",
+    "profile-title",
+    "profile-web-page-url",
+    "support-url",
+)
+
+SUBSCRIPTION_REQUESTS = REGISTRY.counter(
+    "vpnbot_subscription_requests_total", "Запросы к прокси подписок по результату", ("result",))
+
+
+@dataclass(frozen=True, slots=True)
+class SubscriptionEntry:
+    """Тело подписки из панели с заголовками и ETag"""
+    body: bytes
+    headers: tuple
+    etag: str
+    fetched_at: float
+
+
+class SubscriptionProxy(LocalHTTPServer):
+    """Кэширующий прокси ссылок подписки /sub/{inbound_id}/{client_id}
+
+    Тела подписок хранятся в кэше по UUID клиента: в течение ttl секунд
+    они отдаются без запросов к панели, после - перезапрашиваются, а при
+    ошибке панели отдается устаревшая копия (до stale_ttl секунд).
+    Параллельные промахи по одному клиенту объединяются в один запрос.
+    Клиенты с совпадающим If-None-Match получают 304. resolve(client_id)
+    возвращает URL подписки в панели или None для неизвестных клиентов,
+    поэтому прокси не пересылает в панель произвольные запросы.
+    """
+
+    def __init__(self, host, port, resolve, ttl=300, stale_ttl=86400, max_size=100000, negative_ttl=60,
+                 timeout=10):
+        super().__init__("Прокси подписок", host, port, self._handle)
+        self.ttl = ttl
+        self._resolve = resolve
+        self._timeout = timeout
+        self.cache = TTLCache(max_size, stale_ttl, negative_ttl)
+        self._flight = SingleFlight()
+        self._client = None
+        register_cache("subscriptions", self.cache)
+
+    async def start(self):
+        # Панели часто работают с самоподписанными сертификатами, как и в XUISession
+        self._client = httpx.AsyncClient(timeout=self._timeout, verify=False)
+        await super().start()
+
+    async def stop(self):
+        await super().stop()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def invalidate(self, client_id):
+        """Сброс подписки клиента после его изменения ботом; безопасно из любого потока"""
+        self.cache.invalidate(str(client_id))
+
+    async def _handle(self, method, path, headers):
+        match = SUBSCRIPTION_PATH.match(path.split('?', 1)[0])
+        if not match:
+            return HTTPResponse(404, b"Not Found")
+        client_id = match.group(2)
+
+        found, entry = self.cache.get(client_id)
+        if not found or (entry is not None and time.monotonic() - entry.fetched_at >= self.ttl):
+            try:
+                entry = await self._flight.run(client_id, self._refresh, client_id, entry if found else None)
+            except Exception:
+                return HTTPResponse(502, b"Bad Gateway")
+        else:
+            SUBSCRIPTION_REQUESTS.inc(result="hit")
+
+        if entry is None:
+            return HTTPResponse(404, b"Not Found")
+        if headers.get("if-none-match") == entry.etag:
+            SUBSCRIPTION_REQUESTS.inc(result="not_modified")
+            return HTTPResponse(304, b"", {"ETag": entry.etag})
+        return HTTPResponse(200, entry.body, {**dict(entry.headers), "ETag": entry.etag,
+                                              "Cache-Control": f"max-age={self.ttl}"})
+
+    async def _refresh(self, client_id, stale):
+        """Запрос подписки из панели; при ошибке - устаревшая копия, если она есть"""
+        version = self.cache.version
+        try:
+            url = await self._resolve(client_id)
+            if url is None:
+                SUBSCRIPTION_REQUESTS.inc(result="unknown")
+                self.cache.fill(client_id, None, version)
+                return None
+            response = await self._client.get(url)
+            if response.status_code == 404:
+                SUBSCRIPTION_REQUESTS.inc(result="unknown")
+                self.cache.fill(client_id, None, version)
+                return None
+            response.raise_for_status()
+        except Exception as e:
+            if stale is not None:
+                SUBSCRIPTION_REQUESTS.inc(result="stale")
+                logger.warning(f"⚠️ Панель не отдала подписку {client_id}, отдаем кэш: {e}")
+                return stale
+            SUBSCRIPTION_REQUESTS.inc(result="error")
+            logger.error(f"❌ Не удалось получить подписку {client_id}: {e}")
+            raise
+
+        body = response.content
+        entry = SubscriptionEntry(
+            body=body,
+            headers=tuple((name, response.headers[name]) for name in FORWARDED_HEADERS if name in response.headers),
+            etag=f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"',
+            fetched_at=time.monotonic()
+        )
+        self.cache.fill(client_id, entry, version)
+        SUBSCRIPTION_REQUESTS.inc(result="miss")
+        return entry
@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+
+import httpx
+from telegram.error import BadRequest, TelegramError
+from telegram.request import HTTPXRequest
+
+from cache import TTLCache
+from metrics import REGISTRY, register_cache
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_EDITS = REGISTRY.counter(
+    "vpnbot_message_edits_total", "Правки сообщений бота по результату", ("result",))
+
+
+def build_request(pool_size, connect_timeout, read_timeout, write_timeout, pool_timeout):
+    """HTTPXRequest для Bot API с постоянными соединениями всего пула
+
+    HTTPXRequest ограничивает только общее число соединений, а httpx по
+    умолчанию держит открытыми не больше 20: при большей параллельности
+    (обработчики, рассылка, уведомления) лишние соединения закрываются
+    после каждого запроса и открываются заново с TLS-рукопожатием.
+    """
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        write_timeout=write_timeout,
+        pool_timeout=pool_timeout,
+        httpx_kwargs={"limits": httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)}
+    )
+
+
+class MessageEditor:
+    """Правка сообщений с пропуском правок, не меняющих содержимое
+
+    Для каждого сообщения хранится хэш последнего отправленного текста,
+    режима разметки и клавиатуры. Повторное нажатие кнопки с тем же
+    результатом (например, статус без изменений) не вызывает Bot API, а
+    ответ "message is not modified" для сообщений, чей хэш еще не известен
+    (например, после перезапуска), ошибкой не считается.
+    """
+
+    def __init__(self, max_size=100000, ttl=86400):
+        self._hashes = TTLCache(max_size, ttl)
+        register_cache("message_edits", self._hashes)
+
+    @staticmethod
+    def _digest(text, parse_mode, reply_markup):
+        markup = reply_markup.to_json() if reply_markup is not None else ""
+        return hashlib.blake2b(f"{parse_mode}\0{markup}\0{text}".encode(), digest_size=16).digest()
+
+    async def edit(self, query, text, parse_mode=None, reply_markup=None):
+        """Правка сообщения кнопки; возвращает False, если содержимое не изменилось"""
+        message = query.message
+        key = (message.chat_id, message.message_id) if message is not None else None
+        digest = self._digest(text, parse_mode, reply_markup)
+        if key is not None and self._hashes.get(key) == (True, digest):
+            MESSAGE_EDITS.inc(result="skipped")
+            return False
+
+        try:
+            await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+            MESSAGE_EDITS.inc(result="edited")
+            changed = True
+        except BadRequest as e:
+            if "message is not modified" not in str(e).lower():
+                raise
+            MESSAGE_EDITS.inc(result="not_modified")
+            changed = False
+        if key is not None:
+            self._hashes.put(key, digest)
+        return changed
+
+
+@asynccontextmanager
+async def answering(query):
+    """Ответ на нажатие кнопки параллельно с его обработкой
+
+    answer() только убирает индикатор загрузки у кнопки, поэтому запрос
+    отправляется сразу, а обработка не ждет его ответа. Ошибки answer()
+    (например, устаревшее нажатие) на обработку не влияют.
+    """
+    task = asyncio.create_task(query.answer())
+    try:
+        yield
+    finally:
+        try:
+            await task
+        except TelegramError as e:
+            logger.debug(f"Не удалось ответить на нажатие кнопки: {e}")
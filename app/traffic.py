@@ -0,0 +1,97 @@
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class TrafficUsage:
+    """Счетчики трафика клиента на момент снимка"""
+    client_id: str | None
+    email: str
+    inbound_id: int
+    panel: str
+    up: int
+    down: int
+    total: int
+    expiry_time: int
+    enable: bool
+
+    @property
+    def used(self):
+        return self.up + self.down
+
+    @property
+    def remaining(self):
+        """Остаток трафика в байтах; None, если лимита нет"""
+        if not self.total:
+            return None
+        return max(self.total - self.used, 0)
+
+
+class TrafficSnapshot:
+    """Снимок трафика всех клиентов панели
+
+    Заполняется фоновой выгрузкой инбаундов, поэтому статус пользователя
+    читается из памяти без запросов к панели.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_client_id = {}
+        self._by_email = {}
+        self.updated_at = None
+
+    def load(self, inbounds_by_panel):
+        """Замена снимка данными из выгрузки инбаундов {панель: инбаунды}"""
+        by_client_id, by_email = {}, {}
+        for panel, inbounds in inbounds_by_panel.items():
+            for inbound in inbounds:
+                for usage in self._inbound_usage(panel, inbound):
+                    by_email[usage.email] = usage
+                    if usage.client_id:
+                        by_client_id[usage.client_id] = usage
+
+        with self._lock:
+            self._by_client_id = by_client_id
+            self._by_email = by_email
+            self.updated_at = datetime.now()
+
+        logger.info(f"📈 Снимок трафика обновлен: {len(by_email)} клиентов")
+
+    @staticmethod
+    def _inbound_usage(panel, inbound):
+        client_ids = {
+            client.email.lower(): str(client.id)
+            for client in inbound.settings.clients or []
+            if client.email
+        }
+        for stats in inbound.client_stats or []:
+            if not stats.email:
+                continue
+            email = stats.email.lower()
+            yield TrafficUsage(
+                client_id=client_ids.get(email),
+                email=email,
+                inbound_id=inbound.id,
+                panel=panel,
+                up=stats.up,
+                down=stats.down,
+                total=stats.total,
+                expiry_time=stats.expiry_time,
+                enable=stats.enable
+            )
+
+    def get(self, client_id=None, email=None):
+        """Поиск счетчиков клиента по UUID или email"""
+        usage = self._by_client_id.get(str(client_id)) if client_id else None
+        if usage is None and email:
+            usage = self._by_email.get(email.lower())
+        return usage
+
+
+def format_bytes(value):
+    """Форматирование объема трафика в GB"""
+    return f"{value / 1073741824:.2f} GB"
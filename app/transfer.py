@@ -0,0 +1,250 @@
+import csv
+import json
+import logging
+import os
+from collections import Counter, defaultdict
+from dataclasses import asdict, fields
+from pathlib import Path
+
+from client_index import ClientRecord
+from panel import PanelUnavailable
+from provisioning import add_clients_with_fallback
+from storage import UserRow
+
+logger = logging.getLogger(__name__)
+
+USER_FIELDS = tuple(field.name for field in fields(UserRow))
+# Состояние клиента в панели при экспорте с --with-panel
+PANEL_FIELDS = ("panel_found", "enable", "up", "down", "total", "expiry_time")
+
+FORMATS = ("jsonl", "csv")
+INT_FIELDS = ("telegram_id", "inbound_id")
+
+
+def detect_format(path, fmt=None):
+    """Формат файла: явно заданный или по расширению (.csv - CSV, иначе JSONL)"""
+    if fmt:
+        return fmt
+    return "csv" if str(path).lower().endswith(".csv") else "jsonl"
+
+
+# ========== ЭКСПОРТ ==========
+
+def _panel_state(user, index, traffic):
+    record = index.by_client_id(user.xui_client_id) if user.xui_client_id else None
+    usage = traffic.get(user.xui_client_id, user.email) if traffic else None
+    return {
+        "panel_found": record is not None,
+        "enable": usage.enable if usage else None,
+        "up": usage.up if usage else None,
+        "down": usage.down if usage else None,
+        "total": usage.total if usage else None,
+        "expiry_time": usage.expiry_time if usage else None,
+    }
+
+
+def export_users(users, output, fmt="jsonl", index=None, traffic=None):
+    """Потоковая выгрузка пользователей в JSONL или CSV; возвращает число строк
+
+    users - итератор UserRow (например, UserStorage.iter_users), поэтому
+    память не зависит от размера таблицы. С index (и traffic) к строкам
+    добавляется состояние клиента в панели.
+    """
+    columns = USER_FIELDS + (PANEL_FIELDS if index is not None else ())
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(output, fieldnames=columns)
+        writer.writeheader()
+
+    count = 0
+    for user in users:
+        row = asdict(user)
+        if index is not None:
+            row.update(_panel_state(user, index, traffic))
+        if writer:
+            writer.writerow(row)
+        else:
+            output.write(json.dumps(row, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+# ========== ИМПОРТ ==========
+
+def _normalize(record):
+    """Приведение типов записи из JSONL/CSV: пустые строки - None, ID - целые"""
+    result = {}
+    for name in USER_FIELDS:
+        value = record.get(name)
+        if value == "":
+            value = None
+        if value is not None and name in INT_FIELDS:
+            value = int(value)
+        result[name] = value
+    if result["telegram_id"] is None:
+        raise ValueError("нет telegram_id")
+    return result
+
+
+def read_users(path, fmt="jsonl"):
+    """Потоковое чтение записей: пары (номер записи, словарь полей users)"""
+    with open(path, newline="", encoding="utf-8") as source:
+        if fmt == "csv":
+            records = csv.DictReader(source)
+        else:
+            records = (json.loads(line) for line in source if line.strip())
+        for position, record in enumerate(records, start=1):
+            try:
+                yield position, _normalize(record)
+            except (ValueError, TypeError) as e:
+                logger.error(f"❌ Запись #{position} пропущена: {e}")
+
+
+class ImportProgress:
+    """Номер последней записи, импортированной целиком, для продолжения после сбоя"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def load(self):
+        try:
+            return json.loads(self.path.read_text())["position"]
+        except FileNotFoundError:
+            return 0
+
+    def save(self, position):
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp.write_text(json.dumps({"position": position}))
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+
+
+class UserImporter:
+    """Пакетный импорт пользователей с созданием недостающих клиентов в панели
+
+    Записи обрабатываются пачками по batch_size: клиенты, уже известные
+    индексу панели (по UUID, email или Telegram ID), переиспользуются, остальные
+    размещаются по инбаундам и добавляются одним client.add на инбаунд.
+    Строки пачки пишутся в базу одной транзакцией, после чего сохраняется
+    прогресс. Повторный запуск продолжает с первой незавершенной пачки;
+    уже импортированные Telegram ID и созданные клиенты не дублируются.
+    """
+
+    def __init__(self, store, index, placement, add_clients, ensure_inbound, subscription_url, make_client,
+                 batch_size=500):
+        self.store = store
+        self.index = index
+        self.placement = placement
+        self._add_clients = add_clients
+        self._ensure_inbound = ensure_inbound
+        self._subscription_url = subscription_url
+        self._make_client = make_client
+        self.batch_size = batch_size
+        self.stats = Counter()
+
+    def run(self, records, progress):
+        """Импорт записей (номер, поля) с сохранением прогресса после каждой пачки"""
+        start = progress.load()
+        if start:
+            logger.info(f"⏩ Продолжаем импорт после записи #{start}")
+
+        batch = []
+        for position, record in records:
+            if position <= start:
+                continue
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                self._import_batch(batch)
+                progress.save(position)
+                batch = []
+        if batch:
+            self._import_batch(batch)
+        progress.clear()
+        return self.stats
+
+    def _import_batch(self, batch):
+        existing = self.store.existing_telegram_ids(record["telegram_id"] for record in batch)
+        users = []
+        pending = Counter()
+        groups = defaultdict(list)
+
+        for record in batch:
+            telegram_id = record["telegram_id"]
+            if telegram_id in existing:
+                self.stats["skipped"] += 1
+                continue
+            existing.add(telegram_id)
+
+            client = self._make_client(record)
+            found = self._find_client(record, client)
+            if found is not None:
+                if found.telegram_id not in (None, telegram_id):
+                    logger.error(f"❌ Клиент {found.email} принадлежит Telegram ID {found.telegram_id}, "
+                                 f"запись {telegram_id} пропущена")
+                    self.stats["failed"] += 1
+                    continue
+                users.append(self._user(record, found.client_id, found.email, found.panel, found.inbound_id))
+                self.stats["reused"] += 1
+                continue
+
+            target = self.placement.choose(lambda panel, inbound_id: self.index.count(panel, inbound_id)
+                                           + pending[(panel, inbound_id)])
+            inbound_id = self._ensure_inbound(target) if target else None
+            if not inbound_id:
+                if not self.placement.available:
+                    raise PanelUnavailable("Панели 3x-ui недоступны, импорт остановлен")
+                raise RuntimeError("Нет инбаунда для размещения новых клиентов")
+            shard_key = (target.panel.name, inbound_id)
+            pending[shard_key] += 1
+            groups[shard_key].append((record, client))
+
+        for shard_key, items in groups.items():
+            errors = add_clients_with_fallback(self._add_clients, shard_key, [client for _, client in items])
+            if any(isinstance(error, PanelUnavailable) for error in errors):
+                # Пачка не завершена: при повторном запуске она будет обработана заново
+                raise PanelUnavailable("Панель 3x-ui стала недоступна, импорт остановлен")
+            panel_name, inbound_id = shard_key
+            for (record, client), error in zip(items, errors):
+                if error is not None:
+                    self.stats["failed"] += 1
+                    continue
+                client_id = str(client.id)
+                self.index.add(ClientRecord(client_id, client.email, inbound_id, record["telegram_id"], panel_name))
+                users.append(self._user(record, client_id, client.email, panel_name, inbound_id))
+                self.stats["provisioned"] += 1
+
+        self.stats["added"] += self.store.add_users(users)
+        logger.info(f"📥 Пачка из {len(batch)} записей импортирована: {dict(self.stats)}")
+
+    def _find_client(self, record, client):
+        """Клиент панели для записи: по UUID и email из записи, затем по Telegram ID
+        и email, с которым импорт создал бы клиента
+
+        Без последних двух проверок повторный запуск после сбоя между
+        client.add и записью пачки в базу создал бы клиентов второй раз.
+        """
+        if record["xui_client_id"]:
+            found = self.index.by_client_id(record["xui_client_id"])
+            if found:
+                return found
+        if record["email"]:
+            found = self.index.by_email(record["email"])
+            if found:
+                return found
+        return self.index.by_telegram_id(record["telegram_id"]) or self.index.by_email(client.email)
+
+    def _user(self, record, client_id, email, panel, inbound_id):
+        return {
+            "telegram_id": record["telegram_id"],
+            "username": record["username"],
+            "full_name": record["full_name"],
+            "language_code": record["language_code"],
+            "subscription_url": self._subscription_url(client_id, inbound_id, panel),
+            "xui_client_id": client_id,
+            "email": email,
+            "panel": panel,
+            "inbound_id": inbound_id,
+            "created_at": record["created_at"],
+        }
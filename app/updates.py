@@ -0,0 +1,77 @@
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя
+
+    Обновления разных пользователей обрабатываются одновременно (не более
+    max_concurrent_updates), обновления одного пользователя - строго по очереди.
+    Базовый класс занимает свое место до do_process_update, поэтому ему
+    передается лимит принятых обновлений max_pending (включая ждущих своей
+    очереди), а места для обработки выдаются в do_process_update после
+    очереди пользователя: иначе обновления, ждущие предыдущих обновлений
+    того же пользователя, держали бы места и задерживали остальных.
+    """
+
+    def __init__(self, max_concurrent_updates, drain_timeout=30, max_pending=10000):
+        super().__init__(max(max_pending, max_concurrent_updates))
+        self.concurrency = max_concurrent_updates
+        self.drain_timeout = drain_timeout
+        # Места для обработки занимаются только обновлениями, дождавшимися своей очереди
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # Блокировки пользователей и число ожидающих их обновлений
+        self._user_locks = {}
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @staticmethod
+    def _ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        """Сначала очередь пользователя, затем место из max_concurrent_updates"""
+        self._idle.clear()
+        try:
+            key = self._ordering_key(update)
+            if key is None:
+                async with self._slots:
+                    await coroutine
+                return
+
+            entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0], self._slots:
+                    await coroutine
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._user_locks[key]
+        finally:
+            # Место базового класса еще занято этим обновлением
+            if self.current_concurrent_updates <= 1:
+                self._idle.set()
+
+    async def initialize(self):
+        logger.info(f"⚙️ Параллельная обработка обновлений: до {self.concurrency}, порядок сохраняется для каждого пользователя")
+
+    async def shutdown(self):
+        """Ожидание обработки уже принятых обновлений"""
+        if self.current_concurrent_updates:
+            logger.info(f"⏳ Завершаем обработку {self.current_concurrent_updates} обновлений...")
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Не дождались завершения {self.current_concurrent_updates} обновлений "
+                           f"за {self.drain_timeout} с")
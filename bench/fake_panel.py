@@ -0,0 +1,403 @@
+"""Локальная замена HTTP API панели 3x-ui для нагрузочных тестов
+
+Реализует эндпоинты, которыми пользуется бот через py3xui: логин,
+список и получение инбаундов, создание и перезапись инбаунда, добавление
+и изменение клиентов и сброс их трафика, а также ссылки подписки /sub/{инбаунд}/{UUID}.
+Размер инбаундов, число клиентов и задержка ответа настраиваются.
+
+Запуск отдельно: python bench/fake_panel.py --port 2053 --clients 20000
+"""
+import argparse
+import base64
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SESSION_COOKIE = "3x-ui"
+CSRF_TOKEN = "bench-csrf-token"
+
+
+def _client(email, telegram_id=""):
+    return {
+        "id": str(uuid.uuid4()),
+        "email": email,
+        "enable": True,
+        "flow": "",
+        "limitIp": 0,
+        "totalGB": 10 * 1073741824,
+        "expiryTime": 0,
+        "tgId": telegram_id,
+        "subId": uuid.uuid4().hex[:16],
+        "reset": 0
+    }
+
+
+def _client_stats(inbound_id, client):
+    return {
+        "id": 0,
+        "inboundId": inbound_id,
+        "enable": True,
+        "email": client["email"],
+        "up": 1048576,
+        "down": 5242880,
+        "expiryTime": 0,
+        "total": client.get("totalGB", 0),
+        "reset": 0
+    }
+
+
+class FakePanelState:
+    """Инбаунды, клиенты и счетчики запросов фейковой панели"""
+
+    def __init__(self, inbounds=1, clients_per_inbound=0, base_port=5622):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.sessions = set()
+        self.inbounds = {}
+        self._next_id = 1
+        for index in range(inbounds):
+            inbound = self._add_inbound(base_port + index, f"Bench inbound {index + 1}")
+            for number in range(clients_per_inbound):
+                # Существующие клиенты не связаны с пользователями бенчмарка
+                email = f"existing{inbound['id']}-{number}@bench.vpn"
+                self._append_client(inbound, _client(email))
+
+    def _add_inbound(self, port, remark, settings=None, stream_settings=None, sniffing=None):
+        inbound = {
+            "id": self._next_id,
+            "up": 0,
+            "down": 0,
+            "total": 0,
+            "remark": remark,
+            "enable": True,
+            "expiryTime": 0,
+            "listen": "",
+            "port": port,
+            "protocol": "vless",
+            "tag": f"inbound-{port}",
+            "clients": [],
+            "clientStats": [],
+            "settings_extra": json.loads(settings) if settings else {"decryption": "none", "fallbacks": []},
+            "streamSettings": stream_settings or json.dumps(
+                {"network": "tcp", "security": "none", "tcpSettings": {"header": {"type": "none"}}}),
+            "sniffing": sniffing or json.dumps({"enabled": True, "destOverride": ["http", "tls"]})
+        }
+        inbound["settings_extra"].pop("clients", None)
+        self.inbounds[inbound["id"]] = inbound
+        self._next_id += 1
+        return inbound
+
+    def _append_client(self, inbound, client):
+        inbound["clients"].append(client)
+        inbound["clientStats"].append(_client_stats(inbound["id"], client))
+
+    @staticmethod
+    def render(inbound):
+        """Инбаунд в формате ответа 3x-ui (settings - JSON строкой)"""
+        settings = {**inbound["settings_extra"], "clients": inbound["clients"]}
+        result = {key: value for key, value in inbound.items() if key not in ("clients", "settings_extra")}
+        result["settings"] = json.dumps(settings)
+        return result
+
+    def list_inbounds(self):
+        with self.lock:
+            return [self.render(inbound) for inbound in self.inbounds.values()]
+
+    def get_inbound(self, inbound_id):
+        with self.lock:
+            inbound = self.inbounds.get(inbound_id)
+            return self.render(inbound) if inbound else None
+
+    def add_inbound(self, data):
+        with self.lock:
+            self._add_inbound(
+                int(data["port"]), data.get("remark", ""),
+                data.get("settings"), data.get("streamSettings"), data.get("sniffing")
+            )
+
+    def add_clients(self, inbound_id, clients):
+        """Добавление клиентов; как и 3x-ui, отклоняет всю пачку при дубликате email"""
+        with self.lock:
+            inbound = self.inbounds.get(inbound_id)
+            if inbound is None:
+                return "Inbound Not Found"
+            emails = {client["email"].lower() for inbound in self.inbounds.values() for client in inbound["clients"]}
+            for client in clients:
+                if client["email"].lower() in emails:
+                    return f"Duplicate email: {client['email']}"
+                emails.add(client["email"].lower())
+            for client in clients:
+                self._append_client(inbound, client)
+            return None
+
+    def update_inbound(self, inbound_id, data):
+        """Перезапись инбаунда; как и 3x-ui, сохраняет трафик оставшихся клиентов"""
+        with self.lock:
+            inbound = self.inbounds.get(inbound_id)
+            if inbound is None:
+                return "Inbound Not Found"
+            settings = json.loads(data["settings"])
+            stats = {item["email"].lower(): item for item in inbound["clientStats"]}
+            inbound["clients"], inbound["clientStats"] = [], []
+            for client in settings.pop("clients", []):
+                self._append_client(inbound, client)
+                item = inbound["clientStats"][-1]
+                previous = stats.get(client["email"].lower())
+                if previous:
+                    item["up"], item["down"] = previous["up"], previous["down"]
+                item["enable"] = client.get("enable", True)
+                item["expiryTime"] = client.get("expiryTime", 0)
+            inbound["settings_extra"] = settings
+            return None
+
+    def update_client(self, inbound_id, client_id, client):
+        """Замена клиента по UUID; статистика переходит на новый email, как в 3x-ui"""
+        with self.lock:
+            inbound = self.inbounds.get(inbound_id)
+            if inbound is None:
+                return "Inbound Not Found"
+            for index, existing in enumerate(inbound["clients"]):
+                if existing["id"] == client_id:
+                    break
+            else:
+                return "Client Not Found"
+            email = client["email"].lower()
+            for other in self.inbounds.values():
+                for item in other["clients"]:
+                    if item["id"] != client_id and item["email"].lower() == email:
+                        return f"Duplicate email: {client['email']}"
+            stats = inbound["clientStats"][index]
+            stats["email"], stats["enable"] = client["email"], client.get("enable", False)
+            inbound["clients"][index] = {**existing, **client}
+            return None
+
+    def reset_client_traffic(self, inbound_id, email):
+        with self.lock:
+            inbound = self.inbounds.get(inbound_id)
+            if inbound is None:
+                return "Inbound Not Found"
+            for item in inbound["clientStats"]:
+                if item["email"].lower() == email.lower():
+                    item["up"] = item["down"] = 0
+            return None
+
+    def subscription(self, inbound_id, client_id):
+        """Тело подписки клиента (base64 со ссылкой vless://) или None"""
+        with self.lock:
+            inbound = self.inbounds.get(inbound_id)
+            for client in inbound["clients"] if inbound else []:
+                if client["id"] == client_id:
+                    link = f"vless://{client_id}@127.0.0.1:{inbound['port']}?type=tcp#{client['email']}"
+                    return base64.b64encode(link.encode())
+            return None
+
+    def client_count(self):
+        with self.lock:
+            return sum(len(inbound["clients"]) for inbound in self.inbounds.values())
+
+
+class FakePanelHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Заголовки и тело уходят разными send(): без TCP_NODELAY алгоритм Нейгла и отложенный ACK
+    # клиента добавляют ~40 мс к каждому ответу на keep-alive соединении. 3x-ui (Go) так не делает
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def panel(self):
+        return self.server.panel
+
+    def _send(self, payload, status=200, cookie=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if cookie:
+            self.send_header("Set-Cookie", f"{SESSION_COOKIE}={cookie}; Path=/")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _ok(self, obj=None, msg=""):
+        self._send({"success": True, "msg": msg, "obj": obj})
+
+    def _fail(self, msg):
+        self._send({"success": False, "msg": msg, "obj": None})
+
+    def _subscription(self, inbound_id, client_id):
+        body = self.panel.state.subscription(inbound_id, client_id)
+        if body is None:
+            return self._send({}, status=404)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Subscription-Userinfo", "upload=0; download=0; total=0; expire=0")
+        self.send_header("Profile-Update-Interval", "12")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        cookies = self.headers.get("Cookie", "")
+        match = re.search(rf"{re.escape(SESSION_COOKIE)}=([^;]+)", cookies)
+        return bool(match) and match.group(1) in self.panel.state.sessions
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def _drop_if_down(self):
+        """Имитация недоступной панели: соединение закрывается без ответа"""
+        if self.panel.down:
+            self.close_connection = True
+            return True
+        return False
+
+    def _begin(self, operation):
+        self.panel.count(operation)
+        if self.panel.latency:
+            time.sleep(self.panel.latency)
+
+    def do_GET(self):
+        if self._drop_if_down():
+            return
+        path = self.path.split("?", 1)[0].strip("/")
+        state = self.panel.state
+
+        if path == "csrf-token":
+            return self._ok(CSRF_TOKEN)
+
+        match = re.fullmatch(r"sub/(\d+)/([0-9A-Za-z-]+)", path)
+        if match:
+            # Ссылки подписки открываются клиентами без сессии панели
+            self._begin("subscription")
+            return self._subscription(int(match.group(1)), match.group(2))
+        if not self._authorized():
+            # Так 3x-ui отвечает на запросы без сессии
+            return self._send({}, status=404)
+
+        if path == "panel/api/inbounds/list":
+            self._begin("inbound.get_list")
+            return self._ok(state.list_inbounds())
+
+        match = re.fullmatch(r"panel/api/inbounds/get/(\d+)", path)
+        if match:
+            self._begin("inbound.get_by_id")
+            inbound = state.get_inbound(int(match.group(1)))
+            return self._ok(inbound) if inbound else self._fail("Inbound Not Found")
+
+        self._send({}, status=404)
+
+    def do_POST(self):
+        if self._drop_if_down():
+            return
+        path = self.path.split("?", 1)[0].strip("/")
+        data = self._read_json()
+        state = self.panel.state
+
+        if path == "login":
+            self._begin("login")
+            session = uuid.uuid4().hex
+            with state.lock:
+                state.sessions.add(session)
+            return self._send({"success": True, "msg": "", "obj": None}, cookie=session)
+        if not self._authorized():
+            return self._send({}, status=404)
+
+        if path == "panel/api/inbounds/add":
+            self._begin("inbound.add")
+            state.add_inbound(data)
+            return self._ok()
+
+        if path == "panel/api/inbounds/addClient":
+            self._begin("client.add")
+            clients = json.loads(data["settings"])["clients"]
+            error = state.add_clients(int(data["id"]), clients)
+            return self._fail(error) if error else self._ok()
+
+        match = re.fullmatch(r"panel/api/inbounds/update/(\d+)", path)
+        if match:
+            self._begin("inbound.update")
+            error = state.update_inbound(int(match.group(1)), data)
+            return self._fail(error) if error else self._ok()
+
+        match = re.fullmatch(r"panel/api/inbounds/updateClient/(.+)", path)
+        if match:
+            self._begin("client.update")
+            client = json.loads(data["settings"])["clients"][0]
+            error = state.update_client(int(data["id"]), match.group(1), client)
+            return self._fail(error) if error else self._ok()
+
+        match = re.fullmatch(r"panel/api/inbounds/(\d+)/resetClientTraffic/(.+)", path)
+        if match:
+            self._begin("client.reset_stats")
+            error = state.reset_client_traffic(int(match.group(1)), match.group(2))
+            return self._fail(error) if error else self._ok()
+
+        self._send({}, status=404)
+
+
+class FakePanel:
+    """Фейковая панель 3x-ui на локальном порту"""
+
+    def __init__(self, inbounds=1, clients_per_inbound=0, latency=0.0, host="127.0.0.1", port=0, base_port=5622):
+        self.state = FakePanelState(inbounds, clients_per_inbound, base_port)
+        self.latency = latency
+        # Включенный флаг имитирует падение панели
+        self.down = False
+        self._server = ThreadingHTTPServer((host, port), FakePanelHandler)
+        self._server.daemon_threads = True
+        self._server.panel = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, operation):
+        with self.state.lock:
+            self.state.calls[operation] += 1
+
+    def reset_counters(self):
+        with self.state.lock:
+            self.state.calls.clear()
+
+    def calls(self):
+        with self.state.lock:
+            return dict(self.state.calls)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-panel", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковая панель 3x-ui")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2053)
+    parser.add_argument("--inbounds", type=int, default=1, help="число инбаундов")
+    parser.add_argument("--clients", type=int, default=0, help="клиентов в каждом инбаунде")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка каждого ответа")
+    args = parser.parse_args()
+
+    panel = FakePanel(args.inbounds, args.clients, args.latency_ms / 1000, args.host, args.port)
+    print(f"Фейковая панель 3x-ui: {panel.url}")
+    try:
+        panel._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""Нагрузочный тест бота на фейковой панели 3x-ui
+
+Поднимает локальную панель (bench/fake_panel.py), импортирует бота с
+временной базой и вызывает обработчики register_user, show_status и
+status_command синтетическими обновлениями Telegram с заданной
+параллельностью. Результаты сохраняются в bench/results/ с хэшем коммита,
+чтобы сравнивать прогоны между коммитами (--compare).
+
+Пример: python bench/loadtest.py --users 2000 --concurrency 100 --clients 20000 --latency-ms 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+BENCH_DIR = Path(__file__).resolve().parent
+APP_DIR = BENCH_DIR.parent / "app"
+RESULTS_DIR = BENCH_DIR / "results"
+
+sys.path.insert(0, str(APP_DIR))
+
+from fake_panel import FakePanel  # noqa: E402
+
+# Первый синтетический Telegram ID, чтобы не пересекаться с клиентами панели
+FIRST_USER_ID = 7_000_000_000
+
+
+# ========== СИНТЕТИЧЕСКИЕ ОБНОВЛЕНИЯ ==========
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"bench{user_id}"
+        self.first_name = "Bench"
+        self.full_name = f"Bench User {user_id}"
+        self.language_code = "ru"
+
+
+class FakeMessage:
+    """Сообщение, ответы которого только подсчитываются"""
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeCallbackQuery:
+    def __init__(self, user, data):
+        self.from_user = user
+        self.data = data
+        # Сообщение с кнопками: одно на пользователя, как при повторных нажатиях
+        self.message = SimpleNamespace(chat_id=user.id, message_id=1)
+        self.edits = []
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+class FakeUpdate:
+    def __init__(self, user):
+        self.effective_user = user
+        self.message = FakeMessage()
+
+
+# ========== ПРОГОН ==========
+
+def percentile(values, fraction):
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def import_bot(panel_url, data_dir, args):
+    """Импорт бота с настройками на фейковую панель и временную базу"""
+    os.environ.update({
+        'BOT_TOKEN': '1:bench',
+        'XUI_PANEL_URL': panel_url,
+        'XUI_USERNAME': 'bench',
+        'XUI_PASSWORD': 'bench',
+        'DATA_DIR': str(data_dir),
+        'INBOUND_ID': '1',
+        'BOT_MODE': 'polling',
+        'METRICS_PORT': '0',
+        'PANEL_WORKERS': str(args.panel_workers),
+        'DB_WORKERS': str(args.db_workers),
+        'CLIENT_POOL_SIZE': str(args.client_pool),
+    })
+    # Лимиты частоты бота ограничили бы саму нагрузку; их можно вернуть через окружение
+    for name in ('REGISTER_USER_RATE', 'REGISTER_GLOBAL_RATE', 'PANEL_QUEUE_LIMIT'):
+        os.environ.setdefault(name, '0')
+    import bot
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    return bot
+
+
+async def run_registrations(bot, user_ids, concurrency, rate=0):
+    """Регистрации пачкой (rate=0) или с равномерным потоком rate в секунду; задержка считается от прихода"""
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+    latencies = []
+
+    async def register(number, user_id):
+        nonlocal failures
+        if rate:
+            await asyncio.sleep(number / rate)
+        arrived = time.perf_counter()
+        async with semaphore:
+            query = FakeCallbackQuery(FakeUser(user_id), "register")
+            await bot.register_user(query, None)
+            latencies.append(time.perf_counter() - arrived)
+            # Успешные ответы: новая регистрация, найденный или уже записанный аккаунт
+            if not query.edits or not query.edits[-1].startswith(("🎉", "🔄", "✅")):
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(register(number, user_id) for number, user_id in enumerate(user_ids)))
+    return time.perf_counter() - started, failures, latencies
+
+
+async def run_status(bot, user_ids, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def status(number):
+        user = FakeUser(user_ids[number % len(user_ids)])
+        async with semaphore:
+            started = time.perf_counter()
+            if number % 2:
+                await bot.status_command(FakeUpdate(user), None)
+            else:
+                await bot.show_status(FakeCallbackQuery(user, "status"), None)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(status(number) for number in range(requests)))
+    return time.perf_counter() - started, latencies
+
+
+async def run_benchmark(bot, panel, args):
+    # Запуск как в main(): база, подключение, разрешение инбаундов
+    bot.init_db()
+    await bot.panel_runner.run(bot.test_xui_connection)
+    await bot.panel_runner.run(bot.warm_up_inbound_cache)
+
+    # Запас клиентов заполняется до замера, как в простое перед пиком регистраций
+    if bot.client_pool:
+        while await bot.panel_runner.run(bot.fill_client_pool):
+            pass
+
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+
+    panel.reset_counters()
+    reg_seconds, failures, reg_latencies = await run_registrations(
+        bot, user_ids, args.concurrency, args.register_rate)
+    await bot.client_batcher.flush_all()
+    reg_calls = panel.calls()
+    registered = args.users - failures
+
+    # Статус читается из снимка, который обновляет фоновая синхронизация
+    await bot.run_panel_sync()
+    panel.reset_counters()
+    status_seconds, latencies = await run_status(bot, user_ids, args.status_requests, args.concurrency)
+    status_calls = panel.calls()
+
+    await bot.post_shutdown(None)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        "registrations": {
+            "users": args.users,
+            "failed": failures,
+            "seconds": round(reg_seconds, 3),
+            "per_second": round(registered / reg_seconds, 2) if reg_seconds else None,
+            "panel_calls": reg_calls,
+            "panel_calls_per_registration": round(sum(reg_calls.values()) / registered, 3) if registered else None,
+            "panel_clients_after": panel.state.client_count(),
+            "p50_ms": ms(percentile(reg_latencies, 0.50)),
+            "p95_ms": ms(percentile(reg_latencies, 0.95)),
+            "p99_ms": ms(percentile(reg_latencies, 0.99)),
+        },
+        "status": {
+            "requests": args.status_requests,
+            "seconds": round(status_seconds, 3),
+            "per_second": round(args.status_requests / status_seconds, 2) if status_seconds else None,
+            "p50_ms": ms(percentile(latencies, 0.50)),
+            "p95_ms": ms(percentile(latencies, 0.95)),
+            "p99_ms": ms(percentile(latencies, 0.99)),
+            "max_ms": ms(max(latencies) if latencies else None),
+            "panel_calls": status_calls,
+        },
+    }
+
+
+# ========== РЕЗУЛЬТАТЫ ==========
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save_results(result):
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}-{result['commit']}.json"
+    path.write_text(json.dumps(result, ensure_ascii=False, indent=2))
+    return path
+
+
+def print_comparison(result, baseline_path):
+    """Сравнение ключевых показателей с сохраненным прогоном"""
+    baseline = json.loads(Path(baseline_path).read_text())
+    if baseline.get("config") != result["config"]:
+        print("⚠️ Параметры прогонов различаются, сравнение приблизительное")
+
+    rows = [
+        ("registrations", "per_second", "рег/с"),
+        ("registrations", "panel_calls_per_registration", "вызовов панели на регистрацию"),
+        ("registrations", "p50_ms", "регистрация p50, мс"),
+        ("registrations", "p95_ms", "регистрация p95, мс"),
+        ("status", "p50_ms", "статус p50, мс"),
+        ("status", "p95_ms", "статус p95, мс"),
+        ("status", "p99_ms", "статус p99, мс"),
+    ]
+    print(f"\nСравнение с {baseline.get('commit')} ({baseline_path}):")
+    for section, key, title in rows:
+        old, new = baseline[section].get(key), result[section].get(key)
+        if old and new is not None:
+            print(f"  {title}: {old} → {new} ({(new - old) / old:+.1%})")
+        else:
+            print(f"  {title}: {old} → {new}")
+
+
+def print_summary(result):
+    reg, status = result["registrations"], result["status"]
+    print(f"\n📊 Коммит {result['commit']}, параметры: {result['config']}")
+    print(f"🆕 Регистрации: {reg['users']} за {reg['seconds']} с → {reg['per_second']} рег/с, ошибок {reg['failed']}, "
+          f"p50 {reg['p50_ms']} мс, p95 {reg['p95_ms']} мс, p99 {reg['p99_ms']} мс")
+    print(f"📡 Вызовы панели: {reg['panel_calls']} ({reg['panel_calls_per_registration']} на регистрацию)")
+    print(f"📊 Статус: {status['requests']} запросов, p50 {status['p50_ms']} мс, "
+          f"p95 {status['p95_ms']} мс, p99 {status['p99_ms']} мс, вызовов панели {status['panel_calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на фейковой панели 3x-ui")
+    parser.add_argument("--users", type=int, default=500, help="число регистраций")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных обновлений")
+    parser.add_argument("--register-rate", type=float, default=0,
+                        help="регистраций в секунду равномерным потоком (0 - все сразу)")
+    parser.add_argument("--status-requests", type=int, default=2000, help="число запросов статуса")
+    parser.add_argument("--inbounds", type=int, default=1, help="инбаундов на панели")
+    parser.add_argument("--clients", type=int, default=1000, help="существующих клиентов в каждом инбаунде")
+    parser.add_argument("--latency-ms", type=float, default=10.0, help="задержка ответа панели")
+    parser.add_argument("--panel-workers", type=int, default=8)
+    parser.add_argument("--db-workers", type=int, default=4)
+    parser.add_argument("--client-pool", type=int, default=0, help="размер запаса заранее созданных клиентов")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--no-save", action="store_true", help="не сохранять результаты")
+    parser.add_argument("--verbose", action="store_true", help="логи бота уровня INFO")
+    args = parser.parse_args()
+
+    panel = FakePanel(args.inbounds, args.clients, args.latency_ms / 1000).start()
+    config = {key: value for key, value in vars(args).items() if key not in ("compare", "no_save", "verbose")}
+
+    with tempfile.TemporaryDirectory(prefix="vpnbot-bench-") as data_dir:
+        bot = import_bot(panel.url, data_dir, args)
+        try:
+            measurements = asyncio.run(run_benchmark(bot, panel, args))
+        finally:
+            panel.stop()
+
+    result = {"commit": git_commit(), "timestamp": datetime.now().isoformat(timespec="seconds"),
+              "config": config, **measurements}
+    print_summary(result)
+    if not args.no_save:
+        print(f"💾 Результаты: {save_results(result)}")
+    if args.compare:
+        print_comparison(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+# Модули бота импортируются без пакета, как при запуске app/bot.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from storage import SQLiteUserStore  # noqa: E402
+
+# PostgreSQL для контрактных тестов хранилища, например postgresql://postgres@localhost/postgres
+POSTGRES_DSN = os.getenv("POSTGRES_DSN")
+
+
+def _postgres_store():
+    if not POSTGRES_DSN:
+        pytest.skip("POSTGRES_DSN не задан")
+    psycopg = pytest.importorskip("psycopg")
+    from storage_postgres import PostgresUserStore
+
+    # Каждый тест работает в своей схеме, чтобы не видеть строки других тестов
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    with psycopg.connect(POSTGRES_DSN, autocommit=True) as conn:
+        conn.execute(f"CREATE SCHEMA {schema}")
+    store = PostgresUserStore(psycopg.conninfo.make_conninfo(POSTGRES_DSN, options=f"-c search_path={schema}"))
+    store.init()
+    yield store
+    store.close()
+    with psycopg.connect(POSTGRES_DSN, autocommit=True) as conn:
+        conn.execute(f"DROP SCHEMA {schema} CASCADE")
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def store(request, tmp_path):
+    """Хранилище пользователей; тесты с ним выполняются для каждой реализации UserStorage"""
+    if request.param == "postgres":
+        yield from _postgres_store()
+        return
+    store = SQLiteUserStore(tmp_path / "users.db")
+    store.init()
+    yield store
+    store.close()
@@ -0,0 +1,151 @@
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from panel import PanelUnavailable, XUISession
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def breaker(clock, **kwargs):
+    return CircuitBreaker("test", failure_threshold=2, reset_timeout=5.0, max_reset_timeout=20.0, clock=clock,
+                          **kwargs)
+
+
+def test_opens_after_threshold_and_probes_once_after_pause():
+    clock = Clock()
+    circuit = breaker(clock)
+    circuit.record_failure()
+    assert circuit.state == CLOSED and circuit.allow()
+
+    circuit.record_failure()
+    assert circuit.state == OPEN
+    assert not circuit.allow() and not circuit.available
+    assert circuit.retry_in == 5.0
+
+    clock.now += 5
+    assert circuit.available
+    # В полуоткрытом состоянии проходит только одна проба
+    assert circuit.allow()
+    assert circuit.state == HALF_OPEN
+    assert not circuit.allow() and not circuit.available
+
+    circuit.record_success()
+    assert circuit.state == CLOSED and circuit.allow()
+
+
+def test_released_probe_can_be_retried():
+    clock = Clock()
+    circuit = breaker(clock)
+    circuit.record_failure()
+    circuit.record_failure()
+    clock.now += 5
+    assert circuit.allow()
+    circuit.release()
+    assert circuit.state == HALF_OPEN
+    assert circuit.allow()
+
+
+def test_failed_probe_doubles_pause_up_to_max():
+    clock = Clock()
+    circuit = breaker(clock)
+    circuit.record_failure()
+    circuit.record_failure()
+
+    pauses = []
+    for _ in range(4):
+        clock.now += circuit.retry_in
+        assert circuit.allow()
+        circuit.record_failure()
+        assert circuit.state == OPEN
+        pauses.append(circuit.retry_in)
+    assert pauses == [10.0, 20.0, 20.0, 20.0]
+
+    # Успешная проба возвращает начальную паузу
+    clock.now += circuit.retry_in
+    assert circuit.allow()
+    circuit.record_success()
+    circuit.record_failure()
+    circuit.record_failure()
+    assert circuit.retry_in == 5.0
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status}", response=response)
+
+
+class FakeApi:
+    """Под-API py3xui: client.update отклоняется, пока сессия не обновлена"""
+
+    def __init__(self, errors):
+        self.logins = 0
+        self.errors = list(errors)
+        self.client = SimpleNamespace(update=self.update)
+
+    def login(self):
+        self.logins += 1
+
+    def update(self, client_id, client):
+        if self.errors:
+            raise self.errors.pop(0)
+        return client_id
+
+
+def session(api):
+    session = XUISession("http://panel", "admin", "admin", breaker_threshold=1)
+    session._create_api = lambda: api
+    return session
+
+
+def test_session_relogs_in_once_when_panel_rejects_it():
+    api = FakeApi([http_error(404)])
+    panel = session(api)
+
+    assert panel.call("client.update", "c1", None) == "c1"
+    assert api.logins == 2
+    assert panel.breaker.state == CLOSED
+
+    # Сессия уже обновлена: следующий вызов не логинится
+    assert panel.call("client.update", "c2", None) == "c2"
+    assert api.logins == 2
+
+
+def test_stale_relogin_reuses_session_updated_by_other_thread():
+    api = FakeApi([])
+    panel = session(api)
+    _, generation = panel._login()
+    # Другой поток уже перелогинился после отказа в той же сессии
+    panel._login(stale_generation=generation)
+    panel._login(stale_generation=generation)
+    assert api.logins == 2
+
+
+def test_rejection_after_relogin_is_raised_without_opening_breaker():
+    api = FakeApi([http_error(401), http_error(401)])
+    panel = session(api)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        panel.call("client.update", "c1", None)
+    assert api.logins == 2
+    assert panel.breaker.state == CLOSED
+
+
+def test_outage_opens_breaker_and_rejects_calls():
+    api = FakeApi([requests.exceptions.ConnectionError("refused")])
+    panel = session(api)
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        panel.call("client.update", "c1", None)
+    assert panel.breaker.state == OPEN
+    with pytest.raises(PanelUnavailable):
+        panel.call("client.update", "c1", None)
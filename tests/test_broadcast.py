@@ -0,0 +1,67 @@
+import asyncio
+
+from telegram.error import Forbidden
+
+from broadcast import DONE, RUNNING, Broadcaster, SendScheduler
+from concurrency import BlockingRunner
+
+
+class FakeBot:
+    def __init__(self, blocked=()):
+        self.sent = []
+        self.blocked = set(blocked)
+
+    async def send_message(self, chat_id, text):
+        if chat_id in self.blocked:
+            raise Forbidden("bot was blocked by the user")
+        self.sent.append(chat_id)
+
+
+def add_users(store, *telegram_ids):
+    for telegram_id in telegram_ids:
+        store.add_user(telegram_id, None, None, None, None, f"c{telegram_id}", f"user{telegram_id}@telegram.vpn",
+                       "main", 1)
+
+
+def run_resume(store, bot, owner=None):
+    async def scenario():
+        runner = BlockingRunner("db", max_workers=1)
+        broadcaster = Broadcaster(store, runner, SendScheduler(rate=1000, per_chat_interval=0), page_size=2,
+                                  owner=owner)
+        try:
+            await broadcaster.resume(bot)
+            if broadcaster.running:
+                await broadcaster._task
+        finally:
+            runner.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_resume_continues_from_saved_cursor(store):
+    add_users(store, 101, 102, 103, 104, 105)
+    broadcast = store.create_broadcast("привет", 1)
+    # Реплика упала после первой страницы
+    cursor = store.recipients_after(0, 2)[-1][0]
+    store.save_broadcast_progress(broadcast.id, cursor, 2, 0, 0)
+
+    bot = FakeBot(blocked={104})
+    run_resume(store, bot)
+
+    assert bot.sent == [103, 105]
+    row = store.get_broadcast(broadcast.id)
+    assert (row.status, row.sent, row.blocked, row.failed) == (DONE, 4, 1, 0)
+    assert row.last_user_id == store.recipients_after(cursor, 10)[-1][0]
+
+
+def test_broadcast_held_by_other_replica_is_not_resumed(store):
+    add_users(store, 101, 102)
+    broadcast = store.create_broadcast("привет", 1)
+    assert store.acquire_lease(f"broadcast:{broadcast.id}", "other", 60)
+
+    bot = FakeBot()
+    run_resume(store, bot, owner="me")
+
+    assert bot.sent == []
+    row = store.get_broadcast(broadcast.id)
+    assert (row.status, row.last_user_id) == (RUNNING, 0)
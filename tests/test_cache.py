@@ -0,0 +1,39 @@
+import time
+
+from cache import TTLCache
+
+
+def test_fill_after_concurrent_write_is_dropped():
+    cache = TTLCache(max_size=10, ttl=60)
+    # Чтение из базы началось до записи пользователя
+    version = cache.version
+    cache.put(1, "new")
+    cache.fill(1, "stale", version)
+    assert cache.get(1) == (True, "new")
+
+    version = cache.version
+    cache.invalidate(1)
+    cache.fill(1, "stale", version)
+    assert cache.get(1) == (False, None)
+
+    cache.fill(1, "fresh", cache.version)
+    assert cache.get(1) == (True, "fresh")
+
+
+def test_missing_value_is_cached_with_negative_ttl():
+    cache = TTLCache(max_size=10, ttl=60, negative_ttl=0.01)
+    cache.fill(1, None, cache.version)
+    assert cache.get(1) == (True, None)
+    time.sleep(0.02)
+    assert cache.get(1) == (False, None)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    cache.get(1)
+    cache.put(3, "c")
+    assert cache.get(2) == (False, None)
+    assert cache.get(1) == (True, "a")
+    assert cache.stats()["size"] == 2
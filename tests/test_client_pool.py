@@ -0,0 +1,43 @@
+from client_index import ClientIndex, ClientRecord
+from client_pool import ClientPool
+
+
+def test_put_back_returns_spare_to_pool(store):
+    pool = ClientPool(store, size=2, batch_size=2, create=lambda target, spares: None)
+    assert pool.fill(("main", 1)) == 2
+
+    spare = pool.take(["main"])
+    assert store.spare_client_count() == 1
+    pool.put_back(spare)
+    assert store.spare_client_count() == 2
+    assert pool.missing() == 0
+
+
+def test_index_forgets_spare_email_after_bind_and_discard():
+    index = ClientIndex()
+    index.add(ClientRecord("a", "spare-a@pool.vpn", 1, None, "main"))
+    index.add(ClientRecord("b", "spare-b@pool.vpn", 1, None, "main"))
+
+    # Привязка переименовывает клиента: старый email из индекса удаляется
+    index.add(ClientRecord("a", "user1@telegram.vpn", 1, 1, "main"))
+    assert index.by_email("spare-a@pool.vpn") is None
+    assert index.by_telegram_id(1).client_id == "a"
+    assert index.count("main", 1) == 2
+
+    index.remove("b")
+    assert index.by_email("spare-b@pool.vpn") is None
+    assert index.by_client_id("b") is None
+    assert index.count("main", 1) == 1
+
+
+def test_bind_slots_are_limited_and_skipped_while_batch_is_written(store):
+    pool = ClientPool(store, size=2, batch_size=2, create=lambda target, spares: None, max_binds=2)
+    # Пока client.add пишет пачку, регистрации идут в нее, а не в запас
+    assert not pool.acquire_bind(contended=True)
+    assert pool.acquire_bind()
+    assert pool.acquire_bind()
+    assert not pool.acquire_bind()
+
+    pool.release_bind()
+    assert pool.acquire_bind()
+    assert pool.binds == 2
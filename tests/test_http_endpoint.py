@@ -0,0 +1,103 @@
+import asyncio
+
+from http_endpoint import HTTPResponse, LocalHTTPServer
+
+
+async def ok_handler(method, path, headers):
+    return HTTPResponse(200, b"ok")
+
+
+async def started(**kwargs):
+    server = LocalHTTPServer("test", "127.0.0.1", 0, ok_handler, **kwargs)
+    await server.start()
+    port = server._server.sockets[0].getsockname()[1]
+    return server, port
+
+
+async def status_of(reader):
+    line = await asyncio.wait_for(reader.readline(), 5)
+    return int(line.split()[1]) if line else None
+
+
+def test_get_with_keep_alive():
+    async def scenario():
+        server, port = await started()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            for _ in range(2):
+                writer.write(b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n")
+                assert await status_of(reader) == 200
+                while await reader.readline() != b"\r\n":
+                    pass
+                assert await reader.readexactly(2) == b"ok"
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(scenario())
+
+
+def test_oversize_request_line_gets_400():
+    async def scenario():
+        server, port = await started(max_line=256)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /" + b"a" * 1024 + b" HTTP/1.1\r\n\r\n")
+            assert await status_of(reader) == 400
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(scenario())
+
+
+def test_oversize_headers_get_431():
+    async def scenario():
+        server, port = await started(max_line=256, max_header_bytes=512)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET / HTTP/1.1\r\nX-Long: " + b"a" * 1024 + b"\r\n\r\n")
+            assert await status_of(reader) == 431
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            many = b"".join(b"X-%d: %s\r\n" % (i, b"a" * 100) for i in range(10))
+            writer.write(b"GET / HTTP/1.1\r\n" + many + b"\r\n")
+            assert await status_of(reader) == 431
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(scenario())
+
+
+def test_slow_headers_and_idle_connections_are_closed():
+    async def scenario():
+        server, port = await started(header_timeout=0.2, idle_timeout=0.2)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET / HTTP/1.1\r\nHost: x\r\n")
+            assert await asyncio.wait_for(reader.read(), 5) == b""
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            assert await asyncio.wait_for(reader.read(), 5) == b""
+            assert server._connections == 0
+        finally:
+            await server.stop()
+
+    asyncio.run(scenario())
+
+
+def test_connections_over_limit_get_503():
+    async def scenario():
+        server, port = await started(max_connections=1)
+        try:
+            _, held = await asyncio.open_connection("127.0.0.1", port)
+            await asyncio.sleep(0.05)
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            assert await status_of(reader) == 503
+            held.close()
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(scenario())
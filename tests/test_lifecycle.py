@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+
+import pytest
+from py3xui import Client
+
+from lifecycle import (
+    ACTIVE, DAY_MS, DEPLETED, EXPIRED, EXPIRING, RENEWED, WARNED, ClientChange, LifecyclePolicy, LifecycleSweeper
+)
+
+NOW = 1_700_000_000_000
+GB = 1073741824
+
+
+def client(telegram_id, total=10 * GB, expiry_time=0, enable=True):
+    return Client(id=f"c{telegram_id}", email=f"user{telegram_id}@telegram.vpn", enable=enable,
+                  totalGB=total, expiryTime=expiry_time, tgId=telegram_id)
+
+
+def usage(telegram_id, used):
+    return SimpleNamespace(email=f"user{telegram_id}@telegram.vpn", up=used, down=0, total=0)
+
+
+def inbounds(*clients, stats=(), inbound_id=1):
+    """Выгрузка панели main с одним инбаундом"""
+    return {"main": [SimpleNamespace(id=inbound_id, settings=SimpleNamespace(clients=list(clients)),
+                                     client_stats=list(stats))]}
+
+
+@pytest.mark.parametrize(("used", "expiry_time", "phase"), [
+    (7.99 * GB, 0, ACTIVE),
+    (8 * GB, 0, WARNED),
+    (10 * GB, 0, DEPLETED),
+    (0, NOW + 3 * DAY_MS + 1, ACTIVE),
+    (0, NOW + 3 * DAY_MS, EXPIRING),
+    (0, NOW + 1, EXPIRING),
+    (0, NOW, EXPIRED),
+    # Истекший срок важнее израсходованного трафика, а израсходованный трафик - близкого срока
+    (10 * GB, NOW, EXPIRED),
+    (10 * GB, NOW + DAY_MS, DEPLETED),
+    # Отрицательный срок отсчитывается от первого подключения и еще не начался
+    (0, -DAY_MS, ACTIVE),
+])
+def test_classify_boundaries(used, expiry_time, phase):
+    policy = LifecyclePolicy(warn_percent=80, expiry_warn_days=3)
+    assert policy.classify(used, 10 * GB, expiry_time, NOW) == phase
+
+
+def test_classify_without_traffic_limit():
+    assert LifecyclePolicy().classify(100 * GB, 0, 0, NOW) == ACTIVE
+
+
+def test_auto_renew_extends_by_whole_periods_and_enables_client(store):
+    applied = []
+    sweeper = LifecycleSweeper(store, LifecyclePolicy(period_days=30, auto_renew=True),
+                               lambda panel, inbound_id, changes: applied.append(changes))
+    # Срок истек два с половиной периода назад, клиент отключен при истечении
+    expired = NOW - 75 * DAY_MS
+    store.save_lifecycle_phases({"user1@telegram.vpn": EXPIRED})
+
+    report = sweeper.run(inbounds(client(1, expiry_time=expired, enable=False), stats=[usage(1, 10 * GB)]), NOW)
+
+    assert applied == [[ClientChange("user1@telegram.vpn", enable=True, expiry_time=expired + 90 * DAY_MS,
+                                     reset_traffic=True)]]
+    assert [(item.kind, item.used, item.expiry_time) for item in report.notifications] == [
+        (RENEWED, 0, expired + 90 * DAY_MS)]
+    assert store.lifecycle_phases() == {}
+
+
+def test_only_changed_phases_are_written(store):
+    saved = []
+    store.save_lifecycle_phases({"user1@telegram.vpn": WARNED})
+    original = store.save_lifecycle_phases
+    store.save_lifecycle_phases = lambda phases: (saved.append(dict(phases)), original(phases))
+    sweeper = LifecycleSweeper(store, LifecyclePolicy(), lambda panel, inbound_id, changes: None)
+    state = inbounds(client(1), client(2), client(3), stats=[usage(1, 8 * GB), usage(2, 9 * GB), usage(3, GB)])
+
+    report = sweeper.run(state, NOW)
+    assert saved == [{"user2@telegram.vpn": WARNED}]
+    assert (report.checked, report.changed) == (3, 1)
+
+    # Второй проход без изменений ничего не пишет
+    assert sweeper.run(state, NOW).changed == 0
+    assert len(saved) == 1
+
+
+def test_failed_inbound_update_keeps_phase_for_retry(store):
+    calls = []
+
+    def apply(panel, inbound_id, changes):
+        calls.append(changes)
+        if len(calls) == 1:
+            raise ConnectionError("панель недоступна")
+
+    sweeper = LifecycleSweeper(store, LifecyclePolicy(), apply)
+    state = inbounds(client(1), stats=[usage(1, 10 * GB)])
+
+    first = sweeper.run(state, NOW)
+    assert (first.failed_inbounds, first.changed, first.notifications) == (1, 0, ())
+    assert store.lifecycle_phases() == {}
+
+    second = sweeper.run(state, NOW)
+    assert calls == [[ClientChange("user1@telegram.vpn", enable=False)]] * 2
+    assert [item.kind for item in second.notifications] == [DEPLETED]
+    assert store.lifecycle_phases() == {"user1@telegram.vpn": DEPLETED}
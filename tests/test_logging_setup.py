@@ -0,0 +1,27 @@
+import logging
+
+from logging_setup import RepeatFilter
+
+
+def make_record(level, lineno=10):
+    return logging.LogRecord("bot", level, "bot.py", lineno, "сообщение", None, None)
+
+
+def test_repeat_filter_limits_debug_lines_per_call_site():
+    sampler = RepeatFilter(burst=2, period=60)
+    passed = [sampler.filter(make_record(logging.DEBUG)) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+    # Другое место вызова ограничивается отдельно
+    assert sampler.filter(make_record(logging.DEBUG, lineno=11))
+
+
+def test_repeat_filter_keeps_info_and_above():
+    sampler = RepeatFilter(burst=1, period=60)
+    for level in (logging.INFO, logging.WARNING, logging.ERROR):
+        assert all(sampler.filter(make_record(level)) for _ in range(5))
+
+
+def test_repeat_filter_limits_records_at_max_level():
+    sampler = RepeatFilter(burst=1, period=60, max_level=logging.INFO)
+    assert [sampler.filter(make_record(logging.INFO)) for _ in range(3)] == [True, False, False]
+    assert all(sampler.filter(make_record(logging.WARNING)) for _ in range(3))
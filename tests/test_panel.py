@@ -0,0 +1,42 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from panel import InboundCache
+
+
+def inbound(inbound_id=1):
+    return SimpleNamespace(id=inbound_id, remark="vless", port=443, protocol="vless")
+
+
+def test_cold_cache_is_resolved_once_for_parallel_callers():
+    cache = InboundCache(ttl=60)
+    calls = []
+    start = threading.Barrier(8)
+
+    def resolve():
+        calls.append(1)
+        # Пока идет разрешение, остальные вызовы ждут его, а не создают инбаунд сами
+        time.sleep(0.05)
+        return inbound()
+
+    def get():
+        start.wait()
+        return cache.get(resolve)
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: get(), range(8)))
+
+    assert len(calls) == 1
+    assert {info.id for info in results} == {1}
+
+
+def test_failed_refresh_keeps_cached_inbound_until_invalidated():
+    cache = InboundCache(ttl=0)
+    assert cache.get(inbound).id == 1
+    assert cache.get(lambda: None).id == 1
+
+    cache.invalidate()
+    assert cache.get(lambda: None) is None
+    assert cache.get(lambda: inbound(2)).id == 2
@@ -0,0 +1,126 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from concurrency import BlockingRunner, QueueFull
+from panel import PanelUnavailable
+from provisioning import ClientBatcher, add_clients_with_fallback
+
+
+def response(status):
+    result = requests.Response()
+    result.status_code = status
+    return result
+
+
+def test_batcher_raises_queue_full_to_every_submitter():
+    async def scenario():
+        runner = BlockingRunner("panel", max_workers=1, max_pending=0)
+        batcher = ClientBatcher(lambda target, clients: None, runner, window=0.01, max_batch=10)
+        try:
+            results = await asyncio.gather(batcher.submit(("main", 1), "a"), batcher.submit(("main", 1), "b"),
+                                           return_exceptions=True)
+        finally:
+            runner.shutdown()
+        return results
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, QueueFull) for result in results)
+
+
+def test_batcher_adds_one_batch_per_target():
+    calls = []
+
+    async def scenario():
+        runner = BlockingRunner("panel", max_workers=1)
+        batcher = ClientBatcher(lambda target, clients: calls.append((target, list(clients))), runner,
+                                window=0.01, max_batch=10)
+        try:
+            await asyncio.gather(*(batcher.submit(("main", 1), name) for name in "abc"))
+        finally:
+            runner.shutdown()
+
+    asyncio.run(scenario())
+    assert calls == [(("main", 1), ["a", "b", "c"])]
+
+
+def rejected_add(calls, error):
+    """add_clients, у которого пачка из нескольких клиентов завершается error, а клиент b отклоняется"""
+    def add_clients(target, clients):
+        calls.append(list(clients))
+        if len(clients) > 1:
+            raise error
+        if clients[0].email == "b":
+            raise ValueError("Response status is not successful, message: duplicate email")
+    return add_clients
+
+
+def test_rejected_batch_is_retried_one_by_one():
+    calls = []
+    clients = [SimpleNamespace(email=email) for email in "abc"]
+    errors = add_clients_with_fallback(rejected_add(calls, ValueError("duplicate email")), ("main", 1), clients)
+    assert calls == [clients, clients[:1], clients[1:2], clients[2:]]
+    assert errors[0] is None and errors[2] is None
+    assert isinstance(errors[1], ValueError)
+
+
+@pytest.mark.parametrize("error", [
+    PanelUnavailable("панель недоступна"),
+    TimeoutError("инбаунд занят"),
+    requests.exceptions.ReadTimeout("read timeout"),
+    requests.exceptions.HTTPError("502", response=response(502)),
+])
+def test_batch_with_unknown_outcome_is_not_retried(error):
+    calls = []
+    clients = [SimpleNamespace(email=email) for email in "abc"]
+    errors = add_clients_with_fallback(rejected_add(calls, error), ("main", 1), clients)
+    # Пачка могла быть записана: повтор по одному создал бы клиентов дважды
+    assert calls == [clients]
+    assert errors == [error] * 3
+
+
+def test_batcher_flushes_full_batch_without_waiting_for_window():
+    calls = []
+
+    async def scenario():
+        runner = BlockingRunner("panel", max_workers=1)
+        batcher = ClientBatcher(lambda target, clients: calls.append(list(clients)), runner, window=10, max_batch=2)
+        try:
+            started = asyncio.get_running_loop().time()
+            await asyncio.gather(batcher.submit(("main", 1), "a"), batcher.submit(("main", 1), "b"))
+            elapsed = asyncio.get_running_loop().time() - started
+
+            # Неполная пачка ждет окно, а запись видна через busy
+            third = asyncio.create_task(batcher.submit(("main", 1), "c"))
+            await asyncio.sleep(0)
+            assert batcher.busy and calls == [["a", "b"]]
+            await batcher.flush_all()
+            await third
+        finally:
+            runner.shutdown()
+        return elapsed
+
+    assert asyncio.run(scenario()) < 1
+    assert calls == [["a", "b"], ["c"]]
+
+
+def test_batcher_writes_partial_batch_after_window():
+    calls = []
+
+    async def scenario():
+        runner = BlockingRunner("panel", max_workers=1)
+        batcher = ClientBatcher(lambda target, clients: calls.append((target, list(clients))), runner,
+                                window=0.05, max_batch=10)
+        try:
+            first = asyncio.create_task(batcher.submit(("main", 1), "a"))
+            other = asyncio.create_task(batcher.submit(("main", 2), "b"))
+            await asyncio.sleep(0.02)
+            assert calls == []
+            await asyncio.gather(first, other)
+        finally:
+            runner.shutdown()
+
+    asyncio.run(scenario())
+    assert sorted(calls) == [(("main", 1), ["a"]), (("main", 2), ["b"])]
@@ -0,0 +1,26 @@
+import pytest
+
+from ratelimit import GLOBAL, USER, RateLimiter, parse_rate
+
+
+def test_global_rejection_refunds_user_token():
+    limiter = RateLimiter("register", user_rate=(1, 60), global_rate=(1, 60))
+    assert limiter.check(1) is None
+
+    scope, wait = limiter.check(2)
+    assert scope == GLOBAL and wait > 0
+    # Токен пользователя 2 возвращен: он снова упирается в общий лимит, а не в свой
+    assert limiter.check(2)[0] == GLOBAL
+    assert limiter.check(1)[0] == USER
+
+
+def test_user_limit_does_not_spend_global_token():
+    limiter = RateLimiter("register", user_rate=(1, 60), global_rate=(2, 60))
+    assert limiter.check(1) is None
+    assert limiter.check(1)[0] == USER
+    assert limiter.check(2) is None
+
+
+@pytest.mark.parametrize(("spec", "rate"), [("3/60", (3, 60.0)), ("5", (5, 1.0)), ("0", None), ("", None)])
+def test_parse_rate(spec, rate):
+    assert parse_rate(spec) == rate
@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+from py3xui import Client
+
+from reconcile import DANGLING, DUPLICATE, MOVED, ORPHAN, STRAY, Reconciler
+from storage import SpareClient
+
+
+def panel_state(*clients, inbound_id=1, others=None):
+    """Выгрузка панели main: clients в инбаунде inbound_id, others - {ID инбаунда: клиенты}"""
+    inbounds = {inbound_id: list(clients), **(others or {})}
+    return {"main": [SimpleNamespace(id=number, settings=SimpleNamespace(clients=items))
+                     for number, items in inbounds.items()]}
+
+
+def client(client_id, email, telegram_id=None):
+    return Client(id=client_id, email=email, enable=True, tgId=telegram_id or "")
+
+
+def reconciler(store, **kwargs):
+    return Reconciler(store, "main", 1, adopt=lambda record: True, invalidate=lambda telegram_id: None,
+                      repair=True, **kwargs)
+
+
+def test_stray_spare_is_deleted_on_second_pass(store):
+    store.add_spare_clients([SpareClient("kept", "spare-kept@pool.vpn", "main", 1)])
+    deleted = []
+    state = panel_state(client("kept", "spare-kept@pool.vpn"), client("stray", "spare-stray@pool.vpn"))
+    checker = reconciler(store, delete_spare=deleted.append)
+
+    first = checker.run(state)
+    assert [finding.client_id for finding in first.findings if finding.kind == STRAY] == ["stray"]
+    assert deleted == []
+
+    second = checker.run(state)
+    assert [record.client_id for record in deleted] == ["stray"]
+    assert second.repaired == 1
+
+
+def test_spare_recorded_between_passes_is_kept(store):
+    deleted = []
+    state = panel_state(client("late", "spare-late@pool.vpn"))
+    checker = reconciler(store, delete_spare=deleted.append)
+
+    checker.run(state)
+    # Пополнение записало строку уже после первого прохода
+    store.add_spare_clients([SpareClient("late", "spare-late@pool.vpn", "main", 1)])
+    report = checker.run(state)
+    assert deleted == []
+    assert report.findings == ()
+
+
+def test_repair_rules_apply_from_second_pass(store):
+    store.add_user(1, None, None, None, None, "c1", "user1@telegram.vpn", "main", 1)
+    store.add_user(2, None, None, None, None, "c2", "user2@telegram.vpn", "main", 1)
+    store.add_user(3, None, None, None, None, "c3", "user3@telegram.vpn", "main", 1)
+    state = panel_state(
+        client("c1", "user1@telegram.vpn"),
+        client("c4", "user4@telegram.vpn"),
+        client("c5", "other", telegram_id=1),
+        others={2: [client("c3", "user3@telegram.vpn")]},
+    )
+    adopted, invalidated = [], []
+
+    def adopt(record):
+        adopted.append(record)
+        return store.add_user(record.telegram_id, None, None, None, None, record.client_id,
+                              record.email, record.panel, record.inbound_id)
+
+    checker = Reconciler(store, "main", 1, adopt=adopt, invalidate=invalidated.append, repair=True)
+    first = checker.run(state)
+    assert {(finding.kind, finding.client_id) for finding in first.findings} == {
+        (DANGLING, "c2"), (MOVED, "c3"), (ORPHAN, "c4"), (DUPLICATE, "c5")}
+    # Первый проход только находит расхождения
+    assert first.repaired == 0 and adopted == [] and store.get_user(2) is not None
+
+    second = checker.run(state)
+    assert second.repaired == 3
+    assert store.get_user(2) is None
+    assert (store.get_user(3).panel, store.get_user(3).inbound_id) == ("main", 2)
+    assert store.get_user(4).xui_client_id == "c4"
+    assert sorted(invalidated) == [2, 3]
+    # Лишний клиент только показывается в отчете
+    assert [finding.kind for finding in second.findings] == [DUPLICATE]
+    assert store.get_user(1).xui_client_id == "c1"
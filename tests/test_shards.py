@@ -0,0 +1,80 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from panel import InboundCache
+from shards import InboundTarget, InboundWriteLock, ShardPlacement
+
+
+def test_inbound_write_lock_excludes_other_replicas(store):
+    first = InboundWriteLock("inbound:main/1")
+    second = InboundWriteLock("inbound:main/1")
+    first.use_leases(store, "replica-a", ttl=60, wait=1)
+    second.use_leases(store, "replica-b", ttl=60, wait=0.2)
+
+    with first:
+        with pytest.raises(TimeoutError):
+            second.__enter__()
+    # Неудачная попытка не оставляет локальную блокировку занятой
+    with second:
+        pass
+    with first:
+        pass
+
+
+def test_inbound_write_lock_waits_for_release(store):
+    first = InboundWriteLock("inbound:main/1")
+    second = InboundWriteLock("inbound:main/1", poll_interval=0.01)
+    first.use_leases(store, "replica-a")
+    second.use_leases(store, "replica-b", wait=5)
+    acquired = threading.Event()
+
+    def contender():
+        with second:
+            acquired.set()
+
+    with first:
+        thread = threading.Thread(target=contender)
+        thread.start()
+        assert not acquired.wait(0.1)
+    thread.join(timeout=5)
+    assert acquired.is_set()
+
+
+def test_inbound_write_lock_without_leases_is_local():
+    lock = InboundWriteLock("inbound:main/1")
+    with lock:
+        assert not lock._lock.acquire(blocking=False)
+    assert lock._lock.acquire(blocking=False)
+
+
+def make_panel(name, capacities, available=True):
+    panel = SimpleNamespace(name=name, session=SimpleNamespace(available=available))
+    panel.targets = [InboundTarget(panel, inbound_id, 443, capacity, InboundCache(60))
+                     for inbound_id, capacity in enumerate(capacities, start=1)]
+    return panel
+
+
+def choose(placement, counts):
+    target = placement.choose(lambda panel, inbound_id: counts.get((panel, inbound_id), 0))
+    return target.name if target else None
+
+
+def test_placement_prefers_lowest_fill_ratio():
+    placement = ShardPlacement([make_panel("a", [1000, 100])])
+    assert choose(placement, {("a", 1): 500, ("a", 2): 10}) == "a/2"
+    assert choose(placement, {("a", 1): 500, ("a", 2): 60}) == "a/1"
+
+
+def test_placement_uses_uncapped_inbounds_after_capped_ones():
+    placement = ShardPlacement([make_panel("a", [100, 0, 0])])
+    # Доля 0.9 и 0 клиентов не сравниваются между собой
+    assert choose(placement, {("a", 1): 90, ("a", 2): 0, ("a", 3): 3}) == "a/1"
+    assert choose(placement, {("a", 1): 100, ("a", 2): 5, ("a", 3): 3}) == "a/3"
+
+
+def test_placement_skips_full_and_unavailable_panels():
+    placement = ShardPlacement([make_panel("a", [10], available=False), make_panel("b", [10])])
+    assert choose(placement, {}) == "b/1"
+    assert choose(placement, {("b", 1): 10}) is None
@@ -0,0 +1,142 @@
+import sqlite3
+import time
+
+import pytest
+
+from storage import MIGRATIONS, DuplicateUser, SQLiteUserStore, SpareClient
+
+
+def add(store, telegram_id, panel="main", inbound_id=1):
+    return store.add_user(telegram_id, f"user{telegram_id}", None, "ru", f"sub/{telegram_id}", f"c{telegram_id}",
+                          f"user{telegram_id}@telegram.vpn", panel, inbound_id)
+
+
+def test_migrations_upgrade_legacy_database(tmp_path):
+    path = tmp_path / "users.db"
+    # Схема первой версии бота без user_version
+    with sqlite3.connect(path) as conn:
+        conn.execute(MIGRATIONS[0][0])
+        conn.execute("INSERT INTO users (telegram_id, username, xui_client_id) VALUES (1, 'old', 'c1')")
+    conn.close()
+
+    store = SQLiteUserStore(path)
+    store.init()
+    # Повторный запуск не применяет миграции заново
+    store.init()
+    try:
+        version = store._writer.execute("PRAGMA user_version").fetchone()[0]
+        assert version == len(MIGRATIONS)
+        user = store.get_user(1)
+        assert (user.username, user.xui_client_id, user.email, user.panel) == ("old", "c1", None, None)
+        assert store.spare_client_count() == 0
+    finally:
+        store.close()
+
+
+def test_init_is_idempotent(store):
+    add(store, 1)
+    store.init()
+    assert store.get_user(1).username == "user1"
+
+
+def test_add_and_get_user(store):
+    row = add(store, 1)
+    assert (row.telegram_id, row.xui_client_id, row.email, row.panel, row.inbound_id) == (
+        1, "c1", "user1@telegram.vpn", "main", 1)
+    assert row.created_at
+    assert store.get_user(1) == row
+    assert store.get_user_by_client_id("c1") == row
+    assert store.get_user(2) is None
+    assert store.get_user_by_client_id("missing") is None
+    with pytest.raises(DuplicateUser):
+        add(store, 1)
+
+
+def test_add_users_skips_existing_telegram_ids(store):
+    add(store, 1)
+    users = [{"telegram_id": telegram_id, "username": None, "full_name": None, "language_code": None,
+              "subscription_url": None, "xui_client_id": f"c{telegram_id}", "email": None,
+              "panel": "main", "inbound_id": 1} for telegram_id in (1, 2, 3)]
+    users[2]["created_at"] = "2024-01-01 00:00:00"
+
+    assert store.add_users(users) == 2
+    assert store.add_users([]) == 0
+    assert store.existing_telegram_ids([1, 3, 4]) == {1, 3}
+    assert store.existing_telegram_ids([]) == set()
+    assert store.get_user(3).created_at == "2024-01-01 00:00:00"
+    assert [user.telegram_id for user in store.iter_users(batch_size=2)] == [1, 2, 3]
+
+
+def test_location_queries_and_updates(store):
+    add(store, 1, "main", 1)
+    add(store, 2, "main", 2)
+    add(store, 3, None, None)
+
+    assert [user.telegram_id for user in store.iter_users_at("main", 1)] == [1]
+    assert sorted(user.telegram_id for user in store.iter_users_at("main", 1, include_unplaced=True)) == [1, 3]
+    fingerprints = store.location_fingerprints("main", 1)
+    assert set(fingerprints) == {("main", 1), ("main", 2)}
+    assert fingerprints[("main", 1)][0] == 2
+
+    store.update_location(3, "main", 2)
+    assert sorted(user.telegram_id for user in store.iter_users_at("main", 2)) == [2, 3]
+    assert store.delete_user(2)
+    assert not store.delete_user(2)
+    assert [user.telegram_id for user in store.iter_users_at("main", 2)] == [3]
+
+
+def test_broadcast_progress(store):
+    for telegram_id in (1, 2, 3):
+        add(store, telegram_id)
+    broadcast = store.create_broadcast("привет", 42)
+    assert (broadcast.status, broadcast.total, broadcast.last_user_id) == ("running", 3, 0)
+    assert store.get_broadcast() == broadcast
+    assert [row.id for row in store.running_broadcasts()] == [broadcast.id]
+
+    first_page = store.recipients_after(0, 2)
+    assert [telegram_id for _, telegram_id in first_page] == [1, 2]
+    store.save_broadcast_progress(broadcast.id, first_page[-1][0], 2, 0, 0)
+    assert [telegram_id for _, telegram_id in store.recipients_after(first_page[-1][0], 2)] == [3]
+
+    store.save_broadcast_progress(broadcast.id, first_page[-1][0], 2, 1, 0, status="done")
+    done = store.get_broadcast(broadcast.id)
+    assert (done.status, done.sent, done.failed) == ("done", 2, 1)
+    assert done.finished_at
+    assert store.running_broadcasts() == []
+
+
+def test_lifecycle_phases(store):
+    store.save_lifecycle_phases({"a@telegram.vpn": "warned", "b@telegram.vpn": "expired"})
+    store.save_lifecycle_phases({"a@telegram.vpn": "depleted", "b@telegram.vpn": None})
+    assert store.lifecycle_phases() == {"a@telegram.vpn": "depleted"}
+
+
+def test_lease_belongs_to_one_owner_until_released(store):
+    assert store.acquire_lease("job", "a", 60)
+    assert not store.acquire_lease("job", "b", 60)
+    # Владелец продлевает аренду, чужое освобождение ее не снимает
+    assert store.acquire_lease("job", "a", 60)
+    store.release_lease("job", "b")
+    assert not store.acquire_lease("job", "b", 60)
+
+    store.release_lease("job", "a")
+    assert store.acquire_lease("job", "b", 60)
+
+
+def test_expired_lease_can_be_taken_over(store):
+    assert store.acquire_lease("job", "a", 0.05)
+    time.sleep(0.1)
+    assert store.acquire_lease("job", "b", 60)
+    assert not store.acquire_lease("job", "a", 60)
+
+
+def test_spare_clients_are_taken_once_from_given_panels(store):
+    store.add_spare_clients([SpareClient("s1", "spare-1@pool.vpn", "de", 1),
+                             SpareClient("s2", "spare-2@pool.vpn", "nl", 1),
+                             SpareClient("s3", "spare-3@pool.vpn", "nl", 2)])
+    assert store.spare_client_count() == 3
+    assert store.take_spare_client(["de"]) == SpareClient("s1", "spare-1@pool.vpn", "de", 1)
+    assert store.take_spare_client(["de"]) is None
+    assert store.take_spare_client([]) is None
+    assert store.take_spare_client(["nl"]).client_id in {"s2", "s3"}
+    assert len(store.spare_client_ids()) == 1
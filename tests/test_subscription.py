@@ -0,0 +1,82 @@
+import asyncio
+
+import httpx
+
+from subscription import SubscriptionProxy
+
+CLIENT_ID = "6f1c3e2a-0b7d-4a55-9c1e-2d4f8a9b0c11"
+PATH = f"/sub/1/{CLIENT_ID}"
+
+
+class FakePanel:
+    """HTTP клиент прокси: отвечает телом подписки или ошибкой"""
+
+    def __init__(self):
+        self.requests = 0
+        self.error = None
+
+    async def get(self, url):
+        self.requests += 1
+        if self.error is not None:
+            raise self.error
+        return httpx.Response(200, content=b"vless://config", request=httpx.Request("GET", url),
+                              headers={"subscription-userinfo": "upload=0; download=0", "x-internal": "1"})
+
+
+def proxy(panel, **kwargs):
+    async def resolve(client_id):
+        return f"http://panel/sub/{client_id}" if client_id == CLIENT_ID else None
+
+    server = SubscriptionProxy("127.0.0.1", 0, resolve, **kwargs)
+    server._client = panel
+    return server
+
+
+def test_etag_match_gets_304_from_cache():
+    panel = FakePanel()
+    server = proxy(panel)
+
+    async def scenario():
+        first = await server._handle("GET", PATH, {})
+        second = await server._handle("GET", PATH, {"if-none-match": first.headers["ETag"]})
+        changed = await server._handle("GET", PATH, {"if-none-match": '"other"'})
+        return first, second, changed
+
+    first, second, changed = asyncio.run(scenario())
+    assert (first.status, first.body) == (200, b"vless://config")
+    assert first.headers["subscription-userinfo"] == "upload=0; download=0"
+    assert "x-internal" not in first.headers
+    assert (second.status, second.body, second.headers["ETag"]) == (304, b"", first.headers["ETag"])
+    assert (changed.status, changed.body) == (200, b"vless://config")
+    assert panel.requests == 1
+
+
+def test_stale_copy_is_served_when_panel_fails():
+    panel = FakePanel()
+    server = proxy(panel, ttl=0)
+
+    async def scenario():
+        fresh = await server._handle("GET", PATH, {})
+        panel.error = httpx.ConnectError("connection refused")
+        stale = await server._handle("GET", PATH, {})
+        server.invalidate(CLIENT_ID)
+        missing = await server._handle("GET", PATH, {})
+        return fresh, stale, missing
+
+    fresh, stale, missing = asyncio.run(scenario())
+    assert (stale.status, stale.body, stale.headers["ETag"]) == (200, fresh.body, fresh.headers["ETag"])
+    # Без устаревшей копии ошибка панели отдается клиенту
+    assert missing.status == 502
+    assert panel.requests == 3
+
+
+def test_unknown_client_is_not_forwarded_to_panel():
+    panel = FakePanel()
+    server = proxy(panel)
+
+    async def scenario():
+        return [await server._handle("GET", path, {}) for path in
+                ("/sub/1/0000", "/sub/1/0000", "/other", "/sub/1/../admin")]
+
+    assert [response.status for response in asyncio.run(scenario())] == [404, 404, 404, 404]
+    assert panel.requests == 0
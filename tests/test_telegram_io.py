@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+from telegram_io import MessageEditor, answering
+
+
+class FakeQuery:
+    def __init__(self, message_id=1, error=None):
+        self.message = SimpleNamespace(chat_id=10, message_id=message_id)
+        self.edits = []
+        self.error = error
+
+    async def edit_message_text(self, text, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.edits.append((text, kwargs["reply_markup"]))
+
+    async def answer(self):
+        raise BadRequest("Query is too old")
+
+
+def keyboard(label):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data="status")]])
+
+
+def test_same_content_is_not_edited_twice():
+    editor = MessageEditor()
+    query = FakeQuery()
+
+    async def scenario():
+        return [await editor.edit(query, "статус", reply_markup=keyboard("Обновить")),
+                await editor.edit(query, "статус", reply_markup=keyboard("Обновить")),
+                # Изменилась только клавиатура или сообщение другое: правка нужна
+                await editor.edit(query, "статус", reply_markup=keyboard("Назад")),
+                await editor.edit(FakeQuery(message_id=2), "статус", reply_markup=keyboard("Назад"))]
+
+    assert asyncio.run(scenario()) == [True, False, True, True]
+    assert [text for text, _ in query.edits] == ["статус", "статус"]
+
+
+def test_not_modified_reply_is_remembered():
+    editor = MessageEditor()
+    query = FakeQuery(error=BadRequest("Message is not modified: specified new message content ..."))
+
+    async def scenario():
+        first = await editor.edit(query, "статус")
+        query.error = None
+        return first, await editor.edit(query, "статус")
+
+    assert asyncio.run(scenario()) == (False, False)
+    assert query.edits == []
+
+
+def test_other_bad_request_is_raised():
+    editor = MessageEditor()
+    query = FakeQuery(error=BadRequest("Message to edit not found"))
+    with pytest.raises(BadRequest):
+        asyncio.run(editor.edit(query, "статус"))
+
+
+def test_answer_error_does_not_break_handler():
+    async def scenario():
+        async with answering(FakeQuery()):
+            return "handled"
+
+    assert asyncio.run(scenario()) == "handled"
@@ -0,0 +1,80 @@
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from py3xui import Client
+
+from client_index import ClientIndex
+from storage import SQLiteUserStore
+from transfer import ImportProgress, UserImporter
+
+
+class FakePlacement:
+    available = True
+
+    def choose(self, count_clients):
+        return SimpleNamespace(panel=SimpleNamespace(name="main"))
+
+
+class CrashingStore(SQLiteUserStore):
+    """Хранилище, падающее на записи пачки, как при сбое после client.add"""
+    crash = False
+
+    def add_users(self, users):
+        if self.crash:
+            raise RuntimeError("сбой процесса")
+        return super().add_users(users)
+
+
+def make_client(record):
+    return Client(id=str(uuid.uuid4()), email=f"user{record['telegram_id']}@telegram.vpn", enable=True,
+                  tgId=record["telegram_id"])
+
+
+def record(telegram_id):
+    return {"telegram_id": telegram_id, "username": None, "full_name": None, "language_code": None,
+            "subscription_url": None, "xui_client_id": None, "email": None, "panel": None,
+            "inbound_id": None, "created_at": None}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = CrashingStore(tmp_path / "users.db")
+    store.init()
+    yield store
+    store.close()
+
+
+def test_resume_after_crash_reuses_created_clients(store, tmp_path):
+    panel_clients = []
+
+    def add_clients(target, clients):
+        panel_clients.extend(clients)
+
+    def fresh_index():
+        # После перезапуска индекс строится заново из состояния панели
+        index = ClientIndex()
+        inbound = SimpleNamespace(id=1, settings=SimpleNamespace(clients=list(panel_clients)))
+        index.refresh(lambda: {"main": [inbound]})
+        return index
+
+    def importer(index):
+        return UserImporter(store, index, FakePlacement(), add_clients, lambda target: 1,
+                            lambda client_id, inbound_id, panel: f"sub/{client_id}", make_client, batch_size=2)
+
+    records = [(position, record(1000 + position)) for position in range(1, 4)]
+    progress = ImportProgress(tmp_path / "import.progress")
+
+    store.crash = True
+    with pytest.raises(RuntimeError):
+        importer(fresh_index()).run(records, progress)
+    assert len(panel_clients) == 2
+
+    store.crash = False
+    stats = importer(fresh_index()).run(records, progress)
+
+    assert len(panel_clients) == 3
+    assert stats["reused"] == 2
+    assert stats["provisioned"] == 1
+    assert store.existing_telegram_ids([1001, 1002, 1003]) == {1001, 1002, 1003}
+    assert store.get_user(1001).xui_client_id == str(panel_clients[0].id)
@@ -0,0 +1,78 @@
+import asyncio
+
+from telegram import CallbackQuery, Update, User
+
+from updates import PerUserUpdateProcessor
+
+
+def make_update(update_id, user_id):
+    user = User(id=user_id, first_name="user", is_bot=False)
+    return Update(update_id, callback_query=CallbackQuery(str(update_id), user, chat_instance="chat"))
+
+
+def test_queued_updates_of_one_user_do_not_block_others():
+    async def scenario():
+        processor = PerUserUpdateProcessor(2)
+        release = asyncio.Event()
+        order = []
+
+        async def slow(name):
+            order.append(name)
+            await release.wait()
+
+        async def fast(name):
+            order.append(name)
+
+        # Пользователь A: одно долгое обновление и несколько ждущих в очереди
+        tasks = [asyncio.create_task(processor.process_update(make_update(1, 1), slow("a1")))]
+        tasks += [asyncio.create_task(processor.process_update(make_update(n, 1), fast(f"a{n}")))
+                  for n in range(2, 6)]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(processor.process_update(make_update(10, 2), fast("b")), timeout=1)
+        assert order == ["a1", "b"]
+        # Принятые обновления видны PTB, включая ждущих очереди пользователя
+        assert processor.current_concurrent_updates == 5
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert order[2:] == ["a2", "a3", "a4", "a5"]
+        assert processor.current_concurrent_updates == 0
+
+    asyncio.run(scenario())
+
+
+def test_concurrency_limit_across_users():
+    async def scenario():
+        processor = PerUserUpdateProcessor(2)
+        running = 0
+        peak = 0
+
+        async def handler():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(make_update(n, n), handler()) for n in range(6)))
+        assert peak == 2
+
+    asyncio.run(scenario())
+
+
+def test_shutdown_waits_for_updates_in_flight():
+    async def scenario():
+        processor = PerUserUpdateProcessor(4, drain_timeout=1)
+        done = []
+
+        async def handler():
+            await asyncio.sleep(0.02)
+            done.append(True)
+
+        task = asyncio.create_task(processor.process_update(make_update(1, 1), handler()))
+        await asyncio.sleep(0)
+        await processor.shutdown()
+        assert done == [True]
+        await task
+
+    asyncio.run(scenario())